@@ -8,18 +8,68 @@ import multiprocessing
 import subprocess
 import sqlite3
 import re
+import gzip
+import bisect
+import itertools
+import operator
+import traceback
+from urllib.request import pathname2url
 from datetime import datetime
-
-# databasePath = ""
-
-def connectToDB():
+from TaskScheduling import runLargestFirst
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# the database every connection opens unless it is given another path, set with -db
+databasePath = 'SpliceJunction.db'
+
+# the settings of each kind of connection, picked by connectToDB()'s profile:
+#	ingest, for connections which write many junctions: a 256 MB page cache, fewer syncs, which in WAL mode still
+#	keep the database consistent after a crash, and temporary tables and sorts in memory
+#	query, for connections which only read: opened read-only, with the database file memory mapped so pages are
+#	read straight from the operating system's page cache instead of being copied in to SQLite's.
+#	SQLite clamps mmap_size to the largest size it was compiled with. Temporary tables can still be made, which
+#	PRAGMA query_only would refuse. A WAL database still gets -wal and -shm files, so its directory must be writable
+connectionProfiles = {
+	'default': {'read_only': False, 'pragmas': []},
+	'ingest': {'read_only': False, 'pragmas': ['PRAGMA cache_size = -262144;', 'PRAGMA synchronous = NORMAL;', 'PRAGMA temp_store = MEMORY;']},
+	'query': {'read_only': True, 'pragmas': ['PRAGMA mmap_size = 17179869184;', 'PRAGMA cache_size = -262144;']}}
+
+# state shared by every task, sent to each worker process once by initializeWorker()
+sharedBamList = []
+sharedGeneSet = set()
+sharedFlank = 1
+sharedAggregates = True
+writerQueue = None
+
+# worker processes send the writer process batches of at least writerBatchRows junctions,
+# the writer commits once it has stored writerCommitRows junctions
+writerBatchRows = 5000
+writerCommitRows = 200000
+
+# the transcript_model, loaded in to memory once per process and database by transcriptModelIndex(), and the
+# database it was loaded from. storeTranscriptModelJunctions() forgets it
+transcriptModel = None
+transcriptModelPath = None
+
+# the layout of a schema 2 junction_id, see packJunctionID()
+chromosomeShift = 55
+startShift = 27
+maxChromosomeID = (1 << 8) - 1
+maxJunctionStart = (1 << 28) - 1
+maxJunctionLength = (1 << 27) - 1
+
+def connectToDB(path=None, profile='default'):
 
 	"""
 	Establishes a single unique connection to the database SpliceJunction.db
 	and a cursor
 
 	Args:
-	    None
+	    path, the database to connect to, databasePath (SpliceJunction.db in the working directory) by default
+	    profile, the name of the settings in connectionProfiles to connect with: default, ingest or query
 
 	Returns:
 	    The connection and a cursor to that connection
@@ -28,9 +78,21 @@ def connectToDB():
 	    None
 	"""
 
-	conn = sqlite3.connect('SpliceJunction.db', timeout=80)
+	if path is None:
+		path = databasePath
+
+	settings = connectionProfiles[profile]
+
+	if settings['read_only']:
+		conn = sqlite3.connect('file:' + pathname2url(os.path.abspath(path)) + '?mode=ro', timeout=80, uri=True)
+	else:
+		conn = sqlite3.connect(path, timeout=80)
+
 	cur = conn.cursor()
 
+	for pragma in settings['pragmas']:
+		cur.execute(pragma)
+
 	return conn, cur
 
 def commitAndClose(conn):
@@ -51,7 +113,99 @@ def commitAndClose(conn):
 	conn.commit()
 	conn.close()
 
-def initializeDB():
+def schemaVersion(cur):
+
+	"""
+	Gets the schema of a splice junction database, stored in its user_version. Databases made before
+	schema 2 existed have a user_version of 0 and use schema 1.
+
+	Args:
+		cur, a cursor to a connection to the database
+
+	Returns:
+	    1 or 2
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''PRAGMA user_version;''')
+
+	return 2 if cur.fetchone()[0] == 2 else 1
+
+def packJunctionID(chromosome_id, start, stop):
+
+	"""
+	Packs a junction's position in to the 64-bit junction_id schema 2 uses as the primary key of JUNCTION_REF.
+	The chromosome_id takes the top 8 bits, the start the next 28 bits and the length of the intron, stop - start,
+	the low 27 bits, so junction_ids sort by chromosome, then start, then stop. The same packing is written in SQL
+	by packedJunctionID().
+
+	Args:
+		chromosome_id, the ROWID of the junction's chromosome in CHROMOSOME_REF, from 1 to 255
+		start, the 5' splice site of a junction
+		stop, the 3' splice site of a junction
+
+	Returns:
+	    an int
+
+	Raises:
+	    ValueError, if the junction does not fit in to a junction_id
+	"""
+
+	if not (0 < chromosome_id <= maxChromosomeID and 0 <= start <= maxJunctionStart and 0 <= stop - start <= maxJunctionLength):
+		raise ValueError('%s-%s on chromosome %s cannot be packed in to a junction_id' % (start, stop, chromosome_id))
+
+	return (chromosome_id << chromosomeShift) | (start << startShift) | (stop - start)
+
+def packedJunctionID(chromosome_id, start, stop):
+
+	"""
+	The SQL expression of packJunctionID(), for set-based statements
+
+	Args:
+		chromosome_id, start and stop, SQL expressions for the columns of a junction
+
+	Returns:
+	    a string
+
+	Raises:
+	    None
+	"""
+
+	return '(({0} << {3}) | ({1} << {4}) | ({2} - {1}))'.format(chromosome_id, start, stop, chromosomeShift, startShift)
+
+def chromosomeID(cur, chrom):
+
+	"""
+	Gets the ROWID of a chromosome in CHROMOSOME_REF of a schema 2 database, adding the chromosome the first
+	time a junction is seen on it
+
+	Args:
+		cur, a cursor to a connection to the database
+		chrom, a chromosome name
+
+	Returns:
+	    the chromosome_id
+
+	Raises:
+	    Exception, if the database already holds maxChromosomeID chromosomes
+	"""
+
+	cur.execute('''select chromosome_id from CHROMOSOME_REF where chromosome = ?;''', (chrom, ))
+	res = cur.fetchone()
+
+	if res:
+		return res[0]
+
+	try:
+		cur.execute('''insert into CHROMOSOME_REF (chromosome) values (?);''', (chrom, ))
+	except sqlite3.IntegrityError:
+		raise Exception ('FATAL ERROR - a schema 2 database holds at most %d chromosomes, %s does not fit' % (maxChromosomeID, chrom))
+
+	return cur.lastrowid
+
+def initializeDB(path=None, schema=None):
 
 	"""
 	Sets up the tables and SQLite settings required for the splice junction database
@@ -59,6 +213,23 @@ def initializeDB():
 	WAL mode - Write ahead logging, allows for reading while another worker process is
 	writing to the database. Needed for concurrency reasons.
 
+	A new database is made with schema 1 unless schema 2 is asked for, an existing database keeps
+	the schema it was made with. MigrateDatabase.py converts a schema 1 database to schema 2.
+	Both schemas have the tables and columns described below, schema 2 stores them more compactly
+	for databases of thousands of samples:
+
+		JUNCTION_REF is keyed on a junction_id packed from the junction's position by packJunctionID(),
+		instead of a ROWID plus a unique index on (start, stop, chromosome). start and stop are virtual
+		columns computed from the junction_id. CHROMOSOME_REF gives each chromosome its 8 bit id.
+
+		JUNCTION_COUNTS is a WITHOUT ROWID table clustered on (junction_id, bam_id), so each read count is
+		stored once instead of once in the table and once in its primary key index.
+
+		GENE_REF is a view of JUNCTION_GENES, a WITHOUT ROWID table of (junction_id, gene_id), and GENE_NAMES,
+		which stores each gene name once. Inserting in to or deleting from the view is done by its triggers.
+
+		TRANSCRIPT_MODEL_JUNCTIONS is a WITHOUT ROWID table. SAMPLE_REF has an explicit bam_id INTEGER PRIMARY KEY.
+
 	SAMPLE_REF: Contains all BAM file names and their experiment type
 		type = {0, 1} 
 		GTEX, patient
@@ -76,26 +247,46 @@ def initializeDB():
 
 	TRANSCRIPT_MODEL_JUNCTIONS: A storage of junctions from the user specific transcript_model
 	parameter. This is table is only used as a reference for gencode annotation and normalization
-	and has no actual relevance to the other tables.
+	and has no actual relevance to the other tables. Its stopJunction index is built by 
+	storeTranscriptModelJunctions() after the junctions are loaded.
 
 	Args:
-		None
+		path, the database to set up, databasePath by default
+		schema, 1 or 2, the schema of a new database. None for schema 1
 
 	Returns:
-	    None
+	    the schema of the database
 
 	Raises:
 	    None
 	"""
 
-	conn, cur = connectToDB()
+	if path is None:
+		path = databasePath
+
+	conn, cur = connectToDB(path)
 
 	# WAL mode is only present in SQLite versions 3.7.0 or above
 	# Make sure your sqlite3 Python library is based off of the same SQLite3 or higher!
-	# It is critical to having multiple writers and readers 
+	# It is critical to having multiple writers and readers
 	cur.execute('''PRAGMA journal_mode = WAL;''') # WAL - write ahead logging - allows reading while writing. Needed for concurrency
 	cur.execute('''PRAGMA foreign_keys = ON;''')
 
+	cur.execute('''select count(*) from sqlite_master where type = 'table' and name = 'JUNCTION_REF';''')
+
+	if cur.fetchone()[0]:
+		existing = schemaVersion(cur)
+
+		if schema and schema != existing:
+			print ('%s already uses schema %d, not schema %d. MigrateDatabase.py converts a schema 1 database to schema 2' % (path, existing, schema))
+
+		schema = existing
+
+	if schema == 2:
+		initializeCompactTables(cur)
+		commitAndClose(conn)
+		return 2
+
 	cur.execute('''create table if not exists SAMPLE_REF (
 		sample_name varchar(50) primary key, 
 		type tinyint not null);''') 
@@ -139,19 +330,307 @@ def initializeDB():
 		stop unsigned big int not null,
 		primary key (chromosome, start, stop));''')
 
-	cur.execute('''create index if not exists stopJunction
-		on TRANSCRIPT_MODEL_JUNCTIONS (chromosome, stop);
-		''')
-
 	commitAndClose(conn)
 
-def getJunctionID(cur, chrom, start, stop, flank):
+	return 1
+
+def initializeCompactTables(cur):
+
+	"""
+	Creates the tables, view and triggers of schema 2, see initializeDB(), and sets the database's user_version to 2.
+	Generated columns need SQLite 3.31.0 or higher.
+
+	Args:
+		cur, a cursor to a connection to the database
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	# bam_id is an INTEGER PRIMARY KEY so VACUUM keeps it, see compactDatabase()
+	cur.execute('''create table if not exists SAMPLE_REF (
+		bam_id integer primary key,
+		sample_name varchar(50) not null unique,
+		type tinyint not null);''')
+
+	cur.execute('''create table if not exists CHROMOSOME_REF (
+		chromosome_id integer primary key check (chromosome_id between 1 and {0}),
+		chromosome tinyint not null unique);'''.format(maxChromosomeID))
+
+	cur.execute('''create table if not exists JUNCTION_REF (
+		junction_id integer primary key,
+		chromosome tinyint not null,
+		start unsigned big int generated always as ((junction_id >> {0}) & {1}) virtual,
+		stop unsigned big int generated always as (((junction_id >> {0}) & {1}) + (junction_id & {2})) virtual,
+		gencode_annotation tinyint not null,
+		n_patients_seen unsigned big int default 0,
+		n_gtex_seen unsigned big int default 0,
+		total_patient_read_count big int default 0,
+		total_gtex_read_count big int default 0,
+		total_read_count big int default 0);'''.format(startShift, maxJunctionStart, maxJunctionLength))
+
+	cur.execute('''create table if not exists JUNCTION_COUNTS (
+		junction_id integer not null,
+		bam_id integer not null,
+		read_count unsigned big int not null,
+		norm_read_count float,
+		foreign key(bam_id) references SAMPLE_REF(bam_id),
+		foreign key(junction_id) references JUNCTION_REF(junction_id),
+		primary key (junction_id, bam_id)) without rowid;''')
+
+	cur.execute('''create table if not exists GENE_NAMES (
+		gene_id integer primary key,
+		gene varchar(30) not null unique);''')
+
+	cur.execute('''create table if not exists JUNCTION_GENES (
+		junction_id integer not null,
+		gene_id integer not null,
+		foreign key(junction_id) references JUNCTION_REF(junction_id),
+		foreign key(gene_id) references GENE_NAMES(gene_id),
+		primary key (junction_id, gene_id)) without rowid;''')
+
+	cur.execute('''create view if not exists GENE_REF as
+		select n.gene as gene, g.junction_id as junction_id
+		from JUNCTION_GENES g inner join GENE_NAMES n on n.gene_id = g.gene_id;''')
+
+	cur.execute('''create trigger if not exists GENE_REF_INSERT instead of insert on GENE_REF
+		begin
+			insert or ignore into GENE_NAMES (gene) values (new.gene);
+			insert or ignore into JUNCTION_GENES (junction_id, gene_id)
+				select new.junction_id, gene_id from GENE_NAMES where gene = new.gene;
+		end;''')
+
+	cur.execute('''create trigger if not exists GENE_REF_DELETE instead of delete on GENE_REF
+		begin
+			delete from JUNCTION_GENES where junction_id = old.junction_id and
+				gene_id = (select gene_id from GENE_NAMES where gene = old.gene);
+		end;''')
+
+	cur.execute('''create table if not exists TRANSCRIPT_MODEL_JUNCTIONS (
+		chromosome tinyint not null,
+		start unsigned big int not null,
+		stop unsigned big int not null,
+		primary key (chromosome, start, stop)) without rowid;''')
+
+	cur.execute('''PRAGMA user_version = 2;''')
+
+def hasRegionIndex(cur):
+
+	"""
+	Checks whether a database has the R*Tree made by createRegionIndex()
+
+	Args:
+		cur, a cursor to a connection to the database
+
+	Returns:
+	    True or False
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''select 1 from sqlite_master where type = 'table' and name = 'JUNCTION_RTREE';''')
+
+	return cur.fetchone() is not None
+
+def createRegionIndex(cur):
+
+	"""
+	Creates JUNCTION_RTREE, an R*Tree of every junction in JUNCTION_REF, if it does not exist, so the junctions
+	overlapping a region are found without reading all of JUNCTION_REF. Its id is the junction_id (the ROWID of
+	schema 1) and its two dimensions are the chromosome_id of the junction's chromosome and its start to stop.
+	Schema 1 databases get a CHROMOSOME_REF as well, without the limit of 255 chromosomes of schema 2.
+
+	Triggers on JUNCTION_REF keep the R*Tree in sync as junctions are added, by the writer process or --bulk,
+	and removed by --delete --compact. Needs the R*Tree module, which SQLite is built with by default.
+
+	Args:
+		cur, a cursor to a connection to the database, outside of a transaction
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	if hasRegionIndex(cur):
+		return
+
+	cur.execute('''begin immediate;''')
+
+	cur.execute('''create table if not exists CHROMOSOME_REF (
+		chromosome_id integer primary key,
+		chromosome tinyint not null unique);''')
+	cur.execute('''insert or ignore into CHROMOSOME_REF (chromosome) 
+		select distinct chromosome from JUNCTION_REF order by chromosome;''')
+
+	# rtree_i32 stores positions as 32-bit integers, an rtree's 32-bit floats would round positions above 16777216
+	cur.execute('''create virtual table JUNCTION_RTREE using rtree_i32 (
+		junction_id,
+		chromosome_min, chromosome_max,
+		start, stop);''')
+	cur.execute('''insert into JUNCTION_RTREE (junction_id, chromosome_min, chromosome_max, start, stop)
+		select r.ROWID, k.chromosome_id, k.chromosome_id, r.start, r.stop 
+		from JUNCTION_REF r 
+		inner join CHROMOSOME_REF k on k.chromosome = r.chromosome;''')
+
+	# a schema 2 junction's chromosome is always in CHROMOSOME_REF already
+	cur.execute('''create trigger if not exists JUNCTION_RTREE_INSERT after insert on JUNCTION_REF
+		begin
+			insert or ignore into CHROMOSOME_REF (chromosome) values (new.chromosome);
+			insert into JUNCTION_RTREE (junction_id, chromosome_min, chromosome_max, start, stop)
+				select new.ROWID, k.chromosome_id, k.chromosome_id, new.start, new.stop 
+				from CHROMOSOME_REF k where k.chromosome = new.chromosome;
+		end;''')
+	cur.execute('''create trigger if not exists JUNCTION_RTREE_DELETE after delete on JUNCTION_REF
+		begin
+			delete from JUNCTION_RTREE where junction_id = old.ROWID;
+		end;''')
+
+	cur.connection.commit()
+
+def chromosomeKey(chrom):
+
+	"""
+	Makes the key of a chromosome in the transcript_model index. Chromosome columns have integer
+	affinity, so SQLite stores '1' as the integer 1 and 'X' as text; keys follow the same rule.
+
+	Args:
+		chrom, a chromosome name from a file or a chromosome value from the database
+
+	Returns:
+	    an int or a string
+
+	Raises:
+	    None
+	"""
+
+	try:
+		return int(chrom)
+	except ValueError:
+		return chrom
+
+def loadTranscriptModel(cur):
+
+	"""
+	Loads TRANSCRIPT_MODEL_JUNCTIONS in to sorted per chromosome arrays used by annotateJunction()
+
+	Args:
+		cur, a cursor to a connection to the database
+
+	Returns:
+	    a dictionary keyed on chromosomeKey(). Each value is a tuple of (starts, pairedStops, stops):
+	    starts is every junction start in increasing order, pairedStops[i] is the stop of the junction
+	    starting at starts[i] (junctions are sorted by start, then stop) and stops is every junction stop in increasing order
+
+	Raises:
+	    None
+	"""
+
+	junctions = {}
+
+	for chrom, start, stop in cur.execute('''select chromosome, start, stop from TRANSCRIPT_MODEL_JUNCTIONS;'''):
+		junctions.setdefault(chromosomeKey(chrom), []).append((int(start), int(stop)))
+
+	index = {}
+
+	for chrom, pairs in junctions.items():
+		pairs.sort()
+		index[chrom] = ([start for start, stop in pairs], [stop for start, stop in pairs], sorted(stop for start, stop in pairs))
+
+	return index
+
+def transcriptModelIndex(cur):
+
+	"""
+	Returns the in-memory transcript_model index, loading it from the database the first time a
+	process needs it. The transcript_model does not change while samples are added. The index is kept
+	for the database file it was loaded from, a connection to another database loads that database's
+	index instead, and an in-memory database's is never kept
+
+	Args:
+		cur, a cursor to a connection to the database
+
+	Returns:
+	    an index made by loadTranscriptModel()
+
+	Raises:
+	    None
+	"""
+
+	global transcriptModel, transcriptModelPath
+
+	# the file of the main database, '' for an in-memory database. Read on the connection so cur's rows are kept
+	path = [row[2] for row in cur.connection.execute('''PRAGMA database_list;''') if row[1] == 'main'][0]
+
+	if not path:
+		return loadTranscriptModel(cur)
+
+	if transcriptModel is None or transcriptModelPath != path:
+		transcriptModel = loadTranscriptModel(cur)
+		transcriptModelPath = path
+
+	return transcriptModel
+
+def annotateJunction(index, chrom, start, stop, flank):
+
+	"""
+	Classifies a junction against the transcript_model using bisection on the in-memory index.
+	A splice site is annotated if a transcript_model junction has the same site within +/- flank.
+
+	Args:
+		index, an index made by loadTranscriptModel()
+		chrom, the chromosome a junction lies on
+		start, the 5' splice site of a junction
+		stop, the 3' splice site of a junction
+		flank, the +/- range a junction's start and stop site must fall within, 0 for exact matches
+
+	Returns:
+	    gencode_annotation, 0 = none, 1 = only start, 2 = only stop, 3 = both, 4 = exon skipping
+
+	Raises:
+	    None
+	"""
+
+	junctions = index.get(chromosomeKey(chrom))
+
+	if not junctions:
+		return 0 # novel junction
+
+	starts, pairedStops, stops = junctions
+
+	i = bisect.bisect_left(starts, start - flank)
+	isStartAnnotated = i < len(starts) and starts[i] <= start + flank
+
+	while i < len(starts) and starts[i] <= start + flank:
+		if stop - flank <= pairedStops[i] <= stop + flank:
+			return 3 # both annotated
+		i += 1
+
+	j = bisect.bisect_left(stops, stop - flank)
+	isStopAnnotated = j < len(stops) and stops[j] <= stop + flank
+
+	if isStopAnnotated and isStartAnnotated:
+		return 4 # exon skipping
+	elif isStopAnnotated:
+		return 2 # only stop
+	elif isStartAnnotated:
+		return 1 # only start
+
+	return 0 # novel junction
+
+def getJunctionID(cur, chrom, start, stop, flank, annotation=None, schema=None):
 
 	"""
 	Retrieves the ROWID and annotation of a junction from the database
 
 	If the junction does not exist in the database, then the function adds it
-	and returns the appropriate values
+	and returns the appropriate values. New junctions are annotated in memory by annotateJunction()
+	instead of querying TRANSCRIPT_MODEL_JUNCTIONS
 
 	Args:
 		cur, the cursor of a database connection
@@ -159,7 +638,9 @@ def getJunctionID(cur, chrom, start, stop, flank):
 		start, the 5' splice site of a junction
 		stop, the 3' splice site of a junction
 		flank, the +/- range a junction's start and stop site must fall within
-		the transcript_model's start and stop site to be considered "annotated" 
+		the transcript_model's start and stop site to be considered "annotated", 0 for exact matches
+		annotation, the annotation of the junction if it was already made by annotateJunction(), used if the junction is new
+		schema, the schema of the database from schemaVersion(), looked up if None
 
 	Returns:
 	    ROWID (junction_id), gencode_annotation of a junction
@@ -172,6 +653,31 @@ def getJunctionID(cur, chrom, start, stop, flank):
 	# none, only start, only stop, both, exon skipping
 	# thus, gencode junctions will always have a gencode_annotation value of 3
 
+	if schema is None:
+		schema = schemaVersion(cur)
+
+	# schema 2 junctions are found by their packed junction_id, only the writer process adds them
+	if schema == 2:
+
+		if not (0 <= start <= maxJunctionStart and 0 <= stop - start <= maxJunctionLength):
+			raise ValueError('%s:%s-%s cannot be packed in to a junction_id' % (chrom, start, stop))
+
+		cur.execute('''select junction_id, gencode_annotation from JUNCTION_REF where junction_id = {0};'''.format(
+			packedJunctionID('(select chromosome_id from CHROMOSOME_REF where chromosome = :chrom)', ':start', ':stop')),
+			{'chrom': chrom, 'start': start, 'stop': stop})
+		res = cur.fetchone()
+
+		if res:
+			return res
+
+		if annotation is None:
+			annotation = annotateJunction(transcriptModelIndex(cur), chrom, start, stop, flank)
+
+		junction_id = packJunctionID(chromosomeID(cur, chrom), start, stop)
+		cur.execute('''insert into JUNCTION_REF (junction_id, chromosome, gencode_annotation) values (?, ?, ?);''', (junction_id, chrom, annotation))
+
+		return junction_id, annotation
+
 	# check if start and stop are apart of an existing gencode annotation
 	cur.execute('''select ROWID, gencode_annotation from JUNCTION_REF where 
 		chromosome is ? and
@@ -185,56 +691,8 @@ def getJunctionID(cur, chrom, start, stop, flank):
 	# if no such junction determine annotation of new junction: novel junction, only one annotated or a case of exon skipping?
 	else:
 
-		if flank > 0:
-			cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-				chromosome is ? and
-				start >= ? and
-				start <= ? and
-				stop >= ? and
-				stop <= ?;''', (chrom, (start - flank), (start + flank), (stop - flank), (stop + flank)) )
-			isBothAnnotated = cur.fetchone()
-
-			if not isBothAnnotated:
-				cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-					chromosome = ? and
-					start >= ? and
-					start <= ?;''', (chrom, (start - flank), (start + flank)) )
-				isStartAnnotated = cur.fetchone()
-
-				cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-					chromosome = ? and
-					stop >= ? and
-					stop <= ?;''', (chrom, (stop - flank), (stop + flank)))
-				isStopAnnotated = cur.fetchone()
-
-		else:
-			cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-				chromosome = ? and
-				start = ?
-				stop is = ?;''', (chrom, start, stop) )
-			isBothAnnotated = cur.fetchone()
-
-			if not isBothAnnotated:
-				cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-					chromosome = ? and
-					start = ?;''', (chrom, start))
-				isStartAnnotated = cur.fetchone()
-
-				cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
-					chromosome = ? and
-					stop = ?;''', (chrom, stop))
-				isStopAnnotated = cur.fetchone()
-
-		if isBothAnnotated:
-			annotation = 3 # both annotated
-		elif isStopAnnotated and isStartAnnotated:
-			annotation = 4 # exon skipping
-		elif isStopAnnotated:
-			annotation = 2 # only stop
-		elif isStartAnnotated:
-			annotation = 1 # only start
-		else:
-			annotation = 0 # novel junction
+		if annotation is None:
+			annotation = annotateJunction(transcriptModelIndex(cur), chrom, start, stop, flank)
 
 		try:
 			cur.execute('''insert into JUNCTION_REF (
@@ -415,80 +873,817 @@ def get_annotated_counts(spliceDict):
 
 	return count_dict
 
-def summarizeGeneFile(poolArguement):
+def siteMaxima(groups, chroms, positions, counts):
 
 	"""
-	The function each worker process must go through.
-
-	Each process is assigned a gene, and finds the corresponding gene text file in each
-	sample folder. The worker process performs transcript_model annotation, normalization, 
-	and finally adds the junction information to the database.
+	The vectorized get_annotated_counts(). Finds the largest read count of every splice site with a grouped max: 
+	junctions are sorted by (group, chromosome, position) and each run of equal keys is reduced at once.
 
 	Args:
-		poolArgument, is composed of:
-
-			bamList, a list of bams to be used to access each sample's folder
-			gene, the gene text file in which each worker process should read from each sample
-			flank, the flanking region for each transcript_model junction
+		groups, chroms and positions, numpy integer arrays which together identify a splice site, groups tells
+		apart the spliceDicts the junctions came from
+		counts, a numpy integer array of read counts
 
 	Returns:
-	    None
+	    a numpy array with the largest read count of each junction's splice site
 
 	Raises:
 	    None
 	"""
 
-	bamList, gene, flank = poolArguement
-	conn, cur = connectToDB()
+	if not len(counts):
+		return counts.copy()
 
-	print ('processing ' + gene)
+	order = numpy.lexsort((positions, chroms, groups))
 
-	for bam in bamList:
+	# True where a new splice site begins in sorted order
+	newSite = numpy.zeros(len(order), dtype=bool)
+	newSite[0] = True
 
-		bam_id, bam_type = get_bam_id_and_type(cur, bam)
+	for key in (groups, chroms, positions):
+		sortedKey = key[order]
+		newSite[1:] |= sortedKey[1:] != sortedKey[:-1]
 
-		sample = bam[:-4]
-		gene_file = ''.join([os.getcwd(), "/", sample, "/", gene, ".txt"])
+	maxima = numpy.maximum.reduceat(counts[order], numpy.flatnonzero(newSite))
 
-		if not os.path.isfile(gene_file):
-			continue
+	siteMax = numpy.empty_like(counts)
+	siteMax[order] = maxima[numpy.cumsum(newSite) - 1]
 
-		spliceDict = makeSpliceDict(gene_file)
-		annotated_counts = get_annotated_counts(spliceDict)
+	return siteMax
 
-		for junction in spliceDict:
+def normalizeJunctionArrays(counts, annotations, start_max, stop_max):
 
-			chrom, start, stop = junction
-			reads = spliceDict[junction]
+	"""
+	The vectorized normalizeReadCount(), following the same rules for every junction at once:
+	annotation 0 is not normalized, 1 uses the start site, 2 the stop site and 3 or 4 the site with the
+	bigger read count
 
-			junction_id, annotation = getJunctionID(cur, chrom, int(start), int(stop), flank)
+	numpy.round() scales by 1000 and rounds half to even, which can disagree with round() when a ratio is 
+	within a rounding error of half a thousandth, so those few ratios are rounded by round() instead
 
-			try:
-				norm_read_count = normalizeReadCount(spliceDict, junction, annotation, annotated_counts)
-			except ZeroDivisionError:
-				print("Zero division error when normalizing %s:%s-%s in genefile %s.txt in sample %s with annotation %d"%(chrom, start, stop, gene, sample, annotation))
-				norm_read_count = 'null'
+	Args:
+		counts, a numpy integer array of read counts
+		annotations, a numpy integer array of gencode annotations
+		start_max and stop_max, numpy arrays made by siteMaxima()
 
-			annotateJunctionWithGene(gene, junction_id, cur)
+	Returns:
+	    a list of normalized read counts as strings, the same strings normalizeReadCount() returns,
+	    'NULL' for unannotated junctions and None where normalizeReadCount() divides by zero
 
-			# locks are needed to maintain total read count integrity
-			lock.acquire()
-			updateJunctionInformation(junction_id, bam_id, bam_type, gene, sample, reads, norm_read_count, cur)
-			lock.release()
+	Raises:
+	    None
+	"""
 
-		del spliceDict, annotated_counts
-	
-	commitAndClose(conn)
+	annotated_counts = numpy.where(annotations == 1, start_max, numpy.where(annotations == 2, stop_max, numpy.maximum(start_max, stop_max)))
 
-	print ('finished ' + gene)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		ratios = counts / annotated_counts
 
-def updateJunctionInformation(junction_id, bam_id, bam_type, gene, sample, new_read_count, new_norm_read_count, cur):
+	scaled = ratios * 1000
+	rounded = numpy.round(ratios, 3).tolist()
 
-	"""
-	Adds a junction's position and its read counts to the database. Logic for total read counts has also been implemented.
+	for i in numpy.flatnonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6).tolist():
+		rounded[i] = round(float(ratios[i]), 3)
 
-	In the case that a junction already exists for a sample, the larger read count and its corresponding normalized read count
-	is used.
+	norms = list(map(str, rounded))
+
+	for i in numpy.flatnonzero(annotated_counts == 0).tolist():
+		norms[i] = None
+
+	for i in numpy.flatnonzero(annotations == 0).tolist():
+		norms[i] = 'NULL'
+
+	return norms
+
+def normalizeJunctionGroups(groups, annotations):
+
+	"""
+	Normalizes the junctions of several spliceDicts, E.x. every gene of a sample or a gene in every sample.
+
+	If numpy is installed the largest read count of each splice site and the normalized read counts are computed
+	for every junction of every group at once by siteMaxima() and normalizeJunctionArrays(), otherwise one group
+	at a time by get_annotated_counts() and normalizeReadCount(). Both give the same results.
+
+	Args:
+		groups, a list of (bam_id, bam_type, sample, gene, spliceDict) tuples, spliceDict made by makeSpliceDict()
+		annotations, a list with the gencode annotation of every junction of each group, in spliceDict order
+
+	Returns:
+	    (norms, start_maxima, stop_maxima), lists with an entry for every junction of every group in order. norms holds
+	    the strings normalizeReadCount() returns and None where it divides by zero, start_maxima and stop_maxima the
+	    largest read count of the junction's start and stop site in its group
+
+	Raises:
+	    None
+	"""
+
+	if numpy is None:
+
+		norms, start_maxima, stop_maxima = [], [], []
+
+		for (bam_id, bam_type, sample, gene, spliceDict), groupAnnotations in zip(groups, annotations):
+
+			annotated_counts = get_annotated_counts(spliceDict)
+
+			for junction, annotation in zip(spliceDict, groupAnnotations):
+
+				chrom, start, stop = junction
+
+				try:
+					norms.append(normalizeReadCount(spliceDict, junction, annotation, annotated_counts))
+				except ZeroDivisionError:
+					norms.append(None)
+
+				start_maxima.append(annotated_counts[makeStartString(chrom, start)])
+				stop_maxima.append(annotated_counts[makeStopString(chrom, stop)])
+
+		return norms, start_maxima, stop_maxima
+
+	junctions = list(itertools.chain.from_iterable(group[4] for group in groups))
+	chromIDs = {}
+
+	groupIDs = numpy.repeat(numpy.arange(len(groups), dtype=numpy.int64), [len(group[4]) for group in groups])
+	chroms = numpy.fromiter((chromIDs.setdefault(chrom, len(chromIDs)) for chrom, start, stop in junctions), dtype=numpy.int64, count=len(junctions))
+	starts = numpy.fromiter(map(int, map(operator.itemgetter(1), junctions)), dtype=numpy.int64, count=len(junctions))
+	stops = numpy.fromiter(map(int, map(operator.itemgetter(2), junctions)), dtype=numpy.int64, count=len(junctions))
+	counts = numpy.fromiter(itertools.chain.from_iterable(group[4].values() for group in groups), dtype=numpy.int64, count=len(junctions))
+
+	start_max = siteMaxima(groupIDs, chroms, starts, counts)
+	stop_max = siteMaxima(groupIDs, chroms, stops, counts)
+
+	annotations = numpy.fromiter(itertools.chain.from_iterable(annotations), dtype=numpy.int64, count=len(junctions))
+	norms = normalizeJunctionArrays(counts, annotations, start_max, stop_max)
+
+	return norms, start_max.tolist(), stop_max.tolist()
+
+def annotateJunctionGroups(cur, groups, flank):
+
+	"""
+	Annotates and normalizes the junctions of several spliceDicts with normalizeJunctionGroups(). Nothing is 
+	written to the database here, the rows are stored by the writer process with storeJunctionRows()
+
+	Args:
+		cur, a cursor to a connection to the database, used once per process to load the transcript_model
+		groups, a list of (bam_id, bam_type, sample, gene, spliceDict) tuples, spliceDict made by makeSpliceDict()
+		flank, the flanking region for each transcript_model junction
+
+	Returns:
+	    a list of (bam_id, bam_type, sample, gene, rows) tuples, one for each group. rows is a list of
+	    (chrom, start, stop, read_count, annotation, norm_read_count, start_max, stop_max) tuples, 
+	    start_max and stop_max are the largest read counts of the junction's splice sites in the gene, so the 
+	    writer can normalize again if the database holds a different annotation for the junction
+
+	Raises:
+	    None
+	"""
+
+	index = transcriptModelIndex(cur)
+	annotations = [[annotateJunction(index, chrom, int(start), int(stop), flank) for chrom, start, stop in spliceDict]
+		for bam_id, bam_type, sample, gene, spliceDict in groups]
+
+	norms, start_maxima, stop_maxima = normalizeJunctionGroups(groups, annotations)
+
+	batch = []
+	position = 0
+
+	for (bam_id, bam_type, sample, gene, spliceDict), groupAnnotations in zip(groups, annotations):
+
+		rows = []
+
+		for ((chrom, start, stop), reads), annotation in zip(spliceDict.items(), groupAnnotations):
+
+			norm_read_count = norms[position]
+
+			if norm_read_count is None:
+				print("Zero division error when normalizing %s:%s-%s in genefile %s.txt in sample %s with annotation %d"%(chrom, start, stop, gene, sample, annotation))
+				norm_read_count = 'null'
+
+			rows.append((chrom, start, stop, reads, annotation, norm_read_count, start_maxima[position], stop_maxima[position]))
+			position += 1
+
+		batch.append((bam_id, bam_type, sample, gene, rows))
+
+	return batch
+
+def sendJunctionGroups(cur, groups, flank, force=False):
+
+	"""
+	Annotates and normalizes the junctions a worker has read with annotateJunctionGroups() and hands them to
+	the writer process, once there are at least writerBatchRows of them
+
+	Args:
+		cur, a cursor to a connection to the database
+		groups, a list of (bam_id, bam_type, sample, gene, spliceDict) tuples. The list is emptied once it is sent
+		flank, the flanking region for each transcript_model junction
+		force, True to send the groups whatever their size, at the end of a task
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	if not groups or (not force and sum(len(group[4]) for group in groups) < writerBatchRows):
+		return
+
+	writerQueue.put(annotateJunctionGroups(cur, groups, flank))
+	del groups[:]
+
+def storeJunctionRows(cur, batch, flank, aggregates=True):
+
+	"""
+	Stores a batch of annotated junctions made by the worker processes. Only the writer process calls this.
+
+	If the database already holds a junction with a different annotation, E.x. one stored with another flank,
+	the stored annotation is kept and the read count is normalized again against it, the same as when each worker
+	wrote its own junctions
+
+	Args:
+		cur, a cursor to the writer's connection to the database
+		batch, a list of (bam_id, bam_type, sample, gene, rows) tuples sent by sendJunctionGroups()
+		flank, the flanking region for each transcript_model junction
+		aggregates, False to leave the population aggregates of JUNCTION_REF for rebuildAggregates()
+
+	Returns:
+	    the number of junctions stored
+
+	Raises:
+	    None
+	"""
+
+	stored = 0
+	schema = schemaVersion(cur)
+
+	for bam_id, bam_type, sample, gene, rows in batch:
+		for chrom, start, stop, reads, annotation, norm_read_count, start_max, stop_max in rows:
+
+			junction_id, stored_annotation = getJunctionID(cur, chrom, int(start), int(stop), flank, annotation, schema)
+
+			if stored_annotation != annotation:
+
+				junction = (chrom, start, stop)
+				annotated_counts = {makeStartString(chrom, start): start_max, makeStopString(chrom, stop): stop_max}
+
+				try:
+					norm_read_count = normalizeReadCount({junction: reads}, junction, stored_annotation, annotated_counts)
+				except ZeroDivisionError:
+					print("Zero division error when normalizing %s:%s-%s in genefile %s.txt in sample %s with annotation %d"%(chrom, start, stop, gene, sample, stored_annotation))
+					norm_read_count = 'null'
+
+			annotateJunctionWithGene(gene, junction_id, cur)
+			updateJunctionInformation(junction_id, bam_id, bam_type, gene, sample, reads, norm_read_count, cur, aggregates)
+
+		stored += len(rows)
+
+	return stored
+
+def junctionWriter(queue, flank, aggregates=True, path=None):
+
+	"""
+	The function of the single writer process. Holds the only connection that writes to the database while
+	parallel_process_gene_files() runs and commits every writerCommitRows junctions, so worker processes never 
+	wait on each other for the database's write lock.
+
+	If storing a batch fails, the remaining batches are still taken off the queue, so workers blocked on
+	a full queue can finish, and the process exits with 1 without committing the current transaction.
+
+	Args:
+		queue, the multiprocessing queue worker processes send batches to, None marks the end
+		flank, the flanking region for each transcript_model junction
+		aggregates, False to leave the population aggregates of JUNCTION_REF for rebuildAggregates()
+		path, the database to write to, databasePath by default
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	conn, cur = connectToDB(path, 'ingest')
+	pending = 0
+	failed = False
+
+	for batch in iter(queue.get, None):
+
+		if failed:
+			continue
+
+		try:
+			pending += storeJunctionRows(cur, batch, flank, aggregates)
+
+			if pending >= writerCommitRows:
+				conn.commit()
+				pending = 0
+
+		except Exception:
+			traceback.print_exc()
+			print ("The writer process failed, no more junctions will be stored")
+			failed = True
+
+	if failed:
+		conn.close()
+		exit(1)
+
+	commitAndClose(conn)
+
+def summarizeGeneFile(poolArguement):
+
+	"""
+	The function each worker process must go through.
+
+	Each process is assigned a gene, and finds the corresponding gene text file in each
+	sample folder. The worker process performs transcript_model annotation and normalization, 
+	and finally sends the junctions to the writer process, which adds them to the database.
+
+	Args:
+		poolArgument, the gene text file in which each worker process should read from each sample
+
+		The list of bams used to access each sample's folder and the flanking region for each
+		transcript_model junction are set once per worker by initializeWorker()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	gene = poolArguement
+	flank = sharedFlank
+	conn, cur = connectToDB(profile='query')
+	groups = []
+
+	print ('processing ' + gene)
+
+	for bam in sharedBamList:
+
+		bam_id, bam_type = get_bam_id_and_type(cur, bam)
+
+		sample = bam[:-4]
+		gene_file = ''.join([os.getcwd(), "/", sample, "/", gene, ".txt"])
+
+		if not os.path.isfile(gene_file):
+			continue
+
+		groups.append((bam_id, bam_type, sample, gene, makeSpliceDict(gene_file)))
+		sendJunctionGroups(cur, groups, flank)
+	
+	sendJunctionGroups(cur, groups, flank, force=True)
+	conn.close()
+
+	print ('finished ' + gene)
+
+def sampleJunctionFile(bam):
+
+	"""
+	Finds the single junction file SpliceJunctionDiscovery.py writes for a sample when run with -output=sample
+
+	Args:
+		bam, the name of a bam file
+
+	Returns:
+	    the path to the sample's junction file, or None if the sample only has gene text files
+
+	Raises:
+	    None
+	"""
+
+	for name in ("junctions.txt.gz", "junctions.txt"):
+
+		path = ''.join([os.getcwd(), "/", bam[:-4], "/", name])
+
+		if os.path.isfile(path):
+			return path
+
+	return None
+
+def readSampleJunctionFile(path):
+
+	"""
+	Reads a sample's junction file in one sequential pass
+
+	The format of the file is as follows, sorted by gene:
+
+	#gene	chromosome	StartPos	StopPos	ReadCount
+
+	Args:
+		path, the path to a junction file produced by SpliceJunctionDiscovery.py with -output=sample
+
+	Returns:
+	    a generator of (gene, spliceDict) tuples, one for each gene in the file
+
+	Raises:
+	    None
+	"""
+
+	with (gzip.open(path, "rt") if path.endswith(".gz") else open(path, "r")) as jf:
+
+		rows = (line.split() for line in jf if not line.startswith("#"))
+
+		for gene, geneRows in itertools.groupby(rows, key=lambda row: row[0]):
+
+			spliceDict = {}
+
+			for gene, chrom, start, stop, count in geneRows:
+				spliceDict[(chrom, start, stop)] = int(count)
+
+			yield gene, spliceDict
+
+def summarizeSampleFile(poolArguement):
+
+	"""
+	The function each worker process goes through for samples with a single junction file.
+
+	Each process is assigned a sample and reads its junction file from start to end once.
+	Junctions are annotated, normalized and sent to the writer process gene by gene exactly as summarizeGeneFile() does.
+
+	Args:
+		poolArgument, the name of the sample's bam file
+
+		The genes of the transcript_file (junctions of other genes are skipped) and the flanking region
+		for each transcript_model junction are set once per worker by initializeWorker()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	bam = poolArguement
+	gene_set = sharedGeneSet
+	flank = sharedFlank
+	conn, cur = connectToDB(profile='query')
+	groups = []
+
+	print ('processing ' + bam)
+
+	bam_id, bam_type = get_bam_id_and_type(cur, bam)
+	sample = bam[:-4]
+
+	for gene, spliceDict in readSampleJunctionFile(sampleJunctionFile(bam)):
+
+		if gene not in gene_set:
+			continue
+
+		groups.append((bam_id, bam_type, sample, gene, spliceDict))
+		sendJunctionGroups(cur, groups, flank)
+
+	sendJunctionGroups(cur, groups, flank, force=True)
+	conn.close()
+
+	print ('finished ' + bam)
+
+def readSampleGenes(bam, gene_set):
+
+	"""
+	Reads every junction a sample has in the genes of the transcript_file, from its single junction file
+	if it has one and from its gene text files otherwise. The sample folder is listed once instead of 
+	checking for a gene text file of every gene in the transcript_file
+
+	Args:
+		bam, the name of the sample's bam file
+		gene_set, a set of gene names from the transcript_file
+
+	Returns:
+	    a generator of (gene, spliceDict) tuples, in alphabetical order of genes for gene text files
+
+	Raises:
+	    None
+	"""
+
+	path = sampleJunctionFile(bam)
+
+	if path:
+		for gene, spliceDict in readSampleJunctionFile(path):
+			if gene in gene_set:
+				yield gene, spliceDict
+
+		return
+
+	folder = ''.join([os.getcwd(), "/", bam[:-4]])
+
+	if not os.path.isdir(folder):
+		return
+
+	with os.scandir(folder) as entries:
+		gene_files = sorted((entry.name[:-4], entry.path) for entry in entries if entry.name.endswith(".txt") and entry.name[:-4] in gene_set)
+
+	for gene, gene_file in gene_files:
+		yield gene, makeSpliceDict(gene_file)
+
+def stagedRows(bam, gene_set):
+
+	"""
+	Makes the rows of the STAGED_ROWS table of a sample. The largest read counts of each junction's
+	splice sites in its gene are computed by get_annotated_counts()
+
+	Args:
+		bam, the name of the sample's bam file
+		gene_set, a set of gene names from the transcript_file
+
+	Returns:
+	    a generator of (gene, chrom, start, stop, read_count, start_max, stop_max) tuples
+
+	Raises:
+	    None
+	"""
+
+	for gene, spliceDict in readSampleGenes(bam, gene_set):
+
+		annotated_counts = get_annotated_counts(spliceDict)
+
+		for junction, count in spliceDict.items():
+			chrom, start, stop = junction
+			yield gene, chrom, int(start), int(stop), count, annotated_counts[makeStartString(chrom, start)], annotated_counts[makeStopString(chrom, stop)]
+
+def roundedRatio(read_count, annotated_count):
+
+	"""
+	Normalizes a read count the way normalizeReadCount() does. Registered as an SQL function so bulk
+	ingest stores exactly the values Python's round() gives
+
+	Args:
+		read_count, the read count of a junction
+		annotated_count, the largest read count of the splice site it is normalized against
+
+	Returns:
+	    a float rounded to 3 decimals
+
+	Raises:
+	    None
+	"""
+
+	return round((float(read_count) / float(annotated_count)), 3)
+
+def stageSampleJunctions(cur, bam, bam_id, flank):
+
+	"""
+	Loads every junction of a sample in to temporary tables and does all the work that does not
+	depend on other samples, so it can run before the write lock is taken:
+
+		STAGED_JUNCTIONS holds a row for each (gene, junction) of the sample with the largest read counts
+		of its 5' and 3' splice sites in the gene, see stagedRows(), and its rank
+		among the genes the junction was found in. The gene with the largest read count ranks first, ties
+		go to the gene which comes first alphabetically, the order gene text files are read in
+
+		SAMPLE_TOTALS holds a row for each distinct junction with its largest read count in the sample,
+		the count already stored for the sample if any, and its transcript_model annotation as
+		getJunctionID() computes it for a new junction
+
+	In a schema 2 database both tables also hold each junction's packed junction_id, or null if its
+	chromosome is not in CHROMOSOME_REF yet, which applySampleJunctions() fills in
+
+	Args:
+		cur, a cursor to a connection to the database
+		bam, the name of the sample's bam file
+		bam_id, the ROWID of the sample in SAMPLE_REF, None for a sample which is not in the database yet
+		flank, the flanking region for each transcript_model junction
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''create temp table STAGED_ROWS (
+		gene varchar(30) not null,
+		chromosome tinyint not null,
+		start unsigned big int not null,
+		stop unsigned big int not null,
+		read_count unsigned big int not null,
+		start_max unsigned big int not null,
+		stop_max unsigned big int not null);''')
+	cur.executemany('''insert into STAGED_ROWS (gene, chromosome, start, stop, read_count, start_max, stop_max) values (?, ?, ?, ?, ?, ?, ?);''', stagedRows(bam, sharedGeneSet))
+
+	if schemaVersion(cur) == 2:
+		junction_id = packedJunctionID('k.chromosome_id', 's.start', 's.stop')
+		chromosomes = 'left join CHROMOSOME_REF k on k.chromosome = s.chromosome'
+		junction = 'r.junction_id = s.junction_id'
+	else:
+		junction_id = 'null'
+		chromosomes = ''
+		junction = 'r.chromosome = s.chromosome and r.start = s.start and r.stop = s.stop'
+
+	cur.execute('''create temp table STAGED_JUNCTIONS as select 
+		s.gene as gene,
+		s.chromosome as chromosome,
+		s.start as start,
+		s.stop as stop,
+		s.read_count as read_count,
+		s.start_max as start_max,
+		s.stop_max as stop_max,
+		{junction_id} as junction_id,
+		row_number() over (partition by s.chromosome, s.start, s.stop order by s.read_count desc, s.gene) as gene_order
+		from STAGED_ROWS s
+		{chromosomes};'''.format(junction_id=junction_id, chromosomes=chromosomes))
+	cur.execute('''create index temp.stagedJunction on STAGED_JUNCTIONS (chromosome, start, stop);''')
+
+	# gencode_annotation = {0, 1, 2, 3, 4}
+	# none, only start, only stop, both, exon skipping
+	cur.execute('''create temp table SAMPLE_TOTALS as select 
+		s.chromosome as chromosome,
+		s.start as start,
+		s.stop as stop,
+		s.junction_id as junction_id,
+		s.read_count as read_count,
+		c.read_count as old_read_count,
+		case
+			when exists (select 1 from TRANSCRIPT_MODEL_JUNCTIONS t where t.chromosome = s.chromosome and
+				t.start between s.start - :flank and s.start + :flank and
+				t.stop between s.stop - :flank and s.stop + :flank) then 3
+			when exists (select 1 from TRANSCRIPT_MODEL_JUNCTIONS t where t.chromosome = s.chromosome and
+				t.start between s.start - :flank and s.start + :flank) and
+				exists (select 1 from TRANSCRIPT_MODEL_JUNCTIONS t where t.chromosome = s.chromosome and
+				t.stop between s.stop - :flank and s.stop + :flank) then 4
+			when exists (select 1 from TRANSCRIPT_MODEL_JUNCTIONS t where t.chromosome = s.chromosome and
+				t.stop between s.stop - :flank and s.stop + :flank) then 2
+			when exists (select 1 from TRANSCRIPT_MODEL_JUNCTIONS t where t.chromosome = s.chromosome and
+				t.start between s.start - :flank and s.start + :flank) then 1
+			else 0
+		end as gencode_annotation
+		from STAGED_JUNCTIONS s
+		left join JUNCTION_REF r on {junction}
+		left join JUNCTION_COUNTS c on c.junction_id = r.ROWID and c.bam_id = :bam_id
+		where s.gene_order = 1;'''.format(junction=junction), {'flank': flank, 'bam_id': bam_id})
+
+def applySampleJunctions(cur, bam_id, bam_type, aggregates=True):
+
+	"""
+	Stores the junctions staged by stageSampleJunctions() with three set-based statements.
+	The results are the same as running annotateJunctionGroups() and storeJunctionRows() on every gene of the sample:
+
+		1. JUNCTION_REF is upserted once per distinct junction. New junctions are inserted with their
+		annotation, junctions already in the database keep theirs and get their totals updated
+		2. GENE_REF maps every junction to every gene it was found in
+		3. JUNCTION_COUNTS is upserted with the largest read count a junction has across the sample's genes
+		and the normalized read count of the gene it came from, computed the same way as normalizeReadCount().
+		Between genes with the same read count the larger normalized read count is kept
+
+	In a schema 2 database the chromosomes seen for the first time are added to CHROMOSOME_REF, so every staged
+	junction has its junction_id, and gene names are interned in GENE_NAMES directly instead of through the GENE_REF view.
+
+	Args:
+		cur, a cursor to a connection to the database, inside a transaction
+		bam_id, the ROWID of the sample in SAMPLE_REF
+		bam_type, 0 or 1, whether the sample is a control or a patient
+		aggregates, False to only insert new junctions in to JUNCTION_REF and leave the population aggregates
+		for rebuildAggregates()
+
+	Returns:
+	    None
+
+	Raises:
+	    Exception, if a junction of a schema 2 database cannot be packed in to a junction_id
+	"""
+
+	if bam_type == 1:
+		seen, total = 'n_patients_seen', 'total_patient_read_count'
+	elif bam_type == 0:
+		seen, total = 'n_gtex_seen', 'total_gtex_read_count'
+	else:
+		raise Exception ('FATAL ERROR - bam_id is not 0 or 1')
+
+	schema = schemaVersion(cur)
+
+	if schema == 2:
+		try:
+			# another sample may have added the chromosome since this one was staged
+			cur.execute('''insert into CHROMOSOME_REF (chromosome) 
+				select distinct chromosome from STAGED_JUNCTIONS s where junction_id is null and
+				not exists (select 1 from CHROMOSOME_REF k where k.chromosome = s.chromosome);''')
+		except sqlite3.IntegrityError:
+			raise Exception ('FATAL ERROR - a schema 2 database holds at most %d chromosomes' % maxChromosomeID)
+
+		for table in ('STAGED_JUNCTIONS', 'SAMPLE_TOTALS'):
+			cur.execute('''update temp.{table} set junction_id = {junction_id} where junction_id is null;'''.format(table=table,
+				junction_id=packedJunctionID('(select chromosome_id from CHROMOSOME_REF k where k.chromosome = {0}.chromosome)'.format(table), 'start', 'stop')))
+
+		cur.execute('''select chromosome, start, stop from STAGED_JUNCTIONS 
+			where start < 0 or start > ? or stop < start or stop - start > ? limit 1;''', (maxJunctionStart, maxJunctionLength))
+		res = cur.fetchone()
+
+		if res:
+			raise Exception ('FATAL ERROR - %s:%s-%s cannot be packed in to a junction_id' % res)
+
+		columns, key, junction = 'junction_id, chromosome', 'junction_id', 'r.junction_id = s.junction_id'
+	else:
+		columns, key, junction = 'chromosome, start, stop', 'start, stop, chromosome', 'r.chromosome = s.chromosome and r.start = s.start and r.stop = s.stop'
+
+	if aggregates:
+		cur.execute('''insert into JUNCTION_REF ({columns}, gencode_annotation, {seen}, total_read_count, {total})
+			select {columns}, gencode_annotation,
+			old_read_count is null,
+			read_count - ifnull(old_read_count, 0),
+			read_count - ifnull(old_read_count, 0)
+			from SAMPLE_TOTALS
+			where old_read_count is null or read_count > old_read_count
+			on conflict ({key}) do update set
+				{seen} = {seen} + excluded.{seen},
+				total_read_count = total_read_count + excluded.total_read_count,
+				{total} = {total} + excluded.{total};'''.format(columns=columns, key=key, seen=seen, total=total))
+	else:
+		cur.execute('''insert or ignore into JUNCTION_REF ({columns}, gencode_annotation)
+			select {columns}, gencode_annotation
+			from SAMPLE_TOTALS
+			where old_read_count is null;'''.format(columns=columns))
+
+	if schema == 2:
+		cur.execute('''insert or ignore into GENE_NAMES (gene) select distinct gene from STAGED_JUNCTIONS;''')
+		cur.execute('''insert or ignore into JUNCTION_GENES (junction_id, gene_id) 
+			select s.junction_id, n.gene_id
+			from STAGED_JUNCTIONS s
+			inner join GENE_NAMES n on n.gene = s.gene;''')
+	else:
+		cur.execute('''insert or ignore into GENE_REF (gene, junction_id) 
+			select s.gene, r.ROWID
+			from STAGED_JUNCTIONS s
+			inner join JUNCTION_REF r on r.chromosome = s.chromosome and r.start = s.start and r.stop = s.stop;''')
+
+	# the genes with the largest read count are ranked again by normalized read count, see updateJunctionInformation()
+	cur.execute('''insert into JUNCTION_COUNTS (bam_id, junction_id, read_count, norm_read_count)
+		select ?, junction_id, read_count, norm_read_count from (
+			select junction_id, read_count, norm_read_count,
+			row_number() over (partition by junction_id order by read_count desc, norm_read_count desc) as norm_order
+			from (
+				select r.ROWID as junction_id, s.read_count as read_count,
+				case
+					when r.gencode_annotation = 0 then 'NULL'
+					when r.gencode_annotation = 1 then roundedRatio(s.read_count, s.start_max)
+					when r.gencode_annotation = 2 then roundedRatio(s.read_count, s.stop_max)
+					when s.start_max > s.stop_max then roundedRatio(s.read_count, s.start_max)
+					else roundedRatio(s.read_count, s.stop_max)
+				end as norm_read_count
+				from STAGED_JUNCTIONS s
+				inner join JUNCTION_REF r on {junction}))
+		where norm_order = 1
+		on conflict (junction_id, bam_id) do update set
+			read_count = excluded.read_count,
+			norm_read_count = excluded.norm_read_count
+			where excluded.read_count > read_count;'''.format(junction=junction), (bam_id, ))
+
+def bulkSummarizeSample(poolArguement):
+
+	"""
+	The function each worker process goes through in bulk mode (--bulk).
+
+	Each process is assigned a sample and reads its discovery output in one sequential sweep. Its junctions 
+	are loaded in to temporary tables and annotated by stageSampleJunctions() without holding any lock, then the 
+	sample is added to SAMPLE_REF and its junctions applied to the database by applySampleJunctions() in a single 
+	transaction, instead of around eight statements per junction. The database therefore holds either all of a 
+	sample's junctions or none of them, and a sample is only in SAMPLE_REF once its junctions are, so a run that 
+	fails can simply be started again: samples already stored are skipped and the rest are processed.
+
+	Args:
+		poolArgument, the name of the sample's bam file
+
+		The genes of the transcript_file, the flanking region for each transcript_model junction and
+		whether to update the population aggregates are set once per worker by initializeWorker()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	bam = poolArguement
+	conn, cur = connectToDB(profile='ingest')
+	conn.create_function('roundedRatio', 2, roundedRatio)
+
+	print ('processing ' + bam)
+
+	# the sample is not in SAMPLE_REF yet, so it has no read counts to compare against
+	stageSampleJunctions(cur, bam, None, sharedFlank)
+	conn.commit()
+
+	# take the write lock up front, so the transaction never has to upgrade from a read lock
+	cur.execute('''begin immediate;''')
+
+	try:
+		bam_id, bam_type = addSample(cur, bam)
+	except sqlite3.IntegrityError:
+		print (bam + ' was added to the database by another process, skipping it')
+		conn.rollback()
+		conn.close()
+		return
+
+	applySampleJunctions(cur, bam_id, bam_type, sharedAggregates)
+	commitAndClose(conn)
+
+	print ('finished ' + bam)
+
+def updateJunctionInformation(junction_id, bam_id, bam_type, gene, sample, new_read_count, new_norm_read_count, cur, aggregates=True):
+
+	"""
+	Adds a junction's position and its read counts to the database. Logic for total read counts has also been implemented.
+
+	In the case that a junction already exists for a sample, the larger read count and its corresponding normalized read count
+	is used. If the read counts are the same, E.x. the junction is in two overlapping genes, the larger normalized read count
+	is kept, so the result does not depend on the order the genes are stored in.
 
 	Args:
 		junction_id, the ROWID of a junction in JUNCTION_REF
@@ -503,96 +1698,259 @@ def updateJunctionInformation(junction_id, bam_id, bam_type, gene, sample, new_r
 		new_read_count, the reported read count from the text file
 		new_norm_read_count, the calculated normalized read count from the function normalizeReadCount()
 		cur, a cursor to a connection to the database
+		aggregates, False to skip updating the total read counts and n_*_seen of JUNCTION_REF, 
+		they are then recomputed once by rebuildAggregates()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	# check if sample already has the junction in the database
+	cur.execute('''select read_count, norm_read_count from JUNCTION_COUNTS where junction_id is ? and bam_id is ?;''', (junction_id, bam_id))
+	res = cur.fetchone()
+
+	# if it is, check if new_reads > old_reads, update JUNCTION_REF and JUNCTION_COUNTS for the appropriate sample
+	if res:
+		old_read_count, old_norm_read_count = res
+
+		# the same read count from another gene keeps the larger normalized read count, whichever gene was stored first
+		if int(new_read_count) == int(old_read_count) and largerNormReadCount(new_norm_read_count, old_norm_read_count):
+			cur.execute('''update JUNCTION_COUNTS set norm_read_count = ? where junction_id = ? and bam_id = ?;''', (new_norm_read_count, junction_id, bam_id))
+
+		elif int(new_read_count) > int(old_read_count):
+
+			# update entry to reflect new read count values, by its primary key as schema 2 JUNCTION_COUNTS has no ROWID
+			cur.execute('''update JUNCTION_COUNTS set read_count = ?, norm_read_count = ? where junction_id = ? and bam_id = ?;''', (new_read_count, new_norm_read_count, junction_id, bam_id))
+
+			if not aggregates:
+				return
+
+			# update total read counts
+			cur.execute('''update JUNCTION_REF set total_read_count = total_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
+
+			# update total patient or gtex read counts
+			if bam_type == 1:
+				cur.execute('''update JUNCTION_REF set total_patient_read_count = total_patient_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
+			elif bam_type == 0:
+				cur.execute('''update JUNCTION_REF set total_gtex_read_count = total_gtex_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
+
+	# if not, add it with read counts and normalized read counts, increment n_samples_seen, increment n_times_seen, increment JUNCTION_REF total times seen
+	else:
+		cur.execute('''insert into JUNCTION_COUNTS (bam_id, junction_id, read_count, norm_read_count) values (?, ?, ?, ?);''', (bam_id, junction_id, new_read_count, new_norm_read_count))
+
+		if not aggregates:
+			return
+
+		# 0 = gtex, 1 = patient
+		if bam_type == 1:
+			cur.execute('''update JUNCTION_REF set 
+				n_patients_seen = n_patients_seen + 1, 
+				total_read_count = total_read_count + ?, 
+				total_patient_read_count = total_patient_read_count + ? 
+				where ROWID = ?;''', (new_read_count, new_read_count, junction_id))
+		elif bam_type == 0:
+			cur.execute('''update JUNCTION_REF set 
+				n_gtex_seen = n_gtex_seen + 1, 
+				total_read_count = total_read_count + ?, 
+				total_gtex_read_count = total_gtex_read_count + ? 
+				where ROWID = ?;''', (new_read_count, new_read_count, junction_id))
+
+def largerNormReadCount(new_norm_read_count, old_norm_read_count):
+
+	"""
+	Compares two normalized read counts of a junction in a sample. 'NULL', for junctions without a 
+	transcript_model annotation, and 'null', where normalizing divided by zero, are never larger
+
+	Args:
+		new_norm_read_count, a normalized read count made by normalizeReadCount()
+		old_norm_read_count, the normalized read count stored in JUNCTION_COUNTS
+
+	Returns:
+	    True or False
+
+	Raises:
+	    None
+	"""
+
+	try:
+		return float(new_norm_read_count) > float(old_norm_read_count)
+	except (TypeError, ValueError):
+		return False
+
+def get_bam_id_and_type(cur, bam):
+
+	"""
+	Gets the ROWID and the experiment type of a sample in the database. 
+	This function works on the assumption that the sample already exists in the database.
+	Before running this function, parallel_process_gene_files will have already added bam file names to the database,
+	hence satisfying this assumption
+
+	Args:
+		cur, a cursor to a connection to the database
+		bam, the name of a bam file in the database
+
+	Returns:
+	    bam_id, the ROWID of a sample in SAMPLE_REF
+	    bam_type, 0 or 1, a number which indicates whether a sample is control or a patient
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''select ROWID, type from SAMPLE_REF where sample_name = ?;''', (bam, ))
+	bam_id, bam_type = cur.fetchone()
+
+	return bam_id, bam_type
+
+def initializeWorker(queue, bamList, gene_set, flank, aggregates=True, path=None):
+
+	"""
+	Sets up the state each worker process keeps for its lifetime. State shared by every task is sent
+	to each worker process once here instead of being pickled again for every task.
+
+	Args:
+		queue, the multiprocessing queue of the writer process running junctionWriter(), None if the worker writes to the database itself
+		bamList, a list of sample folder names
+		gene_set, a set of gene names from the transcript_file
+		flank, the allowed +/- range for gencode annotation
+		aggregates, False to leave the population aggregates of JUNCTION_REF for rebuildAggregates()
+		path, the database every connection of the worker opens, databasePath by default
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	global sharedBamList, sharedGeneSet, sharedFlank, sharedAggregates, writerQueue, databasePath
+
+	if path is not None:
+		databasePath = path
+
+	writerQueue = queue
+	sharedBamList = bamList
+	sharedGeneSet = gene_set
+	sharedFlank = flank
+	sharedAggregates = aggregates
+
+def addSample(cur, bam):
+
+	"""
+	Adds a sample to SAMPLE_REF. Samples with GTEX in their name are controls, the rest are patients
+
+	Args:
+		cur, a cursor to a connection to the database
+		bam, the name of a bam file
 
 	Returns:
-	    None
+	    bam_id, the ROWID of the sample in SAMPLE_REF
+	    bam_type, 0 or 1, a number which indicates whether a sample is control or a patient
 
 	Raises:
-	    None
+	    sqlite3.IntegrityError, if the sample is already in the database
 	"""
 
-	# check if sample already has the junction in the database
-	cur.execute('''select ROWID, read_count from JUNCTION_COUNTS where junction_id is ? and bam_id is ?;''', (junction_id, bam_id))
-	res = cur.fetchone()
+	bam_type = 0 if 'GTEX' in bam else 1
 
-	# if it is, check if new_reads > old_reads, update JUNCTION_REF and JUNCTION_COUNTS for the appropriate sample
-	if res:
-		sample_junction_id, old_read_count = res
+	cur.execute('''insert into SAMPLE_REF (sample_name, type) values (?, ?);''', (bam, bam_type))
 
-		if int(new_read_count) > int(old_read_count):
+	return cur.lastrowid, bam_type
 
-			# update entry to reflect new read count values
-			cur.execute('''update JUNCTION_COUNTS set read_count = ?, norm_read_count = ? where ROWID = ?;''', (new_read_count, new_norm_read_count, sample_junction_id))
+def pendingSamples(cur):
 
-			# update total read counts
-			cur.execute('''update JUNCTION_REF set total_read_count = total_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
+	"""
+	Finds the samples added to SAMPLE_REF by an --addBAM run without --bulk which has not finished, see
+	addSamplesToDatabase(). Their read counts are incomplete until they are deleted with --delete and added again.
 
-			# update total patient or gtex read counts
-			if bam_type == 1:
-				cur.execute('''update JUNCTION_REF set total_patient_read_count = total_patient_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
-			elif bam_type == 0:
-				cur.execute('''update JUNCTION_REF set total_gtex_read_count = total_gtex_read_count - ? + ? where ROWID = ?;''', (old_read_count, new_read_count, junction_id))
+	Args:
+		cur, a cursor to a connection to the database
 
-	# if not, add it with read counts and normalized read counts, increment n_samples_seen, increment n_times_seen, increment JUNCTION_REF total times seen
-	else:
-		cur.execute('''insert into JUNCTION_COUNTS (bam_id, junction_id, read_count, norm_read_count) values (?, ?, ?, ?);''', (bam_id, junction_id, new_read_count, new_norm_read_count))
+	Returns:
+	    a set of the names of the samples
 
-		# 0 = gtex, 1 = patient
-		if bam_type == 1:
-			cur.execute('''update JUNCTION_REF set 
-				n_patients_seen = n_patients_seen + 1, 
-				total_read_count = total_read_count + ?, 
-				total_patient_read_count = total_patient_read_count + ? 
-				where ROWID = ?;''', (new_read_count, new_read_count, junction_id))
-		elif bam_type == 0:
-			cur.execute('''update JUNCTION_REF set 
-				n_gtex_seen = n_gtex_seen + 1, 
-				total_read_count = total_read_count + ?, 
-				total_gtex_read_count = total_gtex_read_count + ? 
-				where ROWID = ?;''', (new_read_count, new_read_count, junction_id))
+	Raises:
+	    None
+	"""
 
-def get_bam_id_and_type(cur, bam):
+	cur.execute('''select 1 from sqlite_master where type = 'table' and name = 'PENDING_SAMPLES';''')
+
+	if not cur.fetchone():
+		return set()
+
+	cur.execute('''select s.sample_name from PENDING_SAMPLES p inner join SAMPLE_REF s on s.ROWID = p.bam_id;''')
+
+	return set(row[0] for row in cur.fetchall())
+
+def refuseIncompleteSamples(incomplete):
 
 	"""
-	Gets the ROWID and the experiment type of a sample in the database. 
-	This function works on the assumption that the sample already exists in the database.
-	Before running this function, parallel_process_gene_files will have already added bam file names to the database,
-	hence satisfying this assumption
+	Exits if any of the samples in the bam list were left incomplete by an --addBAM run without --bulk which
+	failed. Those samples are in SAMPLE_REF, so they would otherwise be skipped as if they were stored.
 
 	Args:
-		cur, a cursor to a connection to the database
-		bam, the name of a bam file in the database
+		incomplete, a list of the names of incomplete samples in the bam list
 
 	Returns:
-	    bam_id, the ROWID of a sample in SAMPLE_REF
-	    bam_type, 0 or 1, a number which indicates whether a sample is control or a patient
+	    None, exits if the list is not empty
 
 	Raises:
 	    None
 	"""
 
-	cur.execute('''select ROWID, type from SAMPLE_REF where sample_name = ?;''', (bam, ))
-	bam_id, bam_type = cur.fetchone()
+	if not incomplete:
+		return
 
-	return bam_id, bam_type
+	for bam in incomplete:
+		print ("Sample %s was only partly stored by an --addBAM run which did not finish" % bam)
+
+	print ("Remove them with --delete -sample %s and run --addBAM again. Exiting." % ' '.join(incomplete))
+	exit(1)
 
-def makeLockGlobal(poolLock):
+def samplesNotInDatabase(bam_files):
 
 	"""
-	Makes a lock global for worker processes to use
+	Finds the bam files in the text file bamList which are not in SAMPLE_REF yet, without adding them.
+	Used by bulk mode, which adds each sample in the same transaction as its junctions. Exits if one of the
+	bam files was left incomplete by a failed run without --bulk, see refuseIncompleteSamples().
 
 	Args:
-		poolLock, a multiprocessing lock to be used by worker processes
+		bam_files, path to a file containing the names of bams to be processed in the database each on
+		a seperate line
 
 	Returns:
-	    None
+	    bamList, a list of bam files which are not in the database, in the order of the file
 
 	Raises:
 	    None
 	"""
 
-	global lock
-	lock = poolLock
+	conn, cur = connectToDB(profile='query')
+	cur.execute('''select sample_name from SAMPLE_REF;''')
+	stored = set(row[0] for row in cur.fetchall())
+	pending = pendingSamples(cur)
+	conn.close()
+
+	bamList = []
+	incomplete = []
+
+	with open(bam_files, "r") as bf:
+		for line in bf:
+
+			bam = line.strip()
+
+			if bam in pending and bam not in incomplete:
+				incomplete.append(bam)
+			elif bam and bam not in stored:
+				stored.add(bam)
+				bamList.append(bam)
+
+	refuseIncompleteSamples(incomplete)
+
+	return bamList
 
 def addSamplesToDatabase(bam_files):
 
@@ -603,6 +1961,10 @@ def addSamplesToDatabase(bam_files):
 	are assumed to already exist in the database and thus their junction information should not be
 	processed again. Hence they are not added to bamList.
 
+	The junctions of the added samples are stored over many transactions by the writer process, so the added
+	samples are also listed in PENDING_SAMPLES until the whole run has finished, see clearPendingSamples().
+	If a run fails they stay listed, and a rerun exits instead of skipping them, see refuseIncompleteSamples().
+
 	Args:
 		bam_files, path to a file containing the names of bams to be processed in the database each on
 		a seperate line
@@ -617,7 +1979,10 @@ def addSamplesToDatabase(bam_files):
 	"""
 
 	conn, cur = connectToDB()
+	pending = pendingSamples(cur)
+	cur.execute('''create table if not exists PENDING_SAMPLES (bam_id integer primary key);''')
 	bamList = []
+	incomplete = []
 
 	with open(bam_files, "r") as bf:
 		for line in bf:
@@ -625,19 +1990,43 @@ def addSamplesToDatabase(bam_files):
 			bam = line.strip()
 
 			try: # insert sample names into SAMPLE_REF
-				if 'GTEX' in bam:
-					cur.execute('''insert into SAMPLE_REF (sample_name, type) values (?, 0);''', (bam, ))
-				else: # sample is a patient
-					cur.execute('''insert into SAMPLE_REF (sample_name, type) values (?, 1);''', (bam, ))
+				bam_id, bam_type = addSample(cur, bam)
 			except sqlite3.IntegrityError as e:
+				if bam in pending and bam not in incomplete:
+					incomplete.append(bam)
 				continue # if sample already in DB, don't process it
 
+			cur.execute('''insert into PENDING_SAMPLES (bam_id) values (?);''', (bam_id, ))
 			bamList.append(bam) # if the script has passed over the continue statement, then the sample was succesfully added. Append to bamList.
 
+	if incomplete:
+		conn.rollback()
+		conn.close()
+		refuseIncompleteSamples(incomplete)
+
 	commitAndClose(conn)
 
 	return bamList
 
+def clearPendingSamples(bamList):
+
+	"""
+	Removes the samples of a finished --addBAM run from PENDING_SAMPLES, once all of their junctions are stored
+
+	Args:
+		bamList, the list of bam files returned by addSamplesToDatabase()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	conn, cur = connectToDB(profile='ingest')
+	cur.executemany('''delete from PENDING_SAMPLES where bam_id = (select ROWID from SAMPLE_REF where sample_name = ?);''', ((bam, ) for bam in bamList))
+	commitAndClose(conn)
+
 def gene_file_names(transcript_file):
 
 	"""
@@ -665,21 +2054,62 @@ def gene_file_names(transcript_file):
 
 	return gene_set
 
-def parallel_process_gene_files(num_processes, bam_files, transcript_file, flank):
+def gene_region_lengths(transcript_file):
+
+	"""
+	Sums the length of each gene's regions in a transcript_file. Used to estimate how long
+	each gene takes to process.
+
+	Args:
+		transcript_file, the same transcript_file used for SpliceJunctionDiscovery.py
+
+	Returns:
+	    a dictionary of gene names and region lengths
+
+	Raises:
+	    None
+	"""
+
+	lengths = {}
+
+	with open(transcript_file, "r") as gf:
+		for line in gf:
+			elems = line.strip().split()
+
+			try:
+				lengths[elems[0]] = lengths.get(elems[0], 0) + int(elems[5]) - int(elems[4])
+			except (IndexError, ValueError):
+				lengths.setdefault(elems[0], 0)
+
+	return lengths
+
+def parallel_process_gene_files(num_processes, bam_files, transcript_file, flank, bulk=False, defer_aggregates=False):
 
 	"""
 	Initializes all parameters needed for worker processes and then runs them.
 
+	Samples with a single junction file (SpliceJunctionDiscovery.py -output=sample) are processed one
+	sample per worker. The remaining samples are processed one gene per worker from their gene text files.
+	Tasks are handed out largest first: samples by file size and genes by region length.
+
+	Worker processes only read, annotate and normalize junctions. They send them over a bounded queue to a 
+	single writer process running junctionWriter(), which holds the only connection that writes to the database.
+	The writer commits as it goes, so only a bulk run can be resumed by running it again. Samples left incomplete
+	by a failed run without bulk are refused until they are removed with --delete, see addSamplesToDatabase().
+
 	Parameters include: 
 		bamList, a list of sample folder names
 		gene_set, a list of gene text files
-		poolLock, a global lock for worker processes
+		writerQueue, the queue worker processes send junctions to the writer process with
 
 	Args:
 		num_processes, the number of worker processes to run at a given time. A larger number means more ram use.
 		bam_files, path to a file containing the names of all bam files to be processes
 		gene_list, path to a file containing a list of gene names in its first column
 		flank, the allowed +/- range for gencode annotation  
+		bulk, True to store each sample with set-based statements in a single transaction, see bulkSummarizeSample()
+		defer_aggregates, True to skip the per junction updates of the population aggregates in JUNCTION_REF
+		and recompute them once with rebuildAggregates() after every sample is stored
 
 	Returns:
 	    None
@@ -689,21 +2119,73 @@ def parallel_process_gene_files(num_processes, bam_files, transcript_file, flank
 	"""
 
 	flank = int(flank)
-	poolArguements = []
 	gene_set = gene_file_names(transcript_file)
+
+	if bulk:
+		bamList = samplesNotInDatabase(bam_files)
+
+		print ("Creating a pool with " + str(num_processes) + " processes")
+		pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(None, bamList, gene_set, flank, not defer_aggregates, databasePath), processes=int(num_processes))
+		print ('pool: ' + str(pool))
+
+		costs = [os.path.getsize(sampleJunctionFile(bam)) if sampleJunctionFile(bam) else (os.path.getsize(bam) if os.path.isfile(bam) else 0) for bam in bamList]
+
+		for finished in runLargestFirst(pool, bulkSummarizeSample, bamList, costs):
+			pass
+
+		pool.close()
+		pool.join()
+
+		if defer_aggregates:
+			conn, cur = connectToDB(profile='ingest')
+			cur.execute('''begin immediate;''')
+			rebuildAggregates(cur)
+			commitAndClose(conn)
+
+		return
+
 	bamList = addSamplesToDatabase(bam_files)
-	poolLock = multiprocessing.Lock()
+	sampleFileBams = [bam for bam in bamList if sampleJunctionFile(bam)]
+	geneFileBams = [bam for bam in bamList if bam not in sampleFileBams]
 
-	for gene in gene_set:
-		poolArguements.append((bamList, gene, flank))
+	# a few batches per worker are enough to keep the writer busy and bound the memory used by the queue
+	writerQueue = multiprocessing.Queue(maxsize=4 * int(num_processes))
+	writer = multiprocessing.Process(target=junctionWriter, args=(writerQueue, flank, not defer_aggregates, databasePath))
+	writer.start()
 
 	print ("Creating a pool with " + str(num_processes) + " processes")
-	pool = multiprocessing.Pool(initializer=makeLockGlobal, initargs=(poolLock, ), processes=int(num_processes))
+	pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(writerQueue, geneFileBams, gene_set, flank, True, databasePath), processes=int(num_processes))
 	print ('pool: ' + str(pool))
 
-	pool.map(summarizeGeneFile, poolArguements)
-	pool.close()
-	pool.join()
+	try:
+		for finished in runLargestFirst(pool, summarizeSampleFile, sampleFileBams, [os.path.getsize(sampleJunctionFile(bam)) for bam in sampleFileBams]):
+			pass
+
+		if geneFileBams:
+			genes = list(gene_set)
+			lengths = gene_region_lengths(transcript_file)
+
+			for finished in runLargestFirst(pool, summarizeGeneFile, genes, [lengths[gene] for gene in genes]):
+				pass
+
+		pool.close()
+		pool.join()
+	finally:
+		# tell the writer every junction has been sent, even if a worker failed, so it does not wait forever
+		writerQueue.put(None)
+		writer.join()
+
+	if writer.exitcode != 0:
+		print ("The writer process exited with " + str(writer.exitcode) + ", the junctions of this run were not all stored")
+		exit(1)
+
+	if defer_aggregates:
+		conn, cur = connectToDB(profile='ingest')
+		cur.execute('''begin immediate;''')
+		rebuildAggregates(cur)
+		commitAndClose(conn)
+
+	clearPendingSamples(bamList)
 
 def annotateJunctionWithGene(gene, junction_id, cur):
 	
@@ -724,33 +2206,66 @@ def annotateJunctionWithGene(gene, junction_id, cur):
 
 	cur.execute('''insert or ignore into GENE_REF (gene, junction_id) values (?, ?);''', (gene, junction_id))
 
-def addTranscriptModelJunction(chrom, start, stop, cur):
+def readTranscriptModelFile(gencode_file):
 
 	"""
-	Adds a single junction from the transcript_model to the database's reference table, TRANSCRIPT_MODEL_JUNCTIONS
+	Reads the junctions of a transcript_model text file one line at a time
+
+	The format of the file is as follows:
+
+	chromosome	start	stop	gene
 
 	Args:
-		chrom, the chromosome a junction lies on
-		start, the 5' splice site of a junction
-		stop, the 3' splice site of a junction
-		cur, a cursor to a connection to the database
+		gencode_file, a transcript_model containing known canonical junctions and their positions
 
 	Returns:
+	    a generator of (chrom, start, stop) tuples
+
+	Raises:
 	    None
+	"""
+
+	with open(gencode_file, "r") as gf:
+		for line in gf:
+
+			fields = line.split()
+
+			if fields:
+				yield fields[0], int(fields[1]), int(fields[2])
+
+def isSQLiteDatabase(path):
+
+	"""
+	Checks whether a file is an SQLite database, E.x. a prebuilt transcript_model made by --buildTranscriptModel,
+	rather than a text file
+
+	Args:
+		path, the path to a file
+
+	Returns:
+	    True or False
 
 	Raises:
 	    None
 	"""
 
-	cur.execute('''insert or ignore into TRANSCRIPT_MODEL_JUNCTIONS (chromosome, start, stop) values (?, ?, ?);''', (chrom, start, stop))
+	with open(path, "rb") as f:
+		return f.read(16) == b"SQLite format 3\x00"
 
-def storeTranscriptModelJunctions(gencode_file):
+def storeTranscriptModelJunctions(gencode_file, path=None):
 
 	"""
 	Adds junctions from a transcript_model to the database as a reference for annotation
 
+	The junctions are loaded in a single transaction with executemany(), or with a single insert from a 
+	prebuilt transcript_model database made by --buildTranscriptModel, which is attached instead of parsing
+	the text file again. The stopJunction index is dropped during the load and built once afterwards. The
+	index transcriptModelIndex() kept, which no longer matches the database, is forgotten.
+
 	Args:
-		gencode_file, a transcript_model containing known canonical junctions and their positions
+		gencode_file, a transcript_model containing known canonical junctions and their positions, 
+		either a text file or a prebuilt transcript_model database
+		path, the database to add them to, databasePath by default
 
 	Returns:
 	    None
@@ -759,34 +2274,279 @@ def storeTranscriptModelJunctions(gencode_file):
 	    None
 	"""
 
-	conn, cur = connectToDB()
+	global transcriptModel, transcriptModelPath
+
+	conn, cur = connectToDB(path, 'ingest')
 
 	print ('Started adding transcript_model junctions @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
 
-	with open(gencode_file, "r") as gf:
-		for line in gf:
+	prebuilt = isSQLiteDatabase(gencode_file)
 
-			chrom, start, stop, gene = line.strip().split()[0:4]
+	# databases can only be attached outside of a transaction
+	if prebuilt:
+		cur.execute('''attach database ? as MODEL;''', (gencode_file, ))
 
-			start = int(start)
-			stop = int(stop)
+	cur.execute('''begin immediate;''')
+	cur.execute('''drop index if exists stopJunction;''')
 
-			addTranscriptModelJunction(chrom, start, stop, cur)
+	if prebuilt:
+		cur.execute('''insert or ignore into TRANSCRIPT_MODEL_JUNCTIONS (chromosome, start, stop) 
+			select chromosome, start, stop from MODEL.TRANSCRIPT_MODEL_JUNCTIONS 
+			order by chromosome, start, stop;''')
+	else:
+		cur.executemany('''insert or ignore into TRANSCRIPT_MODEL_JUNCTIONS (chromosome, start, stop) values (?, ?, ?);''', readTranscriptModelFile(gencode_file))
 
-	commitAndClose(conn)
+	cur.execute('''create index stopJunction on TRANSCRIPT_MODEL_JUNCTIONS (chromosome, stop);''')
+	conn.commit()
+
+	transcriptModel = None
+	transcriptModelPath = None
+
+	if prebuilt:
+		cur.execute('''detach database MODEL;''')
+
+	cur.execute('''select count(*) from TRANSCRIPT_MODEL_JUNCTIONS;''')
+	print ('The database holds %d transcript_model junctions' % cur.fetchone()[0])
+
+	conn.close()
 
 	print ('Finished adding gencode annotations @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
 
-def deleteSample(sample):
+def buildTranscriptModelDatabase(gencode_file, model_db):
+
+	"""
+	Writes a prebuilt transcript_model database: an empty splice junction database with only the 
+	transcript_model loaded. New projects can pass it to --addGencode as the -transcript_model, which attaches it
+	instead of parsing the text file, or copy it in as their SpliceJunction.db and skip --addGencode.
+
+	It is left in rollback journal mode, so it is a single file which can be attached from a read-only location.
+	initializeDB() turns WAL mode back on when it is used as a SpliceJunction.db.
+
+	Args:
+		gencode_file, a transcript_model text file
+		model_db, the path of the database to write
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	initializeDB(model_db)
+	storeTranscriptModelJunctions(gencode_file, model_db)
+
+	conn, cur = connectToDB(model_db)
+	cur.execute('''PRAGMA journal_mode = DELETE;''')
+	conn.close()
+
+	print ('Wrote the prebuilt transcript_model database ' + model_db)
+
+def rebuildAggregates(cur):
+
+	"""
+	Recomputes the population aggregates of JUNCTION_REF (n_patients_seen, n_gtex_seen and the three total
+	read counts) from JUNCTION_COUNTS with a single group by, and rewrites the junctions whose stored aggregates
+	do not match. Used after an ingest or delete run with --deferAggregates, and by --rebuildAggregates to
+	check and repair totals that drifted, E.x. after a crash.
+
+	Args:
+		cur, a cursor to a connection to the database. The caller commits
+
+	Returns:
+	    the number of junctions whose aggregates were rewritten
+
+	Raises:
+	    None
+	"""
+
+	for table in ('AGGREGATES', 'DRIFTED'):
+		cur.execute('''create temp table {table} (
+			junction_id integer primary key,
+			n_patients_seen integer,
+			n_gtex_seen integer,
+			total_patient_read_count integer,
+			total_gtex_read_count integer,
+			total_read_count integer);'''.format(table=table))
+
+	# 0 = gtex, 1 = patient
+	cur.execute('''insert into AGGREGATES
+		select c.junction_id,
+		sum(s.type = 1),
+		sum(s.type = 0),
+		sum(case when s.type = 1 then c.read_count else 0 end),
+		sum(case when s.type = 0 then c.read_count else 0 end),
+		sum(c.read_count)
+		from JUNCTION_COUNTS c
+		inner join SAMPLE_REF s on s.ROWID = c.bam_id
+		group by c.junction_id;''')
+
+	# junctions without any read counts left, E.x. after a sample was deleted, go back to 0
+	cur.execute('''insert into DRIFTED
+		select r.ROWID,
+		ifnull(a.n_patients_seen, 0),
+		ifnull(a.n_gtex_seen, 0),
+		ifnull(a.total_patient_read_count, 0),
+		ifnull(a.total_gtex_read_count, 0),
+		ifnull(a.total_read_count, 0)
+		from JUNCTION_REF r
+		left join AGGREGATES a on a.junction_id = r.ROWID
+		where r.n_patients_seen is not ifnull(a.n_patients_seen, 0)
+		or r.n_gtex_seen is not ifnull(a.n_gtex_seen, 0)
+		or r.total_patient_read_count is not ifnull(a.total_patient_read_count, 0)
+		or r.total_gtex_read_count is not ifnull(a.total_gtex_read_count, 0)
+		or r.total_read_count is not ifnull(a.total_read_count, 0);''')
+	# row values need SQLite 3.15.0 or higher
+	cur.execute('''update JUNCTION_REF set 
+		(n_patients_seen, n_gtex_seen, total_patient_read_count, total_gtex_read_count, total_read_count) = 
+		(select n_patients_seen, n_gtex_seen, total_patient_read_count, total_gtex_read_count, total_read_count
+		from DRIFTED where junction_id = JUNCTION_REF.ROWID)
+		where ROWID in (select junction_id from DRIFTED);''')
+	drifted = cur.rowcount
+
+	cur.execute('''drop table temp.AGGREGATES;''')
+	cur.execute('''drop table temp.DRIFTED;''')
+
+	print ("Rebuilt the population aggregates of %d junctions in JUNCTION_REF" % drifted)
+
+	return drifted
+
+def subtractAggregates(cur):
+
+	"""
+	Takes the read counts of the samples in the temporary table DELETED_SAMPLES off the population aggregates
+	of JUNCTION_REF. The read counts are summed per junction with a single group by and every junction the samples
+	were seen in is updated with a single statement, instead of one update per junction per sample.
+
+	Args:
+		cur, a cursor to a connection to the database, inside a transaction
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	# 0 = gtex, 1 = patient
+	cur.execute('''create temp table REMOVED_COUNTS (
+		junction_id integer primary key,
+		n_patients_seen unsigned big int,
+		n_gtex_seen unsigned big int,
+		total_patient_read_count big int,
+		total_gtex_read_count big int,
+		total_read_count big int);''')
+	cur.execute('''insert into REMOVED_COUNTS select c.junction_id,
+		sum(s.type = 1),
+		sum(s.type = 0),
+		sum(case when s.type = 1 then c.read_count else 0 end),
+		sum(case when s.type = 0 then c.read_count else 0 end),
+		sum(case when s.type in (0, 1) then c.read_count else 0 end)
+		from JUNCTION_COUNTS c
+		inner join DELETED_SAMPLES s on s.bam_id = c.bam_id
+		group by c.junction_id;''')
+
+	cur.execute('''update JUNCTION_REF set 
+		(n_patients_seen, n_gtex_seen, total_patient_read_count, total_gtex_read_count, total_read_count) = 
+		(select JUNCTION_REF.n_patients_seen - d.n_patients_seen, 
+			JUNCTION_REF.n_gtex_seen - d.n_gtex_seen,
+			JUNCTION_REF.total_patient_read_count - d.total_patient_read_count,
+			JUNCTION_REF.total_gtex_read_count - d.total_gtex_read_count,
+			JUNCTION_REF.total_read_count - d.total_read_count
+			from REMOVED_COUNTS d where d.junction_id = JUNCTION_REF.ROWID)
+		where ROWID in (select junction_id from REMOVED_COUNTS);''')
+
+	cur.execute('''drop table temp.REMOVED_COUNTS;''')
+
+def removeOrphanJunctions(cur):
+
+	"""
+	Removes the junctions no sample has a read count for any more, and their GENE_REF rows. Deleting a sample
+	leaves its junctions in JUNCTION_REF with a read count of 0, this garbage collects them. In a schema 2 database
+	gene names no junction maps to any more are removed from GENE_NAMES as well.
+
+	Args:
+		cur, a cursor to a connection to the database, inside a transaction
+
+	Returns:
+	    the number of junctions removed
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''create temp table ORPHANS (junction_id integer primary key);''')
+	cur.execute('''insert into ORPHANS (junction_id) 
+		select r.ROWID from JUNCTION_REF r 
+		where not exists (select 1 from JUNCTION_COUNTS c where c.junction_id = r.ROWID);''')
+	orphans = cur.rowcount
+
+	# the GENE_REF view of schema 2 would delete one row at a time through its trigger
+	if schemaVersion(cur) == 2:
+		cur.execute('''delete from JUNCTION_GENES where junction_id in (select junction_id from ORPHANS);''')
+		cur.execute('''delete from GENE_NAMES where gene_id not in (select gene_id from JUNCTION_GENES);''')
+	else:
+		cur.execute('''delete from GENE_REF where junction_id in (select junction_id from ORPHANS);''')
+
+	cur.execute('''delete from JUNCTION_REF where ROWID in (select junction_id from ORPHANS);''')
+	cur.execute('''drop table temp.ORPHANS;''')
+
+	print ("Removed %d junctions no sample has a read count for from JUNCTION_REF" % orphans)
+
+	return orphans
+
+def compactDatabase(path=None):
+
+	"""
+	Returns the space left by removed rows to the file system with VACUUM and refreshes the query planner's
+	statistics with ANALYZE. Run outside of a transaction, VACUUM needs a moment when no other connection is writing.
+
+	VACUUM is only run on schema 2 databases: it may renumber the ROWIDs of tables without an INTEGER PRIMARY KEY, 
+	which schema 1 uses as the bam_id and junction_id. Schema 1 databases are analyzed and their free pages 
+	are reused by the samples added next, MigrateDatabase.py writes a compacted schema 2 copy.
+
+	Args:
+		path, the database to compact, databasePath by default
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	if path is None:
+		path = databasePath
+
+	conn, cur = connectToDB(path, 'ingest')
+	before = os.path.getsize(path)
+
+	if schemaVersion(cur) == 2:
+		cur.execute('''vacuum;''')
+		cur.execute('''PRAGMA wal_checkpoint(TRUNCATE);''')
+	else:
+		print ("Schema 1 databases are not vacuumed as it may renumber their ROWIDs, use MigrateDatabase.py to write a compacted copy")
+
+	cur.execute('''analyze;''')
+	conn.close()
+
+	print ("%s went from %.1f MB to %.1f MB" % (path, before / 1e6, os.path.getsize(path) / 1e6))
+
+def deleteSamples(samples, defer_aggregates=False, compact=False):
 
 	"""
-	Removes a sample and its read count information from the database.
+	Removes samples and their read count information from the database in a single transaction. If any of the
+	samples is not in the database nothing is removed.
 
-	Does not remove records from JUNCTION_REF and so a juntion in JUNCTION_REF can have a read count of 0.
+	The population aggregates of JUNCTION_REF are updated for all of the samples at once by subtractAggregates().
+	Junctions left with no read counts stay in JUNCTION_REF with a read count of 0 unless compact is True.
 
 	Args:
-		cur, a cursor to a connection to a database
-		sample, the name of the sample file you want to remove, must include .bam extension
+		samples, a list of the names of the sample files you want to remove, must include .bam extension
+		defer_aggregates, True to recompute the population aggregates in JUNCTION_REF with rebuildAggregates() in 
+		the same transaction once the samples are removed, instead of subtracting the samples' read counts
+		compact, True to also remove the junctions no sample has a read count for with removeOrphanJunctions() and
+		then run compactDatabase()
 	
 	Returns:
 	    None
@@ -795,42 +2555,56 @@ def deleteSample(sample):
 	    None
 	"""
 
-	conn, cur = connectToDB()
+	conn, cur = connectToDB(profile='ingest')
 
-	cur.execute('select ROWID, type from sample_ref where sample_name = ?;', (sample, ))
-	res = cur.fetchone()
+	# take the write lock up front, so the transaction never has to upgrade from a read lock
+	cur.execute('''begin immediate;''')
+	cur.execute('''create temp table DELETED_SAMPLES (
+		bam_id integer primary key,
+		type tinyint not null);''')
+
+	missing = []
 
-	if not res:
-		print ("Sample %s does not exist in the database!" % sample)
+	for sample in samples:
+		cur.execute('''insert or ignore into DELETED_SAMPLES (bam_id, type) select ROWID, type from SAMPLE_REF where sample_name = ?;''', (sample, ))
+
+		if not cur.rowcount:
+			cur.execute('''select 1 from SAMPLE_REF where sample_name = ?;''', (sample, ))
+
+			if not cur.fetchone():
+				missing.append(sample)
+
+	if missing:
+		for sample in missing:
+			print ("Sample %s does not exist in the database!" % sample)
+
+		print ("No samples were deleted")
+		conn.rollback()
+		conn.close()
 		exit(1)
-	else:
-		bam_id, bam_type = res
 
-	cur.execute('select junction_id, read_count from JUNCTION_COUNTS where bam_id = ?;', (bam_id, ))
+	if not defer_aggregates:
+		subtractAggregates(cur)
 
-	for junction_id, read_count in cur.fetchall():
+	cur.execute('''delete from JUNCTION_COUNTS where bam_id in (select bam_id from DELETED_SAMPLES);''')
+	cur.execute('''delete from SAMPLE_REF where ROWID in (select bam_id from DELETED_SAMPLES);''')
+	cur.execute('''create table if not exists PENDING_SAMPLES (bam_id integer primary key);''')
+	cur.execute('''delete from PENDING_SAMPLES where bam_id in (select bam_id from DELETED_SAMPLES);''')
+	cur.execute('''drop table temp.DELETED_SAMPLES;''')
 
-		if bam_type == 0:
-			cur.execute('''update JUNCTION_REF set 
-				n_gtex_seen = n_gtex_seen - 1,
-				total_read_count = total_read_count - ?,
-				total_gtex_read_count = total_gtex_read_count - ?
-				where ROWID = ?;''', (read_count, read_count, junction_id))
-		elif bam_type == 1:
-			cur.execute('''update JUNCTION_REF set 
-				n_patients_seen = n_patients_seen - 1,
-				total_read_count = total_read_count - ?,
-				total_patient_read_count = total_patient_read_count - ?
-				where ROWID = ?;''', (read_count, read_count, junction_id))
-		else:
-			raise Exception ('FATAL ERROR - bam_id is not 0 or 1')
+	if defer_aggregates:
+		rebuildAggregates(cur)
 
-	cur.execute('''delete from JUNCTION_COUNTS where bam_id = ?;''', (bam_id, ))
-	cur.execute('''delete from SAMPLE_REF where sample_name = ?;''', (sample, ))
+	if compact:
+		removeOrphanJunctions(cur)
 
 	commitAndClose(conn)
 
-	print ("Successfully deleted %s from database!" % sample)
+	for sample in samples:
+		print ("Successfully deleted %s from database!" % sample)
+
+	if compact:
+		compactDatabase()
 
 if __name__=="__main__":
 
@@ -842,34 +2616,68 @@ if __name__=="__main__":
 	parser.add_argument('-processes',help='Number of worker processes to parse gene files, default=10.',default=10)
 	parser.add_argument('-bamlist',help='A text file containing the names of bam files you want to discover splice junctions in each on a seperate line, default=bamlist.list',default='bamlist.list')
 	parser.add_argument('-flank',help='Add a +/- flanking region for gencode annotation. Specify 0 if you don\'t want to use this feature, default=1',default=1)
-	parser.add_argument('-sample',help='to be used with --delete, the name of the sample you want to remove from the database')
-	# parser.add_argument('-db',help='The name of the database you are storing junction information in, default=SpliceJunction.db',default='SpliceJunction.db')
+	parser.add_argument('--bulk',help='to be used with --addBAM, load each sample in to a staging table and store it with a few set-based statements in a single transaction. Much faster for large cohorts, requires SQLite 3.25.0 or higher',action='store_true')
+	parser.add_argument('--deferAggregates','--defer-aggregates',help='to be used with --addBAM or --delete, skip updating the total read counts and n_*_seen of every junction as samples are stored or removed and recompute them once at the end',action='store_true')
+	parser.add_argument('-sample',help='to be used with --delete, the names of the samples you want to remove from the database',nargs='+',default=[])
+	parser.add_argument('-samplelist',help='to be used with --delete, a text file containing the names of samples you want to remove from the database each on a seperate line')
+	parser.add_argument('--compact',help='to be used with --delete, also remove the junctions no sample has a read count for any more, then VACUUM (schema 2 only) and ANALYZE the database',action='store_true')
+	parser.add_argument('-model_db',help='to be used with --buildTranscriptModel, the prebuilt transcript_model database to write, default=transcript_model.db',default='transcript_model.db')
+	parser.add_argument('-schema',help='The schema of a new database, 2 stores junctions with compact integer keys for thousands of samples and needs SQLite 3.31.0 or higher. An existing database keeps its schema, default=1',type=int,choices=[1, 2],default=None)
+	parser.add_argument('-db',help='The name of the database you are storing junction information in, default=SpliceJunction.db',default='SpliceJunction.db')
 
 	mode_arguments = parser.add_mutually_exclusive_group(required=True)
-	mode_arguments.add_argument('--addGencode',action='store_true',help='Populate the database with gencode junctions, this step needs to be done once before anything else')
-	mode_arguments.add_argument('--addBAM',action='store_true',help='Add junction information from bamfiles found in the file bamlist.list')
+	mode_arguments.add_argument('--addGencode',action='store_true',help='Populate the database with gencode junctions, this step needs to be done once before anything else. -transcript_model can also be a database made by --buildTranscriptModel')
+	mode_arguments.add_argument('--buildTranscriptModel',action='store_true',help='Write the -transcript_model to a prebuilt database at -model_db, which --addGencode can load or new projects can copy in as their SpliceJunction.db')
+	mode_arguments.add_argument('--addBAM',action='store_true',help='Add junction information from bamfiles found in the file bamlist.list. Only a run with --bulk can be resumed by running it again, samples left incomplete by a failed run without it have to be removed with --delete first')
 	mode_arguments.add_argument('--delete',action='store_true',help='Delete a sample and its read counts from the database')
+	mode_arguments.add_argument('--rebuildAggregates','--rebuild-aggregates',action='store_true',help='Recompute the total read counts and n_*_seen of every junction from the read counts of each sample, fixing any that do not match')
 	args=parser.parse_args()
 
 	print ('Working in directory ' + str(os.getcwd()))
 
-	# databasePath = args.db
+	databasePath = args.db
+
+	if (args.deferAggregates or args.rebuildAggregates or args.delete) and sqlite3.sqlite_version_info < (3, 15, 0):
+		print ('Rebuilding or subtracting the aggregates needs SQLite 3.15.0 or higher for row values, this sqlite3 library uses ' + sqlite3.sqlite_version + '. Exiting.')
+		exit(1)
+
+	if args.schema == 2 and sqlite3.sqlite_version_info < (3, 31, 0):
+		print ('Schema 2 needs SQLite 3.31.0 or higher for generated columns, this sqlite3 library uses ' + sqlite3.sqlite_version + '. Exiting.')
+		exit(1)
 
-	initializeDB()
+	# --buildTranscriptModel writes its own database instead of SpliceJunction.db
+	if not args.buildTranscriptModel:
+		initializeDB(schema=args.schema)
 
-	if args.addGencode:
+	if args.buildTranscriptModel:
+		print ('Building a transcript model database from the file ' + args.transcript_model)
+		buildTranscriptModelDatabase(args.transcript_model, args.model_db)
+	elif args.addGencode:
 		print ('Storing junctions from the transcript model file ' + args.transcript_model)
 		storeTranscriptModelJunctions(args.transcript_model)
 	elif args.addBAM:
 		print ('Storing junctions from bam files found in the file ' + args.bamlist)
-		parallel_process_gene_files(args.processes, args.bamlist, args.transcript_file, args.flank)
+		if args.bulk and sqlite3.sqlite_version_info < (3, 25, 0):
+			print ('--bulk needs SQLite 3.25.0 or higher for upserts and window functions, this sqlite3 library uses ' + sqlite3.sqlite_version + '. Exiting.')
+			exit(1)
+
+		parallel_process_gene_files(args.processes, args.bamlist, args.transcript_file, args.flank, args.bulk, args.deferAggregates)
 	elif args.delete:
-		sample = args.sample
+		samples = list(args.sample)
+
+		if args.samplelist:
+			with open(args.samplelist) as sl:
+				samples += [line.strip() for line in sl if line.strip()]
 
-		if not sample:
-			print('Please enter a sample name with its .bam extension using the parameter \'-sample SAMPLE_NAME\'')
+		if not samples:
+			print('Please enter sample names with their .bam extension using the parameter \'-sample SAMPLE_NAME [SAMPLE_NAME ...]\' or \'-samplelist FILE\'')
 			exit(1)
 
-		deleteSample(sample)
+		deleteSamples(samples, args.deferAggregates, args.compact)
+	elif args.rebuildAggregates:
+		conn, cur = connectToDB(profile='ingest')
+		cur.execute('''begin immediate;''')
+		rebuildAggregates(cur)
+		commitAndClose(conn)
 
 	print ('AddJunctionsToDatabase.py finished on ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
@@ -0,0 +1,229 @@
+import os
+import zlib
+import sqlite3
+import hashlib
+
+def openDiscoveryCache(path, create=True):
+
+	"""
+	Opens (and creates if needed) the result cache of SpliceJunctionDiscovery.py
+
+	The cache holds the junctions found in every (bam, region) pair that has been processed, keyed on
+	the identity of the bam file, the region and the discovery parameters. It can be shared between
+	projects which reuse the same control bam files. Only one process should write to it at a time.
+
+	Args:
+		path, the path to the cache database
+		create, False to only read from an existing cache
+
+	Returns:
+	    a connection to the cache
+
+	Raises:
+	    None
+	"""
+
+	conn = sqlite3.connect(path, timeout=80)
+
+	if not create:
+		return conn
+
+	conn.execute('''PRAGMA journal_mode = WAL;''')
+	conn.execute('''create table if not exists DISCOVERY_RESULTS (
+		bam_key text not null,
+		parameters text not null,
+		region text not null,
+		junctions blob not null,
+		primary key (bam_key, parameters, region)) without rowid;''')
+	conn.commit()
+
+	return conn
+
+def bamIdentity(bam, checksum=False):
+
+	"""
+	Makes a key identifying the contents of a bam file
+
+	By default a bam file is identified by its absolute path, size and modification time, which costs
+	a single stat call. With checksum the key is a SHA-1 of the file's contents instead, so the same bam
+	file is recognized after it has been copied or moved, at the cost of reading the whole file.
+
+	Args:
+		bam, path to a bam file
+		checksum, True to hash the contents of the file
+
+	Returns:
+	    a hex string
+
+	Raises:
+	    None
+	"""
+
+	if checksum:
+		digest = hashlib.sha1()
+
+		with open(bam, "rb") as bf:
+			for block in iter(lambda: bf.read(1 << 20), b""):
+				digest.update(block)
+
+		return 'sha1:' + digest.hexdigest()
+
+	stat = os.stat(bam)
+	identity = '\t'.join([os.path.realpath(bam), str(stat.st_size), str(stat.st_mtime_ns)])
+
+	return 'stat:' + hashlib.sha1(identity.encode()).hexdigest()
+
+def regionKey(chrom, start, stop):
+
+	"""
+	Makes the key of a region in the cache. Regions are keyed on position only, so genes
+	sharing a region share its results.
+
+	Args:
+		chrom, start and stop, the region
+
+	Returns:
+	    a string, E.x. 1:200-300
+
+	Raises:
+	    None
+	"""
+
+	return ''.join([str(chrom), ':', str(int(start)), '-', str(int(stop))])
+
+def encodeJunctions(spliceDict):
+
+	"""
+	Serializes a dictionary of junctions and read counts for storage in the cache
+
+	Args:
+		spliceDict, a dictionary containing junctions and their read counts
+			E.x. spliceDict[('1', '200', '300')] = 5
+
+	Returns:
+	    compressed bytes
+
+	Raises:
+	    None
+	"""
+
+	text = ''.join(['\t'.join([chrom, start, stop, str(count)]) + '\n' for (chrom, start, stop), count in spliceDict.items()])
+
+	return zlib.compress(text.encode(), 6)
+
+def decodeJunctions(blob):
+
+	"""
+	Inverse of encodeJunctions(), keeps the order junctions were first seen in
+
+	Args:
+		blob, bytes made by encodeJunctions()
+
+	Returns:
+	    spliceDict, a dictionary containing junctions and their read counts
+
+	Raises:
+	    None
+	"""
+
+	spliceDict = {}
+
+	for line in zlib.decompress(blob).decode().splitlines():
+		chrom, start, stop, count = line.split('\t')
+		spliceDict[(chrom, start, stop)] = int(count)
+
+	return spliceDict
+
+def cachedRegions(conn, bamKey, parameters):
+
+	"""
+	Finds the regions of a bam file that have already been processed
+
+	Args:
+		conn, a connection to the cache
+		bamKey, a key made by bamIdentity()
+		parameters, a string describing the discovery parameters
+
+	Returns:
+	    a set of region keys
+
+	Raises:
+	    None
+	"""
+
+	cur = conn.execute('''select region from DISCOVERY_RESULTS where bam_key = ? and parameters = ?;''', (bamKey, parameters))
+
+	return set(region for region, in cur)
+
+def storeResults(conn, parameters, results):
+
+	"""
+	Stores the results of a finished task in a single transaction, so a task is either
+	entirely in the cache or not in it at all
+
+	Args:
+		conn, a connection to the cache
+		parameters, a string describing the discovery parameters
+		results, a list of (bamKey, regionKey, spliceDict) tuples. Empty dictionaries are
+		stored too, so regions without junctions are not processed again
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	with conn:
+		conn.executemany('''insert or replace into DISCOVERY_RESULTS (bam_key, parameters, region, junctions) values (?, ?, ?, ?);''',
+			((bamKey, parameters, region, encodeJunctions(spliceDict)) for bamKey, region, spliceDict in results))
+
+def loadResults(conn, bamKey, parameters):
+
+	"""
+	Loads every cached result of a bam file
+
+	Args:
+		conn, a connection to the cache
+		bamKey, a key made by bamIdentity()
+		parameters, a string describing the discovery parameters
+
+	Returns:
+	    a dictionary of region keys and spliceDicts
+
+	Raises:
+	    None
+	"""
+
+	cur = conn.execute('''select region, junctions from DISCOVERY_RESULTS where bam_key = ? and parameters = ?;''', (bamKey, parameters))
+
+	return {region: decodeJunctions(junctions) for region, junctions in cur}
+
+def importResults(conn, path):
+
+	"""
+	Copies every result of another cache, such as one written by a single shard, in to this cache
+	in a single transaction. Results already in this cache are replaced.
+
+	Args:
+		conn, a connection to the cache
+		path, the path to the cache to import
+
+	Returns:
+	    the number of results imported
+
+	Raises:
+	    None
+	"""
+
+	conn.execute('''attach database ? as shard;''', (path,))
+
+	try:
+		with conn:
+			cur = conn.execute('''insert or replace into DISCOVERY_RESULTS (bam_key, parameters, region, junctions)
+				select bam_key, parameters, region, junctions from shard.DISCOVERY_RESULTS;''')
+			imported = cur.rowcount
+	finally:
+		conn.execute('''detach database shard;''')
+
+	return imported
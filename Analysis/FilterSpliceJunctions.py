@@ -1,9 +1,37 @@
 #!/usr/bin/python3
 
 import os
-import sys
+import re
+import gzip
+import shutil
 import sqlite3
-from AddJunctionsToDatabase import connectToDB, commitAndClose
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+from datetime import datetime
+from AddJunctionsToDatabase import connectToDB, schemaVersion, hasRegionIndex, createRegionIndex
+from TaskScheduling import runLargestFirst
+
+try:
+	import pysam
+except ImportError:
+	pysam = None
+
+# results are read from the database fetchRows rows at a time and written in one call per batch, through a
+# write buffer of writeBufferBytes, so the memory a report needs does not grow with the number of junctions
+fetchRows = 10000
+writeBufferBytes = 1 << 20
+
+# the indexes --optimize creates for the queries of this script on each schema, see optimizeDatabase().
+# sampleJunctionCounts lets a per sample query read only that sample's read counts, and holds every column of
+# JUNCTION_COUNTS those queries use so they never read the table itself. geneJunctions finds the junctions of a 
+# gene panel, see loadPanel(). JUNCTION_COUNTS has the same columns in both schemas, so sampleJunctionCounts is defined once
+sampleJunctionCountsIndex = '''create index if not exists sampleJunctionCounts on JUNCTION_COUNTS (bam_id, read_count, norm_read_count, junction_id);'''
+advisedIndexes = [
+	('sampleJunctionCounts', {1: sampleJunctionCountsIndex, 2: sampleJunctionCountsIndex}),
+	('geneJunctions', {1: '''create index if not exists geneJunctions on GENE_REF (gene, junction_id);''',
+		2: '''create index if not exists geneJunctions on JUNCTION_GENES (gene_id, junction_id);'''})]
 
 def tableHeader():
 
@@ -62,52 +90,155 @@ def countPatients(cur):
 
 	return cur.fetchone()[0]
 
-def writeToFile(res, file):
+def fetchBatches(cur):
 
 	"""
-	Writes the results from a database query to a specified text file
+	Reads the results of the last query run on a cursor fetchRows rows at a time, instead of all at once with fetchall()
 
 	Args:
-		res, the returned values from a cursor's fetchall() method
+		cur, a cursor a query has just been executed on
+
+	Returns:
+	    A generator of lists of rows, the last one is never empty
+
+	Raises:
+	    None
+	"""
+
+	while True:
+		rows = cur.fetchmany(fetchRows)
+
+		if not rows:
+			return
+
+		yield rows
+
+def openOutput(file, compression=None):
+
+	"""
+	Opens an output text file for writing in binary mode, compressed or not. Compressed files get a .gz extension.
+	bgzip files are gzip files made of independent blocks, which can be read with zcat and indexed with tabix.
+
+	Args:
+		file, the path or name of a file to write to, without the .gz extension
+		compression, None, 'gzip' or 'bgzip'. bgzip needs pysam
+
+	Returns:
+	    (out, path), an open file object and the path of the file
+
+	Raises:
+	    None
+	"""
+
+	if compression == 'gzip':
+		path = file + '.gz'
+		out = gzip.open(path, 'wb', compresslevel=6)
+	elif compression == 'bgzip':
+		path = file + '.gz'
+		out = pysam.BGZFile(path, 'wb')
+	else:
+		path = file
+		out = open(path, 'wb', buffering=writeBufferBytes)
+
+	return out, path
+
+def writeToFile(cur, file, compression=None):
+
+	"""
+	Writes the results from a database query to a specified text file. The rows are streamed from the cursor
+	with fetchBatches() and each batch is written with a single call, so only one batch is held in memory.
+
+	Args:
+		cur, a cursor a query has just been executed on
 		file, the path or name of a file to write to
+		compression, None, 'gzip' or 'bgzip', see openOutput()
 
 	Returns:
+	    The number of rows written
+
+	Raises:
 	    None
+	"""
+
+	rows = 0
+	out, path = openOutput(file, compression)
+
+	with out:
+
+		out.write(tableHeader().encode())
+
+		for batch in fetchBatches(cur):
+			out.write(''.join('\t'.join(str(element) for element in row) + '\n' for row in batch).encode())
+			rows += len(batch)
+
+	return rows
+
+def readGenePanel(genes):
+
+	"""
+	Reads the gene names of a gene panel, the first column of each line. A transcript_file such as
+	data/kidney.glomerular.genes.list or a list of gene names one per line both work, a header line
+	is read as a gene which matches no junction.
+
+	Args:
+		genes, path to the gene panel file
+
+	Returns:
+	    A set of gene names
 
 	Raises:
 	    None
 	"""
 
-	with open(file, "w") as out:
+	panel = set()
 
-		out.write(tableHeader())
+	with open(genes) as gf:
+		for line in gf:
 
-		for row in res:
-			out.write('\t'.join(str(element) for element in row) + '\n')
+			fields = line.split()
 
-def sampleSpecificJunctions(cur, sample, min_read, min_norm_read):
+			if fields and not fields[0].startswith('#'):
+				panel.add(fields[0])
+
+	return panel
+
+def readBedPanel(bed):
 
 	"""
-	Generates a file containing junctions which are seen in a sample and not seen in any
-	GTEx samples with a read count equal to or greater than the specified minimum read count. 
+	Reads the regions of a BED file. BED positions are 0-based and the end is not part of the region,
+	they are converted to the 1-based positions, both included, junctions are stored with.
 
-	Note that this function does not discriminate against junctions seen in other patient samples.
-	Users should also note that the function does not work for GTEx samples as the database query
-	relies on n_gtex_seen being 0.
+	Args:
+		bed, path to the BED file, E.x. data/kidney.glomerular.genes.bed
 
-	The query provides information about read counts of only the one specified sample
-	in the columns 'sample:read_count' and 'sample:norm_read_count', 
+	Returns:
+	    A list of (chromosome, start, stop) tuples
 
-		Ex. 1:100-200 PATIENT2:344
+	Raises:
+	    None
+	"""
 
-	This occurs because we are joining on only one sample in the database as opposed
-	to all.
+	regions = []
+
+	with open(bed) as bf:
+		for line in bf:
+
+			fields = line.split()
+
+			if not fields or fields[0].startswith('#') or fields[0] in ('track', 'browser'):
+				continue
+
+			regions.append((fields[0], int(fields[1]) + 1, int(fields[2])))
+
+	return regions
+
+def createPanelTables(cur):
+
+	"""
+	Creates the empty temporary tables a panel is loaded in to by loadPanel(), if they do not exist
 
 	Args:
 		cur, a cursor to a connection to a database
-		sample, the name of the sample file you want to investigate, must include .bam extension
-		min_read, the minimum number of reads a junction must have
-		min_norm_read, the minimum normalized read count a junction must have or NULL
 
 	Returns:
 	    None
@@ -116,11 +247,138 @@ def sampleSpecificJunctions(cur, sample, min_read, min_norm_read):
 	    None
 	"""
 
-	count = str(countGTEX(cur))
+	cur.execute('''create temp table if not exists PANEL_GENES (
+		gene varchar(30) primary key) without rowid;''')
+	cur.execute('''create temp table if not exists PANEL_REGIONS (
+		chromosome tinyint not null,
+		start integer not null,
+		stop integer not null);''')
+	cur.execute('''create index if not exists temp.chromosomeRegions on PANEL_REGIONS (chromosome, start);''')
+	cur.execute('''create temp table if not exists PANEL_JUNCTIONS (
+		junction_id integer primary key);''')
 
-	output = '_'.join([sample, 'specific', 'rc' + str(min_read), ('norm_rc' + str(min_norm_read)), 'n_gtex_' + count])
+def loadPanel(cur, genes=None, bed=None):
 
-	cur.execute('''select group_concat(gene_ref.gene),
+	"""
+	Loads a gene panel, a BED file of regions or both in to temporary tables of the connection and finds the 
+	junctions of the panel once, in temp.PANEL_JUNCTIONS, which the queries of this script join against when they
+	are given a panel. So only the junctions of the panel are read and written out.
+
+	A junction is in a gene panel if GENE_REF maps it to one of the genes, and in a BED panel if it overlaps one of
+	the regions. With both, it has to be in both. After --optimize the junctions of a gene panel are found with the
+	geneJunctions index and those of a BED panel with JUNCTION_RTREE, before it every junction of JUNCTION_REF
+	is checked against the regions.
+
+	Args:
+		cur, a cursor to a connection to a database
+		genes, path to a gene panel file, see readGenePanel(), or None
+		bed, path to a BED file, see readBedPanel(), or None
+
+	Returns:
+	    The number of junctions in the panel
+
+	Raises:
+	    None
+	"""
+
+	createPanelTables(cur)
+	cur.execute('''delete from temp.PANEL_GENES;''')
+	cur.execute('''delete from temp.PANEL_REGIONS;''')
+	cur.execute('''delete from temp.PANEL_JUNCTIONS;''')
+
+	if hasRegionIndex(cur):
+		regionJunctions = '''select t.junction_id from temp.PANEL_REGIONS p
+			inner join CHROMOSOME_REF k on k.chromosome = p.chromosome
+			inner join JUNCTION_RTREE t on t.chromosome_min <= k.chromosome_id and t.chromosome_max >= k.chromosome_id and t.start <= p.stop and t.stop >= p.start'''
+	else:
+		regionJunctions = '''select r.ROWID from JUNCTION_REF r 
+			where exists (select 1 from temp.PANEL_REGIONS p where p.chromosome = r.chromosome and p.start <= r.stop and p.stop >= r.start)'''
+
+	if genes:
+		cur.executemany('''insert or ignore into temp.PANEL_GENES (gene) values (?);''', ((gene, ) for gene in readGenePanel(genes)))
+		cur.execute('''insert or ignore into temp.PANEL_JUNCTIONS (junction_id) 
+			select junction_id from GENE_REF where gene in (select gene from temp.PANEL_GENES);''')
+
+	if bed:
+		cur.executemany('''insert into temp.PANEL_REGIONS (chromosome, start, stop) values (?, ?, ?);''', readBedPanel(bed))
+
+		if genes:
+			cur.execute('''delete from temp.PANEL_JUNCTIONS where junction_id not in ({0});'''.format(regionJunctions))
+		else:
+			cur.execute('''insert or ignore into temp.PANEL_JUNCTIONS (junction_id) {0};'''.format(regionJunctions))
+
+	cur.connection.commit()
+
+	cur.execute('''select count(*) from temp.PANEL_JUNCTIONS;''')
+	junctions = cur.fetchone()[0]
+
+	print ('The panel %s holds %d junctions' % (panelName(panel=(genes, bed))[1:], junctions))
+
+	return junctions
+
+def panelName(panel):
+
+	"""
+	The suffix added to the name of a file filtered with a panel, the names of the panel's files
+
+	Args:
+		panel, a (genes, bed) tuple of the panel's files, either of which can be None, or None
+
+	Returns:
+	    A string, empty without a panel
+
+	Raises:
+	    None
+	"""
+
+	if not panel:
+		return ''
+
+	return ''.join('_' + os.path.basename(path) for path in panel if path)
+
+def panelClause(panel):
+
+	"""
+	The condition which limits a query to the junctions loaded by loadPanel()
+
+	Args:
+		panel, a (genes, bed) tuple of the panel's files or None
+
+	Returns:
+	    A string, empty without a panel
+
+	Raises:
+	    None
+	"""
+
+	if not panel:
+		return ''
+
+	return 'and junction_ref.rowid in (select junction_id from temp.PANEL_JUNCTIONS)'
+
+def sampleJunctionsQuery(custom=False, patients=False, chromosome=False, panel=None):
+
+	"""
+	The query of sampleSpecificJunctions(), customSampleSpecificJunctions() and allPatientsSpecificJunctions().
+	Its parameters are the sample name unless patients is True, the minimum read count, the maximum n_gtex_seen, 
+	the maximum total_gtex_read_count if custom is True, the minimum normalized read count and the chromosome
+	if chromosome is True
+
+	Args:
+		custom, True to also filter on total_gtex_read_count
+		patients, True to report every patient sample instead of the one named, with the sample name as an
+		extra first column and the rows ordered by sample
+		chromosome, True to only report the junctions of one chromosome
+		panel, not None to only report the junctions loaded by loadPanel()
+
+	Returns:
+	    A string
+
+	Raises:
+	    None
+	"""
+
+	return '''select {sample_name}group_concat(gene_ref.gene),
 		(junction_ref.chromosome||':'||junction_ref.start||'-'||junction_ref.stop),
 		case 
 			when junction_ref.gencode_annotation = 0 then 'NONE'
@@ -141,17 +399,85 @@ def sampleSpecificJunctions(cur, sample, min_read, min_norm_read):
 		inner join junction_ref on junction_counts.junction_id = junction_ref.rowid 
 		inner join gene_ref on junction_ref.rowid = gene_ref.junction_id 
 		where
-		sample_ref.sample_name = ? and
+		{samples} and
 		junction_counts.read_count >= ? and
 		junction_ref.n_gtex_seen <= ? and
+		{total_gtex_read_count}
 		(junction_counts.norm_read_count >= ? or junction_counts.norm_read_count is NULL)
+		{chromosome}
+		{panel}
 		group by 
-		junction_ref.chromosome, junction_ref.start, junction_ref.stop;''',
+		{bam_id}junction_ref.chromosome, junction_ref.start, junction_ref.stop
+		{order};'''.format(sample_name='sample_ref.sample_name, ' if patients else '',
+		samples='sample_ref.type = 1' if patients else 'sample_ref.sample_name = ?',
+		total_gtex_read_count='junction_ref.total_gtex_read_count <= ? and' if custom else '',
+		chromosome='and junction_ref.chromosome = ?' if chromosome else '',
+		panel=panelClause(panel),
+		bam_id='sample_ref.ROWID, ' if patients else '',
+		order='order by sample_ref.ROWID, junction_ref.chromosome, junction_ref.start, junction_ref.stop' if patients else '')
+
+def sampleSpecificOutput(sample, min_read, min_norm_read, n_gtex, panel=None):
+
+	"""
+	The name of the text file sampleSpecificJunctions() writes for a sample
+
+	Args:
+		sample, the name of the sample file, including its .bam extension
+		min_read, the minimum number of reads a junction must have
+		min_norm_read, the minimum normalized read count a junction must have
+		n_gtex, the number of GTEx samples in the database
+		panel, the (genes, bed) files of the panel the junctions are filtered with or None, see panelName()
+
+	Returns:
+	    A string
+
+	Raises:
+	    None
+	"""
+
+	return '_'.join([sample, 'specific', 'rc' + str(min_read), ('norm_rc' + str(min_norm_read)), 'n_gtex_' + str(n_gtex)]) + panelName(panel)
+
+def sampleSpecificJunctions(cur, sample, min_read, min_norm_read, compression=None, panel=None):
+
+	"""
+	Generates a file containing junctions which are seen in a sample and not seen in any
+	GTEx samples with a read count equal to or greater than the specified minimum read count. 
+
+	Note that this function does not discriminate against junctions seen in other patient samples.
+	Users should also note that the function does not work for GTEx samples as the database query
+	relies on n_gtex_seen being 0.
+
+	The query provides information about read counts of only the one specified sample
+	in the columns 'sample:read_count' and 'sample:norm_read_count', 
+
+		Ex. 1:100-200 PATIENT2:344
+
+	This occurs because we are joining on only one sample in the database as opposed
+	to all.
+
+	Args:
+		cur, a cursor to a connection to a database
+		sample, the name of the sample file you want to investigate, must include .bam extension
+		min_read, the minimum number of reads a junction must have
+		min_norm_read, the minimum normalized read count a junction must have or NULL
+		compression, None, 'gzip' or 'bgzip' to compress the output file, see openOutput()
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	output = sampleSpecificOutput(sample, min_read, min_norm_read, countGTEX(cur), panel)
+
+	cur.execute(sampleJunctionsQuery(panel=panel),
 		(sample, min_read, 0, min_norm_read))
 
-	writeToFile(cur.fetchall(), output)
+	writeToFile(cur, output, compression)
 
-def customSampleSpecificJunctions(cur, sample, min_read, min_norm_read, max_n_gtex_seen, max_total_gtex_reads):
+def customSampleSpecificJunctions(cur, sample, min_read, min_norm_read, max_n_gtex_seen, max_total_gtex_reads, compression=None, panel=None):
 
 	"""
 	Generates a text file using a query in which you can discover junctions specific to a sample
@@ -172,6 +498,8 @@ def customSampleSpecificJunctions(cur, sample, min_read, min_norm_read, max_n_gt
 		min_norm_read, the minimum normalized read count a junction must have or NULL
 		max_n_gtex_seen, the maximum number of gtex samples a junction can appear in
 		max_total_gtex_reads, the maximum total read count for a junction in GTEx samples
+		compression, None, 'gzip' or 'bgzip' to compress the output file, see openOutput()
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None
 
 	Returns:
 	    None
@@ -189,39 +517,178 @@ def customSampleSpecificJunctions(cur, sample, min_read, min_norm_read, max_n_gt
 	if not min_read:
 		min_read = 0
 
-	output = '_'.join([str(sample), ('rc' + str(min_read)), ('norm_rc' + str(min_norm_read)), ('maxGTEX' + str(max_n_gtex_seen)), ('maxGTEXrc' + str(max_total_gtex_reads))])
+	output = '_'.join([str(sample), ('rc' + str(min_read)), ('norm_rc' + str(min_norm_read)), ('maxGTEX' + str(max_n_gtex_seen)), ('maxGTEXrc' + str(max_total_gtex_reads))]) + panelName(panel)
 
-	cur.execute('''select group_concat(gene_ref.gene),
-		(junction_ref.chromosome||':'||junction_ref.start||'-'||junction_ref.stop),
-		case 
-			when junction_ref.gencode_annotation = 0 then 'NONE'
-			when junction_ref.gencode_annotation = 1 then 'START'
-			when junction_ref.gencode_annotation = 2 then 'STOP'
-			when junction_ref.gencode_annotation = 3 then 'BOTH'
-			when junction_ref.gencode_annotation = 4 then 'EXON_SKIP'
-		END as annotation, 
-		junction_ref.n_gtex_seen, 
-		junction_ref.n_patients_seen,
-		junction_ref.total_patient_read_count,
-		junction_ref.total_gtex_read_count,
-		junction_ref.total_read_count,
-		group_concat(distinct junction_counts.read_count||':'||sample_ref.sample_name),
-		group_concat(distinct junction_counts.norm_read_count||':'||sample_ref.sample_name)
-		from 
-		sample_ref inner join junction_counts on sample_ref.ROWID = junction_counts.bam_id 
-		inner join junction_ref on junction_counts.junction_id = junction_ref.rowid 
-		inner join gene_ref on junction_ref.rowid = gene_ref.junction_id 
-		where
-		sample_ref.sample_name = ? and
-		junction_counts.read_count >= ? and
-		junction_ref.n_gtex_seen <= ? and
-		junction_ref.total_gtex_read_count <= ? and
-		(junction_counts.norm_read_count >= ? or junction_counts.norm_read_count is NULL)
-		group by 
-		junction_ref.chromosome, junction_ref.start, junction_ref.stop;''',
-		(sample, min_read, max_n_gtex_seen, max_total_gtex_reads))
+	cur.execute(sampleJunctionsQuery(True, panel=panel),
+		(sample, min_read, max_n_gtex_seen, max_total_gtex_reads, min_norm_read))
+
+	writeToFile(cur, output, compression)
+
+def writeSampleFiles(cur, outputs, compression=None, header=True):
+
+	"""
+	Writes the results of a query with the sample name as its first column and its rows ordered by sample to one
+	text file per sample, in a single streaming pass. The sample name column is not written. Only one file is
+	open at a time, so a report of any number of samples needs the same memory and file handles as one.
+
+	Args:
+		cur, a cursor a query has just been executed on
+		outputs, a dictionary of sample names and the path or name of the file to write each one to
+		compression, None, 'gzip' or 'bgzip', see openOutput()
+		header, False to leave out the header line, used for the parts allPatientsSpecificJunctions() joins
 
-	writeToFile(cur.fetchall(), output)
+	Returns:
+	    A dictionary of sample names and the number of rows written for each
+
+	Raises:
+	    None
+	"""
+
+	written = {}
+	rows = itertools.chain.from_iterable(fetchBatches(cur))
+
+	for sample, sampleRows in itertools.groupby(rows, key=lambda row: row[0]):
+
+		out, path = openOutput(outputs[sample], compression)
+
+		with out:
+
+			if header:
+				out.write(tableHeader().encode())
+
+			written[sample] = 0
+
+			while True:
+				batch = list(itertools.islice(sampleRows, fetchRows))
+
+				if not batch:
+					break
+
+				out.write(''.join('\t'.join(str(element) for element in row[1:]) + '\n' for row in batch).encode())
+				written[sample] += len(batch)
+
+	return written
+
+def patientChromosomeJunctions(poolArguement):
+
+	"""
+	Writes the patient specific junctions of one chromosome to a part file per patient, in a worker process
+	started by allPatientsSpecificJunctions()
+
+	Args:
+		poolArguement, a tuple of the database path, the chromosome, the folder to write the part files to, 
+		a dictionary of patient sample names and their part file names, the minimum read count, the minimum
+		normalized read count and the (genes, bed) files of the panel to filter with or None
+
+	Returns:
+	    The chromosome
+
+	Raises:
+	    None
+	"""
+
+	path, chromosome, folder, parts, min_read, min_norm_read, panel = poolArguement
+
+	conn, cur = connectToDB(path, 'query')
+
+	# temporary tables belong to the connection that made them
+	if panel:
+		loadPanel(cur, *panel)
+
+	cur.execute(sampleJunctionsQuery(patients=True, chromosome=True, panel=panel), (min_read, 0, min_norm_read, chromosome))
+	writeSampleFiles(cur, dict((sample, os.path.join(folder, part)) for sample, part in parts.items()), header=False)
+	conn.close()
+
+	return chromosome
+
+def allPatientsSpecificJunctions(cur, min_read, min_norm_read, compression=None, processes=1, path=None, panel=None):
+
+	"""
+	Writes the file sampleSpecificJunctions() writes for every patient sample, with a single query over the database
+	instead of one per patient. The rows come back ordered by patient and are streamed to each patient's file by
+	writeSampleFiles().
+
+	With more than one process the query is run once per chromosome in a pool of worker processes, largest 
+	chromosome first. Each writes a part file per patient to a temporary folder in the working directory, 
+	which are then joined in chromosome order, so the files are the same as with one process.
+
+	Args:
+		cur, a cursor to a connection to a database
+		min_read, the minimum number of reads a junction must have
+		min_norm_read, the minimum normalized read count a junction must have or NULL
+		compression, None, 'gzip' or 'bgzip' to compress the output files, see openOutput()
+		processes, the number of worker processes to split the chromosomes between
+		path, the database cur is connected to, needed by the worker processes when processes is more than 1
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None.
+		Each worker process loads it again
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	n_gtex = countGTEX(cur)
+
+	cur.execute('''select sample_name from SAMPLE_REF where type = 1 order by ROWID;''')
+	patients = [row[0] for row in cur.fetchall()]
+	outputs = dict((sample, sampleSpecificOutput(sample, min_read, min_norm_read, n_gtex, panel)) for sample in patients)
+
+	print ('Writing the specific junctions of %d patients @ %s' % (len(patients), datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")))
+
+	if processes <= 1:
+		cur.execute(sampleJunctionsQuery(patients=True, panel=panel), (min_read, 0, min_norm_read))
+		written = writeSampleFiles(cur, outputs, compression)
+	else:
+		cur.execute('''select chromosome, count(*) from JUNCTION_REF group by chromosome order by chromosome;''')
+		chromosomes = cur.fetchall()
+		parts = dict((sample, str(number)) for number, sample in enumerate(patients))
+		written = {}
+
+		with tempfile.TemporaryDirectory(dir='.') as scratch:
+
+			folders = [os.path.join(scratch, str(number)) for number in range(len(chromosomes))]
+
+			for folder in folders:
+				os.mkdir(folder)
+
+			pool = multiprocessing.Pool(processes=int(processes))
+			tasks = [(path, chromosome, folder, parts, min_read, min_norm_read, panel) for (chromosome, junctions), folder in zip(chromosomes, folders)]
+
+			for chromosome in runLargestFirst(pool, patientChromosomeJunctions, tasks, [junctions for chromosome, junctions in chromosomes]):
+				print ('finished chromosome ' + str(chromosome))
+
+			pool.close()
+			pool.join()
+
+			for sample in patients:
+
+				partPaths = [os.path.join(folder, parts[sample]) for folder in folders if os.path.isfile(os.path.join(folder, parts[sample]))]
+
+				if not partPaths:
+					continue
+
+				out, outPath = openOutput(outputs[sample], compression)
+
+				with out:
+					out.write(tableHeader().encode())
+
+					for partPath in partPaths:
+						with open(partPath, 'rb') as part:
+							shutil.copyfileobj(part, out, writeBufferBytes)
+
+				written[sample] = len(partPaths)
+
+	# patients without a specific junction still get a file with only the header, as sampleSpecificJunctions() writes
+	for sample in patients:
+		if sample not in written:
+			out, outPath = openOutput(outputs[sample], compression)
+
+			with out:
+				out.write(tableHeader().encode())
+
+	print ('Finished writing the specific junctions of %d patients @ %s' % (len(patients), datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")))
 
 def printSamplesInDB(cur):
 
@@ -248,32 +715,30 @@ def printSamplesInDB(cur):
 	for line in cur.fetchall():
 		print('\t'.join(str(i) for i in line))
 
-def printAllJunctions(cur):
+def allJunctionsQuery(panel=None, region=None):
 
 	"""
-	Dumps all junction information seen in all samples to a text file.
-
-	The query provides information about read counts of a junction across all samples
-	unlike the other queries in the columns 'sample:read_count' and 'sample:norm_read_count', 
-
-		Ex. 1:100-200 GTEx1:20,GTEx3:211,PATIENT2:344
-
-	This occurs because we are joining and grouping all sample names in the database as opposed
-	to just one name.
+	The query of printAllJunctions() and findRegionJunctions(), every junction with its read counts in every sample
 
 	Args:
-		cur, a cursor to a connection to a database
+		panel, not None to only report the junctions loaded by loadPanel()
+		region, None for every junction, 'rtree' for the junctions overlapping a region found with JUNCTION_RTREE,
+		with the named parameters chromosome_id, start and stop, or 'scan' to find them by reading JUNCTION_REF,
+		with the named parameters chromosome, start and stop
 
 	Returns:
-	    None
+	    A string
 
 	Raises:
 	    None
 	"""
 
-	output = 'all_junctions_n_gtex_' + str(countGTEX(cur)) + '_n_paitents_' + str(countPatients(cur))
+	regions = {None: '',
+		'rtree': '''and junction_ref.rowid in (select junction_id from JUNCTION_RTREE 
+			where chromosome_min <= :chromosome_id and chromosome_max >= :chromosome_id and start <= :stop and stop >= :start)''',
+		'scan': '''and junction_ref.chromosome = :chromosome and junction_ref.start <= :stop and junction_ref.stop >= :start'''}
 
-	cur.execute('''select group_concat(gene_ref.gene),
+	return '''select group_concat(gene_ref.gene),
 		(junction_ref.chromosome||':'||junction_ref.start||'-'||junction_ref.stop),
 		case 
 			when junction_ref.gencode_annotation = 0 then 'NONE'
@@ -294,34 +759,306 @@ def printAllJunctions(cur):
 		inner join junction_ref on junction_counts.junction_id = junction_ref.rowid 
 		inner join gene_ref on junction_ref.rowid = gene_ref.junction_id
 		where junction_ref.total_read_count > 0
+		{region}
+		{panel}
 		group by 
-		junction_ref.chromosome, junction_ref.start, junction_ref.stop;''')
+		junction_ref.chromosome, junction_ref.start, junction_ref.stop;'''.format(region=regions[region], panel=panelClause(panel))
 
-	writeToFile(cur.fetchall(), output)
+def printAllJunctions(cur, compression=None, panel=None):
 
-if __name__=="__main__":
-	
-	conn, cur = connectToDB()
+	"""
+	Dumps all junction information seen in all samples to a text file.
 
-	# sample = sys.argv[2]
-	# min_read = int(sys.argv[3])
-	# max_n_gtex_seen = int(sys.argv[4])
-	# max_total_gtex_reads = int(sys.argv[5])
+	The query provides information about read counts of a junction across all samples
+	unlike the other queries in the columns 'sample:read_count' and 'sample:norm_read_count', 
 
-	if sys.argv[1] == '--printsamples':
-		printSamplesInDB(cur)
-	elif sys.argv[1] == '--sample':
-		print(sys.argv[4])
-		sampleSpecificJunctions(cur, sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
-	elif sys.argv[1] == '--custom':
-		customSampleSpecificJunctions(cur, sys.argv[2], float(sys.argv[3]), sys.argv[4], sys.argv[5], sys.argv[6])
-	elif sys.argv[1] == '--all':
-		printAllJunctions(cur)
+		Ex. 1:100-200 GTEx1:20,GTEx3:211,PATIENT2:344
+
+	This occurs because we are joining and grouping all sample names in the database as opposed
+	to just one name.
+
+	Args:
+		cur, a cursor to a connection to a database
+		compression, None, 'gzip' or 'bgzip' to compress the output file, see openOutput()
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	output = 'all_junctions_n_gtex_' + str(countGTEX(cur)) + '_n_paitents_' + str(countPatients(cur)) + panelName(panel)
+
+	cur.execute(allJunctionsQuery(panel))
+
+	writeToFile(cur, output, compression)
+
+def parseRegion(region):
+
+	"""
+	Reads a region written as chromosome:start-end, 1-based with both ends included, the way IGV and samtools
+	write them. Commas in the positions are ignored, E.x. X:31,137,345-33,357,726
+
+	Args:
+		region, a string
+
+	Returns:
+	    (chromosome, start, stop), or None if the region cannot be read
+
+	Raises:
+	    None
+	"""
+
+	match = re.match(r'^(.+):([0-9,]+)-([0-9,]+)$', region.strip())
+
+	if not match:
+		return None
+
+	start, stop = int(match.group(2).replace(',', '')), int(match.group(3).replace(',', ''))
+
+	if start > stop:
+		return None
+
+	return match.group(1), start, stop
+
+def findRegionJunctions(cur, chromosome, start, stop, panel=None):
+
+	"""
+	Runs the query of every junction overlapping a region, with its read counts in every sample, on a cursor.
+	The junctions are found with the R*Tree JUNCTION_RTREE made by --optimize, see createRegionIndex(), so
+	a lookup reads only the junctions of the region. Without it JUNCTION_REF is read from start to end.
+
+	Args:
+		cur, a cursor to a connection to a database
+		chromosome, the chromosome of the region
+		start, the first position of the region
+		stop, the last position of the region
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None
+
+	Returns:
+	    The cursor, to read the rows of the tableHeader() columns from
+
+	Raises:
+	    None
+	"""
+
+	if hasRegionIndex(cur):
+		cur.execute('''select chromosome_id from CHROMOSOME_REF where chromosome = ?;''', (chromosome, ))
+		res = cur.fetchone()
+
+		# no junction is on a chromosome which is not in CHROMOSOME_REF
+		cur.execute(allJunctionsQuery(panel, 'rtree'), {'chromosome_id': res[0] if res else 0, 'start': start, 'stop': stop})
 	else:
-		print('Invalid option. Use one of the following:')
-		print('--printsamples')
-		print('--sample	[SAMPLE]	[MIN_READ]	[MIN_NORM_READ]')
-		print('--custom [SAMPLE] [MIN_READ] [MIN_NORM_READ]	[MAX_N_GTEX_SEEN] [MAX_TOTAL_GTEX_READS]')
-		print('--all')
+		cur.execute(allJunctionsQuery(panel, 'scan'), {'chromosome': chromosome, 'start': start, 'stop': stop})
+
+	return cur
+
+def regionJunctions(cur, chromosome, start, stop, compression=None, panel=None):
+
+	"""
+	Writes every junction overlapping a region, with its read counts in every sample, to a text file
+
+	Args:
+		cur, a cursor to a connection to a database
+		chromosome, the chromosome of the region
+		start, the first position of the region
+		stop, the last position of the region
+		compression, None, 'gzip' or 'bgzip' to compress the output file, see openOutput()
+		panel, the (genes, bed) files of a panel already loaded by loadPanel() to only report its junctions, or None
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	if not hasRegionIndex(cur):
+		print ('The database has no R*Tree of junction positions, reading all of JUNCTION_REF. Run --optimize once to make region lookups fast')
+
+	output = '_'.join(['region', str(chromosome), '%d-%d' % (start, stop)]) + panelName(panel)
+
+	writeToFile(findRegionJunctions(cur, chromosome, start, stop, panel), output, compression)
+
+def boundedScan(step):
+
+	"""
+	Checks whether a SCAN step of a query plan reads a table which does not grow with the number of samples:
+	the temporary tables of a panel, and GENE_NAMES of schema 2 (n in the GENE_REF view), which has one row per
+	gene and which the planner scans when it is small. The R*Tree is searched through a virtual table index,
+	which EXPLAIN QUERY PLAN also lists as a SCAN.
+
+	Args:
+		step, the detail of a step of EXPLAIN QUERY PLAN
 
-	commitAndClose(conn)
\ No newline at end of file
+	Returns:
+	    True or False
+
+	Raises:
+	    None
+	"""
+
+	table = step.split()[1]
+
+	return table.startswith('PANEL_') or table in ('n', 'GENE_NAMES') or re.search(r'VIRTUAL TABLE INDEX [0-9]+:\S', step) is not None
+
+def checkQueryPlans(cur):
+
+	"""
+	Prints the EXPLAIN QUERY PLAN of every per sample query of this script, of finding the junctions of a gene
+	panel and of --region, and checks none of them scans a whole table or index, which makes the query slower as 
+	controls are added
+
+	Args:
+		cur, a cursor to a connection to a database
+
+	Returns:
+	    A list of the options whose query scans a table or index
+
+	Raises:
+	    None
+	"""
+
+	createPanelTables(cur)
+
+	queries = [('--sample', sampleJunctionsQuery(), ('', 0, 0, 0)),
+		('--custom', sampleJunctionsQuery(True), ('', 0, 0, 0, 0)),
+		('--genes', '''select junction_id from GENE_REF where gene in (select gene from temp.PANEL_GENES);''', ())]
+
+	if hasRegionIndex(cur):
+		queries.append(('--region', allJunctionsQuery(region='rtree'), {'chromosome_id': 0, 'start': 0, 'stop': 0}))
+
+	failed = []
+
+	for option, query, parameters in queries:
+
+		cur.execute('explain query plan ' + query, parameters)
+		plan = [row[3] for row in cur.fetchall()]
+		scans = [step for step in plan if step.startswith('SCAN') and not boundedScan(step)]
+
+		print ('%s\t%s' % (option, 'FAILED, falls back to a full scan' if scans else 'OK'))
+
+		for step in plan:
+			print ('\t' + step)
+
+		if scans:
+			failed.append(option)
+
+	return failed
+
+def optimizeDatabase(path):
+
+	"""
+	Creates the advisedIndexes for the queries of this script and the R*Tree of junction positions used by --region,
+	see createRegionIndex(), if they do not exist, refreshes the query planner's statistics with ANALYZE and checks
+	the query plans with checkQueryPlans(). The indexes are kept up to date as samples are added or deleted,
+	run this again after adding many samples to refresh the statistics.
+
+	Args:
+		path, the database to optimize
+
+	Returns:
+	    None, exits if a query still scans a table or index
+
+	Raises:
+	    None
+	"""
+
+	conn, cur = connectToDB(path, 'ingest')
+	schema = schemaVersion(cur)
+
+	for name, index in advisedIndexes:
+		print ('Creating index %s @ %s' % (name, datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")))
+		cur.execute(index[schema])
+		conn.commit()
+
+	print ('Creating the R*Tree of junction positions @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+	createRegionIndex(cur)
+
+	print ('Running ANALYZE @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+	cur.execute('''analyze;''')
+	conn.commit()
+
+	failed = checkQueryPlans(cur)
+	conn.close()
+
+	if failed:
+		print ('FATAL ERROR - the queries of %s scan a whole table or index, their run time grows with the number of samples' % ', '.join(failed))
+		exit(1)
+
+	print ('Finished optimizing @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Report the junctions stored in a splice junction database made by AddJunctionsToDatabase.py')
+	parser.add_argument('-db',help='The database to read, default=SpliceJunction.db',default='SpliceJunction.db')
+	parser.add_argument('-processes',help='to be used with --all-patients, the number of worker processes to split the chromosomes between, default=1',type=int,default=1)
+	parser.add_argument('--genes',help='Only report the junctions of the genes in this file, its first column, E.x. data/kidney.glomerular.genes.list. Works with every option')
+	parser.add_argument('--bed',help='Only report the junctions which overlap a region of this BED file, E.x. data/kidney.glomerular.genes.bed. Works with every option, with --genes a junction has to be in both')
+	parser.add_argument('-compress',help='Compress the output file with gzip, or bgzip (needs pysam) so it can be indexed with tabix. The file gets a .gz extension, default=none',choices=['none', 'gzip', 'bgzip'],default='none')
+
+	mode_arguments = parser.add_mutually_exclusive_group(required=True)
+	mode_arguments.add_argument('--printsamples',action='store_true',help='Print every sample in the database and its experiment type')
+	mode_arguments.add_argument('--sample',nargs=3,metavar=('SAMPLE', 'MIN_READ', 'MIN_NORM_READ'),help='Write the junctions of SAMPLE seen in no GTEx sample to a text file')
+	mode_arguments.add_argument('--custom',nargs=5,metavar=('SAMPLE', 'MIN_READ', 'MIN_NORM_READ', 'MAX_N_GTEX_SEEN', 'MAX_TOTAL_GTEX_READS'),help='Write the junctions of SAMPLE seen in at most MAX_N_GTEX_SEEN GTEx samples to a text file')
+	mode_arguments.add_argument('--all-patients','--allPatients',dest='allPatients',nargs=2,metavar=('MIN_READ', 'MIN_NORM_READ'),help='Write the file --sample writes for every patient sample, in one pass over the database')
+	mode_arguments.add_argument('--all',action='store_true',help='Write every junction and its read count in each sample to a text file')
+	mode_arguments.add_argument('--region',metavar='CHROM:START-END',help='Write every junction overlapping a region, 1-based with both ends included, E.x. X:31137345-33357726, and its read count in each sample to a text file')
+	mode_arguments.add_argument('--optimize',action='store_true',help='Create the indexes the per sample queries need, run ANALYZE and check no query falls back to a full scan. The index is 60 to 90%% of the size of JUNCTION_COUNTS')
+	args=parser.parse_args()
+
+	compression = None if args.compress == 'none' else args.compress
+	region = None
+
+	if args.region:
+		region = parseRegion(args.region)
+
+		if not region:
+			print ('Could not read the region %s, write it as CHROM:START-END, E.x. X:31137345-33357726. Exiting.' % args.region)
+			exit(1)
+
+	if compression == 'bgzip' and not pysam:
+		print ('-compress=bgzip needs pysam, which is not installed. Install it with "pip3 install pysam" or use -compress=gzip. Exiting.')
+		exit(1)
+
+	if not os.path.isfile(args.db):
+		print ('The database %s does not exist. Exiting.' % args.db)
+		exit(1)
+
+	if args.optimize:
+		optimizeDatabase(args.db)
+		exit(0)
+
+	for panelFile in (args.genes, args.bed):
+		if panelFile and not os.path.isfile(panelFile):
+			print ('The panel file %s does not exist. Exiting.' % panelFile)
+			exit(1)
+
+	# reports only read the database
+	conn, cur = connectToDB(args.db, 'query')
+	panel = None
+
+	if (args.genes or args.bed) and not args.printsamples:
+		panel = (args.genes, args.bed)
+		loadPanel(cur, *panel)
+
+	if args.printsamples:
+		printSamplesInDB(cur)
+	elif args.sample:
+		sample, min_read, min_norm_read = args.sample
+		sampleSpecificJunctions(cur, sample, int(min_read), float(min_norm_read), compression, panel)
+	elif args.custom:
+		sample, min_read, min_norm_read, max_n_gtex_seen, max_total_gtex_reads = args.custom
+		customSampleSpecificJunctions(cur, sample, float(min_read), min_norm_read, max_n_gtex_seen, max_total_gtex_reads, compression, panel)
+	elif args.allPatients:
+		min_read, min_norm_read = args.allPatients
+		allPatientsSpecificJunctions(cur, int(min_read), float(min_norm_read), compression, args.processes, args.db, panel)
+	elif args.all:
+		printAllJunctions(cur, compression, panel)
+	elif args.region:
+		chromosome, start, stop = region
+		regionJunctions(cur, chromosome, start, stop, compression, panel)
+
+	conn.close()
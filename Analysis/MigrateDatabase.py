@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+import os
+import sqlite3
+import argparse
+from datetime import datetime
+from FilterSpliceJunctions import advisedIndexes
+from AddJunctionsToDatabase import connectToDB, initializeDB, schemaVersion, pendingSamples, hasRegionIndex, createRegionIndex, packedJunctionID, maxChromosomeID, maxJunctionStart, maxJunctionLength
+
+def checkJunctionsFit(cur):
+
+	"""
+	Checks every junction of the attached schema 1 database can be packed in to a schema 2 junction_id
+
+	Args:
+		cur, a cursor to a connection with the schema 1 database attached as OLD
+
+	Returns:
+	    None, exits if a junction or chromosome does not fit
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''select count(distinct chromosome) from OLD.JUNCTION_REF;''')
+	chromosomes = cur.fetchone()[0]
+
+	if chromosomes > maxChromosomeID:
+		print ('The database has junctions on %d chromosomes, schema 2 holds at most %d. Exiting.' % (chromosomes, maxChromosomeID))
+		exit(1)
+
+	cur.execute('''select chromosome, start, stop from OLD.JUNCTION_REF
+		where start < 0 or start > ? or stop < start or stop - start > ? limit 1;''', (maxJunctionStart, maxJunctionLength))
+	res = cur.fetchone()
+
+	if res:
+		print ('The junction %s:%s-%s cannot be packed in to a schema 2 junction_id. Exiting.' % res)
+		exit(1)
+
+def copyTables(cur):
+
+	"""
+	Copies every table of the attached schema 1 database in to the schema 2 tables made by initializeDB().
+	Samples keep their ROWID, so bam_ids do not change. Junctions get their packed junction_id, and
+	every table is filled in the order of its primary key, so its pages are written full and in order.
+
+	Args:
+		cur, a cursor to a connection to the schema 2 database with the schema 1 database attached as OLD
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''insert into SAMPLE_REF (ROWID, sample_name, type)
+		select ROWID, sample_name, type from OLD.SAMPLE_REF order by ROWID;''')
+
+	cur.execute('''insert into CHROMOSOME_REF (chromosome)
+		select distinct chromosome from OLD.JUNCTION_REF order by chromosome;''')
+
+	# the junction_id of every schema 1 ROWID
+	cur.execute('''create temp table JUNCTION_IDS (
+		old_id integer primary key,
+		junction_id integer not null);''')
+	cur.execute('''insert into JUNCTION_IDS (old_id, junction_id)
+		select r.ROWID, {junction_id}
+		from OLD.JUNCTION_REF r
+		inner join CHROMOSOME_REF k on k.chromosome = r.chromosome;'''.format(junction_id=packedJunctionID('k.chromosome_id', 'r.start', 'r.stop')))
+
+	cur.execute('''insert into JUNCTION_REF (junction_id, chromosome, gencode_annotation,
+		n_patients_seen, n_gtex_seen, total_patient_read_count, total_gtex_read_count, total_read_count)
+		select i.junction_id, r.chromosome, r.gencode_annotation,
+		r.n_patients_seen, r.n_gtex_seen, r.total_patient_read_count, r.total_gtex_read_count, r.total_read_count
+		from OLD.JUNCTION_REF r
+		inner join JUNCTION_IDS i on i.old_id = r.ROWID
+		order by i.junction_id;''')
+
+	cur.execute('''insert into JUNCTION_COUNTS (junction_id, bam_id, read_count, norm_read_count)
+		select i.junction_id, c.bam_id, c.read_count, c.norm_read_count
+		from OLD.JUNCTION_COUNTS c
+		inner join JUNCTION_IDS i on i.old_id = c.junction_id
+		order by i.junction_id, c.bam_id;''')
+
+	cur.execute('''insert into GENE_NAMES (gene) select distinct gene from OLD.GENE_REF order by gene;''')
+
+	cur.execute('''insert into JUNCTION_GENES (junction_id, gene_id)
+		select i.junction_id, n.gene_id
+		from OLD.GENE_REF g
+		inner join JUNCTION_IDS i on i.old_id = g.junction_id
+		inner join GENE_NAMES n on n.gene = g.gene
+		order by i.junction_id, n.gene_id;''')
+
+	cur.execute('''insert into TRANSCRIPT_MODEL_JUNCTIONS (chromosome, start, stop)
+		select chromosome, start, stop from OLD.TRANSCRIPT_MODEL_JUNCTIONS
+		order by chromosome, start, stop;''')
+	cur.execute('''create index if not exists stopJunction on TRANSCRIPT_MODEL_JUNCTIONS (chromosome, stop);''')
+
+	cur.execute('''drop table temp.JUNCTION_IDS;''')
+
+def countRows(cur, schema):
+
+	"""
+	Counts the rows of every table of a database, to check a migration copied everything
+
+	Args:
+		cur, a cursor to a connection to the database
+		schema, the name of the database in the connection, E.x. main or OLD
+
+	Returns:
+	    a list of (table, rows) tuples
+
+	Raises:
+	    None
+	"""
+
+	counts = []
+
+	for table in ('SAMPLE_REF', 'JUNCTION_REF', 'JUNCTION_COUNTS', 'GENE_REF', 'TRANSCRIPT_MODEL_JUNCTIONS'):
+		cur.execute('''select count(*) from {0}.{1};'''.format(schema, table))
+		counts.append((table, cur.fetchone()[0]))
+
+	return counts
+
+def migrateDatabase(source, destination):
+
+	"""
+	Converts a schema 1 splice junction database in to a new schema 2 database, see initializeDB().
+	The source database is only read. If the migration fails, delete the destination and run it again.
+	The indexes FilterSpliceJunctions.py --optimize made on the source are made on the destination too,
+	and the destination is analyzed, so its query plans do not fall back to full scans.
+
+	Args:
+		source, the path of a schema 1 database, E.x. SpliceJunction.db
+		destination, the path of the schema 2 database to write, which must not exist yet
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	if sqlite3.sqlite_version_info < (3, 31, 0):
+		print ('Schema 2 needs SQLite 3.31.0 or higher for generated columns, this sqlite3 library uses ' + sqlite3.sqlite_version + '. Exiting.')
+		exit(1)
+
+	if not os.path.isfile(source):
+		print ('The database %s does not exist. Exiting.' % source)
+		exit(1)
+
+	if os.path.exists(destination):
+		print ('%s already exists, remove it or choose another -out. Exiting.' % destination)
+		exit(1)
+
+	conn, cur = connectToDB(source, 'query')
+	schema = schemaVersion(cur)
+	regionIndex = hasRegionIndex(cur)
+	incomplete = sorted(pendingSamples(cur))
+	cur.execute('''select name from sqlite_master where type = 'index';''')
+	indexes = set(row[0] for row in cur.fetchall())
+	conn.close()
+
+	if schema != 1:
+		print ('%s already uses schema %d. Exiting.' % (source, schema))
+		exit(1)
+
+	if incomplete:
+		print ('%s has samples an --addBAM run did not finish storing, remove them with AddJunctionsToDatabase.py --delete -sample %s first. Exiting.' % (source, ' '.join(incomplete)))
+		exit(1)
+
+	print ('Started migrating %s to %s @ %s' % (source, destination, datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")))
+
+	initializeDB(destination, 2)
+
+	conn, cur = connectToDB(destination, 'ingest')
+
+	# nothing else uses the new database yet and a failed migration is simply run again,
+	# so it is written without a journal and turned back to WAL mode at the end
+	cur.execute('''PRAGMA journal_mode = OFF;''')
+	cur.execute('''PRAGMA synchronous = OFF;''')
+	cur.execute('''attach database ? as OLD;''', (source, ))
+
+	checkJunctionsFit(cur)
+
+	cur.execute('''begin;''')
+	copyTables(cur)
+	conn.commit()
+
+	before, after = countRows(cur, 'OLD'), countRows(cur, 'main')
+
+	cur.execute('''detach database OLD;''')
+
+	# the indexes and R*Tree FilterSpliceJunctions.py --optimize made are made again on the schema 2 tables,
+	# so an optimized database stays optimized
+	for name, index in advisedIndexes:
+		if name in indexes:
+			print ('Creating index %s @ %s' % (name, datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")))
+			cur.execute(index[2])
+			conn.commit()
+
+	if regionIndex:
+		createRegionIndex(cur)
+
+	cur.execute('''analyze;''')
+	conn.commit()
+
+	cur.execute('''PRAGMA journal_mode = WAL;''')
+	conn.close()
+
+	for (table, old), (table, new) in zip(before, after):
+		print ('%s\t%d rows\t%d rows' % (table, old, new))
+
+	if before != after:
+		print ('The number of rows in %s does not match %s, the migration failed' % (destination, source))
+		exit(1)
+
+	print ('%s: %.1f MB, %s: %.1f MB' % (source, os.path.getsize(source) / 1e6, destination, os.path.getsize(destination) / 1e6))
+	print ('Finished migrating @ ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+	print ('Replace %s with %s to use it' % (source, destination))
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Convert a SpliceJunction.db to schema 2, which keys junctions on a packed 64-bit junction_id, interns gene names and stores read counts in WITHOUT ROWID tables')
+	parser.add_argument('-db',help='The schema 1 database to convert, default=SpliceJunction.db',default='SpliceJunction.db')
+	parser.add_argument('-out',help='The schema 2 database to write, default=SpliceJunction.v2.db',default='SpliceJunction.v2.db')
+	args=parser.parse_args()
+
+	migrateDatabase(args.db, args.out)
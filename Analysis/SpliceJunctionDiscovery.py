@@ -1,49 +1,981 @@
 import sys
 import os
+import re
+import gzip
 import errno
+import json
+import hashlib
 import argparse
+import bisect
+import functools
+import tempfile
 import multiprocessing
-import subprocess
 from subprocess import Popen, PIPE
-from cigar import Cigar
 from datetime import datetime
+from TaskScheduling import runLargestFirst, partitionLargestFirst, readBamIndexStatistics, estimateRegionBytes, queryOverheadBytes, readBamReferences
+from DiscoveryCache import openDiscoveryCache, bamIdentity, regionKey, cachedRegions, storeResults, loadResults, importResults
 
-def run(cmd, dieOnError=True):
+try:
+	import pysam
+except ImportError:
+	pysam = None
+
+# per worker process state, set up once by initializeWorker()
+engine = 'samtools'
+alignmentFiles = {}
+bamFiles = []
+regions = []
+cwd = ''
+geneIndex = {}
+outputFormat = 'genefiles'
+compressOutput = False
+cachePath = 'discovery_cache.db'
+
+# describes the filters junctions are discovered with, cached results made with different filters are not reused.
+# Change this whenever the filters or CIGAR parsing change
+discoveryParameters = 'primary(flag<256);start<alignmentStart<stop;allIntrons;v2'
+
+# the number of bam indexes read to estimate the cost of each gene
+costSampleSize = 4
+
+cigarOperations = re.compile(r'(\d+)([MIDNSHP=X])')
+singleIntronCigar = re.compile(r'(\d+)M(\d+)N\d+M$') # the shape most spliced reads have, E.x. 37M1204N63M
+
+# width of the bins used by the gene interval index, 2^14 = 16384 bases like the BAI linear index
+geneIndexBinShift = 14
+
+def printSplices(path, spliceDicts):
+
+	"""
+	Prints junctions and their read counts to a specified file
+
+	This is a striped down version of Beryl Cummings' printSplices()
+
+	The file is written in full under a temporary name and then renamed, so rerunning after a killed
+	run replaces the file instead of appending duplicate lines to it.
+
+	Args:
+		path, the path to the output file
+		spliceDicts, a list of dictionaries containing junctions and their read counts
+			E.x. spliceDict[1:200-300] = 5
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	tempPath = path + ".tmp"
+
+	with open(tempPath, "w") as out:
+		for spliceDict in spliceDicts:
+			for key in spliceDict:
+				chrom, junctionStart, junctionEnd = key
+				timesSeenInSample = str(spliceDict[key])
+
+				out.write("\t".join([str(chrom),str(junctionStart),str(junctionEnd),timesSeenInSample])+"\n")
+
+	os.replace(tempPath, path)
+
+def sampleJunctionFilePath(cwd, bam, compress):
+
+	"""
+	Makes the path of the single junction file a sample's junctions are written to when
+	SpliceJunctionDiscovery.py is run with -output=sample
+
+	Args:
+		cwd, path to the current working directory
+		bam, the name of the sample's bam file
+		compress, True if the file is gzip compressed
+
+	Returns:
+	    the path to the file, E.x. /work/PATIENT/junctions.txt.gz
+
+	Raises:
+	    None
+	"""
+
+	return cwd + "/" + bam[:-4] + "/" + ("junctions.txt.gz" if compress else "junctions.txt")
+
+def writeSampleJunctionFile(path, rows, compress):
+
+	"""
+	Writes all of a sample's junctions to a single file, sorted by gene and then position:
+
+		E.x. junctions.txt
+			#gene	chromosome	start	stop	read_count
+			NPHS1	19	36336772	36337081	5
+			NPHS1	19	36337166	36337530	2
+
+	The file is written under a temporary name and then renamed, so a killed run never leaves
+	behind a partial file.
+
+	Args:
+		path, the path to the output file, made by sampleJunctionFilePath()
+		rows, an iterable of (gene, chrom, start, stop, readCount) tuples
+		compress, True to gzip the file
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	rows = sorted(rows, key=lambda row: (row[0], row[1], int(row[2]), int(row[3])))
+	tempPath = path + ".tmp"
+
+	with (gzip.open(tempPath, "wt", compresslevel=6) if compress else open(tempPath, "w")) as out:
+		out.write("#gene\tchromosome\tstart\tstop\tread_count\n")
+		out.writelines("\t".join([gene, str(chrom), str(start), str(stop), str(readCount)]) + "\n" for gene, chrom, start, stop, readCount in rows)
+
+	os.replace(tempPath, path)
+
+@functools.lru_cache(maxsize=1 << 16)
+def parseCIGARForIntrons(cigar):
+
+	"""
+	Parses a CIGAR string and returns the position of every intron in it relative to the
+	start of the alignment
+
+	RNA-seq libraries repeat a small set of CIGAR strings millions of times so results are cached.
+	The returned tuple is shared between callers and must not be modified.
+
+	The reference position is tracked the same way it always has been: 'M', 'D' and 'N' move it forward,
+	'I' moves it back, soft and hard clipping are ignored. Adding a pair to an alignment's start gives
+	the 5' and 3' splice sites of a junction.
+
+	Args:
+		cigar, a CIGAR string with at least one intron in it
+			E.x. cigar='3M1D40M20N10M5N8M'
+
+	Returns:
+	    a tuple of (junctionStart, junctionEnd) offsets, one for each intron in the read
+			E.x. ((44, 64), (74, 79))
+
+	Raises:
+	    Exception, if the CIGAR string has no intron in it
+	"""
+
+	simple = singleIntronCigar.match(cigar)
+
+	if simple:
+		position = int(simple.group(1))
+		return ((position, position + int(simple.group(2))), )
+
+	junctions = []
+	position = 0
+
+	for length, operation in cigarOperations.findall(cigar):
+		if operation == 'M' or operation == 'D':
+			position += int(length)
+		elif operation == 'N':
+			junctions.append((position, position + int(length)))
+			position += int(length)
+		elif operation == 'I':
+			position -= int(length)
+		## soft clipping is ignored
+		## hard clipping is ignored too
+
+	if not junctions:
+		raise Exception('No intron detected')
+
+	return tuple(junctions)
+
+def initializeWorker(discoveryEngine, workerBamFiles=None, workerRegions=None, workerCwd='', workerOutputFormat='genefiles', workerCompress=False, workerGeneIndex=None, workerCachePath='discovery_cache.db'):
+
+	"""
+	Sets up the state each worker process keeps for its lifetime. State shared by every task is sent
+	to each worker process once here instead of being pickled again for every task.
+
+	Args:
+		discoveryEngine, either 'pysam' or 'samtools'. Determines how alignments are read from bam files
+		workerBamFiles, a list of each bam file
+		workerRegions, a list of (gene, chrom, start, stop) tuples in transcript file order
+		workerCwd, path to the current working directory. This is used to create the path of a sample folder and a gene text file
+		workerOutputFormat, 'genefiles' to write a text file per gene per sample, 'sample' to write a single junction file per sample
+		workerCompress, True to gzip single sample junction files
+		workerGeneIndex, (optional) an interval index made by makeGeneIndex(). Only needed by bamDiscovery(), intronDiscovery() indexes the regions of each cluster itself
+		workerCachePath, the path to the result cache. Workers only read from it
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	global engine, alignmentFiles, bamFiles, regions, cwd, geneIndex, outputFormat, compressOutput, cachePath
+	engine = discoveryEngine
+	alignmentFiles = {}
+	bamFiles = workerBamFiles or []
+	regions = workerRegions or []
+	cwd = workerCwd
+	outputFormat = workerOutputFormat
+	compressOutput = workerCompress
+	geneIndex = workerGeneIndex or {}
+	cachePath = workerCachePath
+
+def getAlignmentFile(bam):
+
+	"""
+	Returns an open pysam handle to a bam file. Each bam file and its index is opened once
+	per worker process and then reused for every region query the worker runs.
+
+	Args:
+		bam, the name of a bam file in the current working directory
+
+	Returns:
+	    a pysam.AlignmentFile
+
+	Raises:
+	    None
+	"""
+
+	if bam not in alignmentFiles:
+		alignmentFiles[bam] = pysam.AlignmentFile(bam, "rb")
+
+	return alignmentFiles[bam]
+
+def samtoolsAlignments(bam, chrom, start, stop):
+
+	"""
+	Streams the spliced primary alignments of a region out of "samtools view" one line at a time,
+	so memory use does not depend on read depth.
+
+	Filters are pushed down to the reader: samtools itself drops secondary, supplementary, QC failed
+	and duplicate alignments (-F 0xF00, the same as flag >= 256) and lines are only split as far as
+	the CIGAR field. Unspliced alignments and alignments starting outside the region are skipped
+	before anything is decoded.
+
+	Args:
+		bam, the name of a bam file
+		chrom, start and stop, the region to query using 1-based inclusive coordinates. If start
+		and stop are None the whole chromosome is read
+
+	Returns:
+	    a generator of (alignmentStart, cigar) tuples, alignmentStart is 1-based
+
+	Raises:
+	    Exception, if samtools exits with an error
+	"""
+
+	if start is None:
+		region = chrom
+		lower, upper = 0, float('inf')
+	else:
+		region = ''.join([chrom, ':', start, '-', stop])
+		lower, upper = int(start), int(stop)
+
+	with tempfile.TemporaryFile() as stderr:
+
+		ps = Popen(['samtools', 'view', '-F', '0xF00', bam, region], stdout=PIPE, stderr=stderr)
+
+		try:
+			for line in ps.stdout:
+
+				elems = line.split(b'\t', 6)
+				cigar = elems[5]
+
+				if b'N' not in cigar:  	#only get introns
+					continue
+
+				alignmentStart = int(elems[3])
+
+				if not (lower < alignmentStart < upper):  	#check if alignment start is after known junction start but before known junction end
+					continue
+
+				yield alignmentStart, cigar.decode()
+		finally:
+			ps.stdout.close()
+
+			if ps.poll() is None:
+				ps.kill()
+
+		if ps.wait() != 0:
+			stderr.seek(0)
+			raise Exception(stderr.read().decode().strip())
+
+def pysamAlignments(bam, chrom, start, stop):
+
+	"""
+	Streams the spliced primary alignments of a region in-process using the worker's open handle
+	to the bam file. Yields the same alignments samtoolsAlignments() does.
+
+	The cheap integer checks (flag >= 256 and the region bounds) run before the CIGAR string is built.
+
+	Args:
+		bam, the name of a bam file
+		chrom, start and stop, the region to query using 1-based inclusive coordinates. If start
+		and stop are None the whole chromosome is read
+
+	Returns:
+	    a generator of (alignmentStart, cigar) tuples, alignmentStart is 1-based
+
+	Raises:
+	    Any exception raised while reading the bam file, E.x. ValueError for a contig which is not in its header
+	"""
+
+	if start is None:
+		reads = getAlignmentFile(bam).fetch(chrom)
+		lower, upper = 0, float('inf')
+	else:
+		reads = getAlignmentFile(bam).fetch(chrom, int(start) - 1, int(stop))
+		lower, upper = int(start), int(stop)
+
+	for read in reads:
+
+		if read.flag >= 256:  	#only primary alignments
+			continue
+
+		alignmentStart = read.reference_start + 1
+
+		if not (lower < alignmentStart < upper):  	#check if alignment start is after known junction start but before known junction end
+			continue
+
+		cigar = read.cigarstring
+
+		if cigar is None or 'N' not in cigar:  	#only get introns
+			continue
+
+		yield alignmentStart, cigar
+
+def readAlignments(bam, chrom, start, stop):
+
+	"""
+	Streams the spliced primary alignments of a region using the worker's discovery engine
+
+	Args:
+		bam, the name of a bam file
+		chrom, start and stop, the region to query. If start and stop are None the whole chromosome is read
+
+	Returns:
+	    a generator of (alignmentStart, cigar) tuples
+
+	Raises:
+	    Any exception raised while reading the bam file
+	"""
+
+	if engine == 'pysam':
+		return pysamAlignments(bam, chrom, start, stop)
+
+	return samtoolsAlignments(bam, chrom, start, stop)
+
+def countSplices(alignments, bam, chrom, start, stop):
+
+	"""
+	Counts the junctions reported by the spliced primary alignments in a region
+
+	Args:
+		alignments, an iterable of (alignmentStart, cigar) tuples which have already been
+		filtered by samtoolsAlignments() or pysamAlignments()
+		bam, the name of the bam file the alignments come from. Only used for error messages
+		chrom, start and stop, the region the alignments were queried from
+
+	Returns:
+	    spliceDict, a dictionary containing junctions and their read counts
+			E.x. spliceDict[('1', '200', '300')] = 5
+
+	Raises:
+	    None
+	"""
+
+	spliceDict = {}
+	pos = ''.join([chrom, ':', start, '-', stop])
+
+	for alignmentStart, cigar in alignments:
+
+		try:
+			junctions = parseCIGARForIntrons(cigar)
+		except Exception as e:
+			print ('Error message: ' + str(e))
+			print ('Error trying to parse CIGAR string: ' + cigar +  ' with the bam file ' + bam +  ' and the position: ' + pos + ' Skipping.')
+			continue
+
+		for junctionStart, junctionEnd in junctions:
+
+			# Beryl Cummings' Code, taken from makeUniqSpliceDict()
+			# uniqueSplice = ':'.join([chrom, str(junctionStart), str(junctionEnd)])
+			uniqueSplice = (chrom, str(alignmentStart + junctionStart), str(alignmentStart + junctionEnd))
+			
+			if uniqueSplice not in spliceDict:
+				spliceDict[uniqueSplice] = 1
+			else:
+				spliceDict[uniqueSplice] += 1
+
+	return spliceDict
+
+def discoverSplicesInRegion(bam, chrom, start, stop):
+
+	"""
+	Counts the junctions found in a region of a single bam file using the worker's discovery engine
+
+	Args:
+		bam, the name of a bam file
+		chrom, start and stop, the region to look for junctions in
+
+	Returns:
+	    spliceDict, a dictionary containing junctions and their read counts
+
+	Raises:
+	    Any exception raised while reading the bam file
+	"""
+
+	return countSplices(readAlignments(bam, chrom, start, stop), bam, chrom, start, stop)
+
+def makeGeneIndex(regions):
+
+	"""
+	Builds an interval index of gene regions used to assign alignments to every gene they fall in
+
+	Each chromosome is cut in to bins of 2^geneIndexBinShift bases. Every bin holds the regions
+	overlapping it, sorted by start, so finding the regions around a position is a single dictionary
+	lookup followed by a bisection.
+
+	Args:
+		regions, a list of (gene, chrom, start, stop) tuples in transcript file order
+
+	Returns:
+	    geneIndex, a dictionary keyed on chromosome. geneIndex[chrom][bin] is a tuple of
+	    (starts, regions) where regions is a list of (start, stop, regionNumber) tuples and
+	    regionNumber is the position of a region in the transcript file
+
+	Raises:
+	    None
+	"""
+
+	bins = {}
+
+	for regionNumber, (gene, chrom, start, stop) in enumerate(regions):
+
+		start = int(start)
+		stop = int(stop)
+
+		chromBins = bins.setdefault(chrom, {})
+
+		for b in range(start >> geneIndexBinShift, (stop >> geneIndexBinShift) + 1):
+			chromBins.setdefault(b, []).append((start, stop, regionNumber))
+
+	index = {}
+
+	for chrom in bins:
+
+		index[chrom] = {}
+
+		for b, binRegions in bins[chrom].items():
+			binRegions.sort()
+			index[chrom][b] = ([r[0] for r in binRegions], binRegions)
+
+	return index
+
+def regionsContaining(chromIndex, position):
+
+	"""
+	Finds every region in which an alignment starting at position would be counted by intronDiscovery(),
+	that is every region where start < position < stop
+
+	Args:
+		chromIndex, the part of an index made by makeGeneIndex() for a single chromosome
+		position, the 1-based start of an alignment
+
+	Returns:
+	    a list of regionNumbers
+
+	Raises:
+	    None
+	"""
+
+	entry = chromIndex.get(position >> geneIndexBinShift)
+
+	if not entry:
+		return []
+
+	starts, binRegions = entry
+
+	return [regionNumber for start, stop, regionNumber in binRegions[:bisect.bisect_left(starts, position)] if position < stop]
+
+def clusterRegions(tasks):
+
+	"""
+	Merges overlapping and nested gene regions in to clusters so each stretch of a chromosome
+	is only queried once in gene mode
+
+	Args:
+		tasks, a list of (gene, chrom, start, stop, bamNumbers) tuples made by planDiscovery()
+
+	Returns:
+	    clusters, a list of (genes, chrom, start, stop, members, bamNumbers) tuples. genes is a
+	    comma separated list of the genes in the cluster, start and stop span every member, members
+	    is a list of (gene, chrom, start, stop) tuples and bamNumbers is every bam file at least one
+	    member still has to be processed in
+
+	Raises:
+	    None
+	"""
+
+	clusters = []
+	byChrom = {}
+
+	for task in tasks:
+		byChrom.setdefault(task[1], []).append(task)
+
+	for chrom, chromTasks in byChrom.items():
+
+		chromTasks.sort(key=lambda task: (int(task[2]), int(task[3])))
+		current = []
+		currentStop = -1
+
+		for task in chromTasks:
+
+			if current and int(task[2]) > currentStop:
+				clusters.append(current)
+				current = []
+				currentStop = -1
+
+			current.append(task)
+			currentStop = max(currentStop, int(task[3]))
+
+		clusters.append(current)
+
+	merged = []
+
+	for cluster in clusters:
+
+		chrom = cluster[0][1]
+		start = min(int(task[2]) for task in cluster)
+		stop = max(int(task[3]) for task in cluster)
+		members = [task[:4] for task in cluster]
+		bamNumbers = tuple(sorted(set(bamNumber for task in cluster for bamNumber in task[4])))
+
+		merged.append((','.join(task[0] for task in cluster), chrom, str(start), str(stop), members, bamNumbers))
+
+	return merged
+
+def intronDiscovery(poolArguement):
+
+	"""
+	The function a worker process goes through. Counts the junctions in a cluster of overlapping gene
+	regions for each bam file that does not have cached results for all of them yet.
+
+	The span of the cluster is queried once per bam file and every spliced primary alignment is
+	assigned to each member region containing its start, which gives the same counts as querying
+	every member region on its own.
+
+	The worker does not write anything itself. It hands its results back to the parent process,
+	which stores them in the result cache. Gene text files and sample junction files are written
+	from the cache by writeSampleOutputs() once discovery is done.
+
+	Args:
+		poolArguement, the single argument for each worker process, which can be broken down
+		in to these components:
+
+			genes, the names of the genes in the cluster, used for progress messages
+			chrom, the chromosome the cluster lies on
+			start and stop, the span of the cluster in which alignments are looked for
+			members, a list of (gene, chrom, start, stop) tuples for each gene region in the cluster
+			bamNumbers, the positions of the bam files to process in the worker's list of bam files
+
+		The list of bam files is set once per worker by initializeWorker()
+
+	Returns:
+	    (results, readsRead, readsCounted), results is a list of (bamNumber, regionResults) tuples where
+	    regionResults is a list of (regionKey, spliceDict) tuples, one for each member. readsRead is the
+	    number of spliced primary alignments parsed and readsCounted the number a separate query per
+	    member would have parsed. Bam files which could not be read are left out so they are retried on the next run
+
+	Raises:
+	    None
+	"""
+
+	genes, chrom, start, stop, members, bamNumbers = poolArguement
+	results = []
+	readsRead = 0
+	readsCounted = 0
+
+	print ('processing ' + genes)
+
+	pos = ''.join([chrom, ':', start, '-', stop])
+	chromIndex = makeGeneIndex(members)[chrom]
+
+	for bamNumber in bamNumbers:
+
+		bam = bamFiles[bamNumber]
+		spliceDicts = [{} for member in members]
+		bamReadsRead = 0
+		bamReadsCounted = 0
+
+		try:
+			for alignmentStart, cigar in readAlignments(bam, chrom, start, stop):
+
+				regionNumbers = regionsContaining(chromIndex, alignmentStart)
+
+				if not regionNumbers:
+					continue
+
+				bamReadsRead += 1
+				bamReadsCounted += len(regionNumbers)
+
+				try:
+					junctions = parseCIGARForIntrons(cigar)
+				except Exception as e:
+					print ('Error message: ' + str(e))
+					print ('Error trying to parse CIGAR string: ' + cigar +  ' with the bam file ' + bam +  ' and the position: ' + pos + ' Skipping.')
+					continue
+
+				for junctionStart, junctionEnd in junctions:
+
+					# Beryl Cummings' Code, taken from makeUniqSpliceDict()
+					uniqueSplice = (chrom, str(alignmentStart + junctionStart), str(alignmentStart + junctionEnd))
+
+					for regionNumber in regionNumbers:
+
+						spliceDict = spliceDicts[regionNumber]
+
+						if uniqueSplice not in spliceDict:
+							spliceDict[uniqueSplice] = 1
+						else:
+							spliceDict[uniqueSplice] += 1
+
+		except Exception as e:
+			print ('Exception message: ' + str(e))
+			print ("Exception occured while reading " + bam + " for position " + pos + " Skipping.")
+			continue
+
+		readsRead += bamReadsRead
+		readsCounted += bamReadsCounted
+		results.append((bamNumber, [(regionKey(memberChrom, memberStart, memberStop), spliceDict) for (gene, memberChrom, memberStart, memberStop), spliceDict in zip(members, spliceDicts)]))
+
+	print ('finished ' + genes)
+
+	return results, readsRead, readsCounted
+
+def bamDiscovery(poolArguement):
+
+	"""
+	The function a worker process goes through in bam mode. Streams a single bam file from start
+	to end once and counts the same junctions intronDiscovery() would for every gene region.
+
+	Instead of querying every gene region, each spliced primary alignment is assigned to every gene
+	region containing its start using the worker's gene index. Chromosomes without any genes, or which
+	are not in the bam file's header, are never read.
+
+	Args:
+		poolArguement, the bam file the worker must process
+
+		The gene regions and their index are set once per worker by initializeWorker()
+
+	Returns:
+	    (bam, results), where results is a list of (regionKey, spliceDict) tuples. Regions on chromosomes
+	    which could not be read are left out so they are retried on the next run
+
+	Raises:
+	    None
+	"""
+
+	bam = poolArguement
+
+	print ('processing ' + bam)
+
+	spliceDicts = [{} for region in regions]
+	chroms = list(geneIndex)
+	failedChroms = set()
+
+	if engine == 'pysam':
+		# read chromosomes in the order they are stored in the bam file
+		order = {chrom: i for i, chrom in enumerate(getAlignmentFile(bam).references)}
+		chroms.sort(key=lambda chrom: order.get(chrom, len(order)))
+
+	# planDiscovery() has stored the regions of chromosomes the bam file does not have
+	references = bamReferences(bam)
+
+	if references is not None:
+		chroms = [chrom for chrom in chroms if chrom in references]
+
+	for chrom in chroms:
+
+		chromIndex = geneIndex[chrom]
+
+		try:
+			for alignmentStart, cigar in readAlignments(bam, chrom, None, None):
+
+				regionNumbers = regionsContaining(chromIndex, alignmentStart)
+
+				if not regionNumbers:
+					continue
+
+				try:
+					junctions = parseCIGARForIntrons(cigar)
+				except Exception as e:
+					print ('Error message: ' + str(e))
+					print ('Error trying to parse CIGAR string: ' + cigar +  ' with the bam file ' + bam +  ' and the chromosome: ' + chrom + ' Skipping.')
+					continue
+
+				for junctionStart, junctionEnd in junctions:
+
+					uniqueSplice = (chrom, str(alignmentStart + junctionStart), str(alignmentStart + junctionEnd))
+
+					for regionNumber in regionNumbers:
+
+						spliceDict = spliceDicts[regionNumber]
+
+						if uniqueSplice not in spliceDict:
+							spliceDict[uniqueSplice] = 1
+						else:
+							spliceDict[uniqueSplice] += 1
+
+		except Exception as e:
+			print ('Exception message: ' + str(e))
+			print ("Exception occured while reading " + bam + " for chromosome " + chrom + " Skipping.")
+			failedChroms.add(chrom)
+			continue
+
+	results = {}
+
+	for (gene, chrom, start, stop), spliceDict in zip(regions, spliceDicts):
+		if chrom not in failedChroms:
+			results[regionKey(chrom, start, stop)] = spliceDict
+
+	print ('finished ' + bam)
+
+	return bam, list(results.items())
+
+def writeSampleOutputs(poolArguement):
+
+	"""
+	Writes a sample's gene text files or single junction file from the result cache. Every file
+	is written in full and renamed in to place.
+
+	Once the outputs are written a marker file is left in the sample folder. If the bam file, the
+	gene regions and the output format are unchanged on the next run, the sample's outputs are not written again.
+
+	Args:
+		poolArguement, a (bam, bamKey) tuple
+
+		The gene regions, output format and the path to the cache are set once per worker by initializeWorker()
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	bam, bamKey = poolArguement
+
+	markerPath = cwd + "/" + bam[:-4] + "/.discovery_complete"
+	marker = outputMarker(bamKey)
+
+	if os.path.isfile(markerPath):
+		with open(markerPath) as mf:
+			if mf.read() == marker:
+				return
+
+	conn = openDiscoveryCache(cachePath, create=False)
+	results = loadResults(conn, bamKey, discoveryParameters)
+	conn.close()
+
+	geneDicts = {}
+	missing = 0
+
+	for gene, chrom, start, stop in regions:
+
+		spliceDict = results.get(regionKey(chrom, start, stop))
+
+		if spliceDict is None:
+			missing += 1
+		elif spliceDict:
+			geneDicts.setdefault(gene, []).append(spliceDict)
+
+	if outputFormat == 'sample':
+		rows = []
+
+		for gene in geneDicts:
+			for spliceDict in geneDicts[gene]:
+				for (junctionChrom, junctionStart, junctionEnd), readCount in spliceDict.items():
+					rows.append((gene, junctionChrom, junctionStart, junctionEnd, readCount))
+
+		writeSampleJunctionFile(sampleJunctionFilePath(cwd, bam, compressOutput), rows, compressOutput)
+	else:
+		for gene in geneDicts:
+			printSplices(cwd + "/" + bam[:-4] + "/" + gene + ".txt", geneDicts[gene])
+
+	if missing:
+		print ('Warning: ' + str(missing) + ' gene regions could not be read from ' + bam + '. Rerun SpliceJunctionDiscovery.py to retry them.')
+	else:
+		with open(markerPath, "w") as mf:
+			mf.write(marker)
+
+def makeBamListAndDirectories(bamList):
+
+	"""
+	Makes a list of bam files for each worker process to use and
+	the directories in which each gene file will reside in
+
+	Args:
+		bamList, text file containing the names of all .bam files
+		each on a seperate line
+
+	Returns:
+	    bamFiles, a list of bamFiles to be processed
+
+	Raises:
+	    None
+	"""
+
+	bamFiles = []
+
+	with open(bamList) as bl:
+		for i in bl:
+
+			i = i.strip()
+
+			bamLocation = os.getcwd() + '/' + i
+			if not os.path.isfile(bamLocation):
+				print ('bam file: ' + i + ' does not exist in CWD! Skipping.')
+				continue
+
+			outputDirectory = bamLocation[:-4]
+
+			os.makedirs(outputDirectory, exist_ok=True)
+			bamFiles.append(i)
+
+	return bamFiles
+
+def outputMarker(bamKey):
+
+	"""
+	Describes the outputs written for a sample, used to tell whether they need to be written again
+
+	Args:
+		bamKey, a key made by bamIdentity()
+
+	Returns:
+	    a string
+
+	Raises:
+	    None
+	"""
+
+	return '\t'.join([bamKey, discoveryParameters, regionsDigest(regions), outputFormat, str(compressOutput)]) + '\n'
+
+def regionsDigest(regions):
+
+	"""
+	Makes a key identifying a list of gene regions
+
+	Args:
+		regions, a list of (gene, chrom, start, stop) tuples
+
+	Returns:
+	    a hex string
+
+	Raises:
+	    None
+	"""
+
+	return hashlib.sha1('\n'.join('\t'.join(region) for region in regions).encode()).hexdigest()
+
+def planDiscovery(bamFiles, regions, cache, checksum):
 
 	"""
-	Runs a single subprocess in the background. Used to execute simple bash commands like cat *.txt
+	Finds the work that is not in the result cache yet
 
-	run() was taken from Andy and modified:
-	http://jura.wi.mit.edu/bio/education/hot_topics/python_pipelines_2014/python_pipelines_2014.pdf
-	https://stackoverflow.com/questions/13398261/python-subprocess-call-and-subprocess-popen-stdout
+	Regions on a chromosome which is not in the header of a bam file cannot be queried in it, samtools
+	and pysam both fail on them. They are stored in the cache without junctions instead, with a warning 
+	for each chromosome, so they are not retried on every run and the sample's outputs can be completed
 
 	Args:
-		cmd, the terminal command to run
-		dieOnError, used to detect errors
+		bamFiles, a list of bam files
+		regions, a list of (gene, chrom, start, stop) tuples in transcript file order
+		cache, a connection to the result cache
+		checksum, True to identify bam files by the SHA-1 of their contents
 
 	Returns:
-	    (exitcode, stdout, stderr), tuple containing the results of the subprocess' execution
+	    (bamKeys, missing), bamKeys is a list with a key for each bam file. missing is a list of
+	    (gene, chrom, start, stop, bamNumbers) tuples, one for each distinct region that still has
+	    to be processed in at least one bam file
 
 	Raises:
 	    None
 	"""
 
-	ps = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-	exitcode = ps.returncode
-	stdout,stderr = ps.communicate()
-	return exitcode, stdout, stderr
+	bamKeys = [bamIdentity(bam, checksum) for bam in bamFiles]
+	done = [cachedRegions(cache, bamKey, discoveryParameters) for bamKey in bamKeys]
+	references = {}
+
+	missing = []
+	absent = []
+	absentChroms = {}
+	seen = set()
+
+	for gene, chrom, start, stop in regions:
+
+		key = regionKey(chrom, start, stop)
+
+		if key in seen:
+			continue
+
+		seen.add(key)
+		bamNumbers = tuple(bamNumber for bamNumber in range(len(bamFiles)) if key not in done[bamNumber])
+
+		for bamNumber in bamNumbers:
+			if bamNumber not in references:
+				references[bamNumber] = bamReferences(bamFiles[bamNumber])
+
+		absentNumbers = [bamNumber for bamNumber in bamNumbers if references[bamNumber] is not None and chrom not in references[bamNumber]]
+
+		if absentNumbers:
+			absent += [(bamKeys[bamNumber], key, {}) for bamNumber in absentNumbers]
+			absentChroms.setdefault(chrom, set()).update(absentNumbers)
+			bamNumbers = tuple(bamNumber for bamNumber in bamNumbers if bamNumber not in absentNumbers)
+
+		if bamNumbers:
+			missing.append((gene, chrom, start, stop, bamNumbers))
+
+	pairs = len(seen) * len(bamFiles)
+	cached = pairs - sum(len(task[4]) for task in missing) - len(absent)
+	print ('%d of %d (gene region, bam file) pairs found in the result cache' % (cached, pairs))
+
+	for chrom in sorted(absentChroms):
+		print ('Warning: chromosome ' + chrom + ' is not in the header of ' + ', '.join(bamFiles[bamNumber] for bamNumber in sorted(absentChroms[chrom])) + '. Its gene regions are stored without junctions for these bam files.')
+
+	if absent:
+		storeResults(cache, discoveryParameters, absent)
+
+	return bamKeys, missing
+
+def bamReferences(bam):
+
+	"""
+	Reads the chromosomes in the header of a bam file
+
+	Args:
+		bam, the name of a bam file
 
-def printSplices(path, spliceDict):
+	Returns:
+	    a set of chromosome names, or None if the header could not be read, in which case every region
+	    is queried and a failure is retried on the next run
 
+	Raises:
+	    None
 	"""
-	Prints junctions and their read counts to a specified file
 
-	This is a striped down version of Beryl Cummings' printSplices()
+	try:
+		return set(readBamReferences(bam))
+	except Exception as e:
+		print ('Could not read the header of ' + bam + ': ' + str(e))
+		return None
+
+def writeOutputs(pool, bamFiles, bamKeys):
+
+	"""
+	Writes every sample's outputs from the result cache using the worker processes
 
 	Args:
-		path, the path to the output file
-		spliceDict, a dictionary containing junctions and their read counts
-			E.x. spliceDict[1:200-300] = 5
+		pool, a multiprocessing pool set up by initializeWorker()
+		bamFiles, a list of bam files
+		bamKeys, a key for each bam file made by bamIdentity()
 
 	Returns:
 	    None
@@ -52,203 +984,427 @@ def printSplices(path, spliceDict):
 	    None
 	"""
 
-	for key in spliceDict:
-		chrom, junctionStart, junctionEnd = key
-		timesSeenInSample = str(spliceDict[key])
+	for finished in pool.imap_unordered(writeSampleOutputs, list(zip(bamFiles, bamKeys)), chunksize=1):
+		pass
 
-		with open(path, "a") as out:
-			out.write("\t".join([str(chrom),str(junctionStart),str(junctionEnd),timesSeenInSample])+"\n")
+def estimateGeneCosts(geneRegions, bamFiles):
 
-def parseCIGARForIntrons(cigar):
+	"""
+	Estimates how long each gene takes to process. The amount of compressed alignment data in a gene's
+	region is read from the indexes of a few bam files. If no bam index can be read, the length of the
+	region is used instead.
+
+	Args:
+		geneRegions, a list of tuples starting with (gene, chrom, start, stop)
+		bamFiles, a list of bam files
+
+	Returns:
+	    a list of estimated costs, one for each region
+
+	Raises:
+	    None
+	"""
+
+	statistics = []
+
+	for bam in bamFiles:
+
+		if len(statistics) >= costSampleSize:
+			break
+
+		bamStatistics = readBamIndexStatistics(bam)
+
+		if bamStatistics:
+			statistics.append(bamStatistics)
+
+	if not statistics:
+		return [int(region[3]) - int(region[2]) for region in geneRegions]
+
+	return [sum(estimateRegionBytes(bamStatistics, region[1], region[2], region[3]) for bamStatistics in statistics) for region in geneRegions]
+
+def readTranscriptFile(transcriptFile):
 
 	"""
-	Parses a CIGAR string and returns values which can used to determine an intron's
-	3' and 5' splice sites
+	Reads the gene regions of a transcript file
 
 	Args:
-		cigar, a CIGAR string with an intron in it
-			E.x. cigar='3M1D40M20N'
+		transcriptFile, path to a file which contains a list of genes and locations of investigation
 
 	Returns:
-	    offset, a figure which accomodates for insertion and deletion events to adjust
-	    an alignment's positions back to the reference genome
+	    regions, a list of (gene, chrom, start, stop) tuples in file order
+
+	Raises:
+	    None
+	"""
+
+	regions = []
+
+	with open(transcriptFile) as tf:
+		for line in tf:
 
-	    matchedExon, a figure to be added to the start position of an alignment which
-	    forms the 5' end of a splice site. This function only considers 'M''s before 
-	    an intron (N) for this figure.
+			elems = line.strip().split()
+			try:
+				gene, gene2, plus, chrom, start, stop, gene_type = elems #edit the transcript file so that you only deal with junction coordinates
+			except Exception as e:
+				print ('Error while parsing transcript file named: ' + str(transcriptFile) + "\n" + 'Error message: ' + str(e) + "\nExiting.")
+				exit (3)
+
+			regions.append((gene, chrom, start, stop))
+
+	return regions
+
+def processGenesInParallel(transcriptFile, bamList, numProcesses, discoveryEngine='samtools', output='genefiles', compress=False, cache='discovery_cache.db', checksum=False):
+
+	"""
+	Sets up the parameters for each worker process and then runs them.
+
+	(gene region, bam file) pairs which are already in the result cache are skipped. The remaining gene
+	regions are merged in to clusters of overlapping regions by clusterRegions() so reads shared by
+	overlapping and nested genes are only fetched and parsed once. Results returned
+	by workers are stored in the cache as each cluster finishes, so a killed run loses at most the clusters
+	in progress. Outputs are then written from the cache.
+
+	Args:
+		transcriptFile, path to a file which contains a list of genes and locations of investigation
+		bamList, a list of bam files you want to discover splice sites in
+		numProcesses, the number of worker processes to run at a given time
+		discoveryEngine, 'pysam' to read bam files in-process or 'samtools' to spawn "samtools view" for each query
+		output, 'genefiles' or 'sample'
+		compress, True to gzip single sample junction files
+		cache, path to the result cache
+		checksum, True to identify bam files in the cache by the SHA-1 of their contents
 
-		intronLength, the length of an intron as reported by the CIGAR string. This figure
-		is added with matchedExon and the start of an alignment to produce the position of
-		the 3' end of a splice site.
+	Returns:
+	    None
 
 	Raises:
 	    None
 	"""
 
-	if 'N' in cigar:
-		cigar = cigar.split('N')[0] + 'N' #remove all information after intron
-	else:
-		raise Exception('No intron detected')
+	cwd = os.getcwd()
+	bamFiles = makeBamListAndDirectories(bamList)
+	regions = readTranscriptFile(transcriptFile)
 
-	offset = 0
-	matchedExon = 0
-	intronLength = 0
-	
-	for c in list(Cigar(cigar).items()): # returns list of tuples : [(20, 'N')]
-		if c[1] == 'N':
-			intronLength += int(c[0])
-		elif c[1] == 'D':
-			offset += int(c[0])
-		elif c[1] == 'I':
-			offset -= int(c[0])
-		elif c[1] == 'M':
-			matchedExon += int(c[0])
-		## soft clipping is ignored
-		## hard clipping is ignored too
+	resultCache = openDiscoveryCache(cache)
+	bamKeys, missing = planDiscovery(bamFiles, regions, resultCache, checksum)
+	poolArguements = clusterRegions(missing)
+	costs = [cost * len(task[5]) for cost, task in zip(estimateGeneCosts(poolArguements, bamFiles), poolArguements)]
 
-	return offset, matchedExon, intronLength
+	regionBases = sum((int(task[3]) - int(task[2]) + 1) * len(task[4]) for task in missing)
+	clusterBases = sum((int(task[3]) - int(task[2]) + 1) * len(task[5]) for task in poolArguements)
+	print ('Merged %d gene regions in to %d clusters, querying %d instead of %d bases across all bam files' % (len(missing), len(poolArguements), clusterBases, regionBases))
 
-def intronDiscovery(poolArguement):
+	print ("Creating a pool with " + str(numProcesses) + " processes")
+	pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(discoveryEngine, bamFiles, regions, cwd, output, compress, None, cache), processes=int(numProcesses))
+	print ('pool: ' + str(pool))
+
+	totalReadsRead = 0
+	totalReadsCounted = 0
+
+	for results, readsRead, readsCounted in runLargestFirst(pool, intronDiscovery, poolArguements, costs): # run the worker processes, largest clusters first
+		storeResults(resultCache, discoveryParameters, [(bamKeys[bamNumber], region, spliceDict) for bamNumber, regionResults in results for region, spliceDict in regionResults])
+		totalReadsRead += readsRead
+		totalReadsCounted += readsCounted
 
+	resultCache.close()
+
+	print ('Parsed %d spliced alignments, querying each gene region separately would have parsed %d' % (totalReadsRead, totalReadsCounted))
+
+	writeOutputs(pool, bamFiles, bamKeys)
+	pool.close()
+	pool.join()
+
+def processBamsInParallel(transcriptFile, bamList, numProcesses, discoveryEngine='samtools', output='genefiles', compress=False, cache='discovery_cache.db', checksum=False):
+
+	"""
+	Sets up the parameters for bam mode, where each worker process reads a whole bam file once, and then runs them.
+
+	Bam files with every gene region in the result cache are skipped.
+
+	Args:
+		transcriptFile, path to a file which contains a list of genes and locations of investigation
+		bamList, a list of bam files you want to discover splice sites in
+		numProcesses, the number of worker processes to run at a given time
+		discoveryEngine, 'pysam' to read bam files in-process or 'samtools' to stream "samtools view" output
+		output, 'genefiles' or 'sample'
+		compress, True to gzip single sample junction files
+		cache, path to the result cache
+		checksum, True to identify bam files in the cache by the SHA-1 of their contents
+
+	Returns:
+	    None
+
+	Raises:
+	    None
 	"""
-	The function a worker process goes through. Produces a file containing junction
-	positions and their read counts for each gene:
 
-		E.x. NPHS1.txt
-			1	200	300	5
-			1	344	355	2
+	cwd = os.getcwd()
+	bamFiles = makeBamListAndDirectories(bamList)
+	regions = readTranscriptFile(transcriptFile)
+	workerGeneIndex = makeGeneIndex(regions)
+
+	resultCache = openDiscoveryCache(cache)
+	bamKeys, missing = planDiscovery(bamFiles, regions, resultCache, checksum)
+
+	bamNumbers = sorted(set(bamNumber for task in missing for bamNumber in task[4]))
+	poolArguements = [bamFiles[bamNumber] for bamNumber in bamNumbers]
+	costs = [os.path.getsize(bam) for bam in poolArguements]
+
+	print ("Creating a pool with " + str(numProcesses) + " processes")
+	pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(discoveryEngine, bamFiles, regions, cwd, output, compress, workerGeneIndex, cache), processes=int(numProcesses))
+	print ('pool: ' + str(pool))
+
+	for bam, results in runLargestFirst(pool, bamDiscovery, poolArguements, costs): # run the worker processes, largest bam files first
+		bamKey = bamKeys[bamFiles.index(bam)]
+		storeResults(resultCache, discoveryParameters, [(bamKey, region, spliceDict) for region, spliceDict in results])
+
+	resultCache.close()
+
+	writeOutputs(pool, bamFiles, bamKeys)
+	pool.close()
+	pool.join()
+
+def shardCachePath(cache, shard):
 
-	Each worker is assigned a single gene region to work on. The worker loops through each BAM file,
-	counts the number of alignments and produces a single gene text file in the corresponding BAM folder. 
+	"""
+	Makes the path of the result cache a single shard writes to, E.x. discovery_cache.shard3.db
 
 	Args:
-		poolArguement, the single argument for each worker process, which can be broken down
-		in to these components:
+		cache, path to the result cache
+		shard, the index of the shard
+
+	Returns:
+	    a path
+
+	Raises:
+	    None
+	"""
+
+	root, ext = os.path.splitext(cache)
+
+	return root + '.shard' + str(shard) + (ext or '.db')
+
+def planDigest(planPath):
 
-			bamFiles, a list of each bam file, this is used to access the corresponding sample folder
-			gene, the gene the worker must process
-			chrom, the chromosome the gene lies on
-			start and stop, the 3' and 5' locations on a chromosome in which samtools should begin looking for alignments in
-			cwd, path to the current working directory. This is used to create the path of a sample folder and a gene text file
+	"""
+	Makes a key identifying a shard plan, written in to the marker of every finished shard so
+	shards of an older plan are not merged by mistake
+
+	Args:
+		planPath, path to a shard plan
 
 	Returns:
+	    a hex string
+
+	Raises:
 	    None
+	"""
+
+	with open(planPath, "rb") as pf:
+		return hashlib.sha1(pf.read()).hexdigest()
+
+def readShardPlan(planPath):
+
+	"""
+	Reads a shard plan written by writeShardPlan()
+
+	Args:
+		planPath, path to a shard plan
+
+	Returns:
+	    the plan as a dictionary
 
 	Raises:
 	    None
 	"""
 
-	bamFiles, gene, chrom, start, stop, cwd = poolArguement
+	try:
+		with open(planPath) as pf:
+			plan = json.load(pf)
+	except Exception as e:
+		print ('Error while reading shard plan: ' + planPath + "\n" + 'Error message: ' + str(e) + "\nExiting.")
+		exit (3)
 
-	print ('processing ' + gene)
+	if plan['parameters'] != discoveryParameters:
+		print ('The shard plan ' + planPath + ' was made by a different version of SpliceJunctionDiscovery.py. Write a new plan. Exiting.')
+		exit (3)
 
-	pos = ''.join([chrom, ':', start, '-', stop])
+	return plan
 
-	for bam in bamFiles:
+def writeShardPlan(transcriptFile, bamList, numShards, planPath, cache='discovery_cache.db', checksum=False):
 
-		spliceDict = {}
-		geneFilePath = (cwd + "/" + bam[:-4] + "/" + gene + ".txt")
+	"""
+	Splits the (gene region, bam file) pairs which are not in the result cache in to shards that can
+	each be run on a separate node, E.x. as a PBS or Slurm array job, with runShard().
 
-		try:
-			exitcode, stdout, stderr = run(' '.join(['samtools view', bam, pos]))
-		except Exception as e:
-			print ('Exception message: ' + str(e))
-			print ("Exception occured while running \"samtools view\" on " + bam + " for position " + pos + " Skipping.")
-			continue
+	Overlapping gene regions are merged in to clusters by clusterRegions(). Every (cluster, bam file)
+	pair is costed by the amount of compressed alignment data in the cluster's span, read from that
+	bam file's index, plus queryOverheadBytes for the query itself, and pairs are split in to shards of about equal cost by partitionLargestFirst().
+	If any bam index cannot be read the length of the span is used instead. The plan is deterministic,
+	so writing it again from the same inputs gives the same file.
 
-		if not stdout:
-			#print ('No introns found for ' + gene + ' at ' + pos + ' in ' + bam)
-			continue
+	Args:
+		transcriptFile, path to a file which contains a list of genes and locations of investigation
+		bamList, a list of bam files you want to discover splice sites in
+		numShards, the number of shards to split the work in to
+		planPath, path to write the plan to, as JSON
+		cache, path to the result cache. Work already in it is left out of the plan
+		checksum, True to identify bam files in the cache by the SHA-1 of their contents
 
-		for line in stdout.splitlines():
+	Returns:
+	    None
 
-			elems = line.decode().split()
+	Raises:
+	    None
+	"""
 
-			alignmentStart = int(elems[3])
-			cigar = str(elems[5])
-			alignmentScore = int(elems[1])
- 
-			if 'N' not in cigar:  	#only get introns
-				continue
+	bamFiles = makeBamListAndDirectories(bamList)
+	regions = readTranscriptFile(transcriptFile)
 
-			if (alignmentScore >= 256):  	#only primary alignments
-				continue
+	resultCache = openDiscoveryCache(cache)
+	bamKeys, missing = planDiscovery(bamFiles, regions, resultCache, checksum)
+	resultCache.close()
 
-			if not ((alignmentStart > int(start)) and (alignmentStart < int(stop))):  	#check if alignment start is after known junction start but before known junction end 
-				continue
+	clusters = clusterRegions(missing)
+	statistics = [readBamIndexStatistics(bam) for bam in bamFiles]
 
-			try:
-				offset, matchedExon, intronLength = parseCIGARForIntrons(cigar)
-			except Exception as e:
-				print ('Error message: ' + str(e))
-				print ('Error trying to parse CIGAR string: ' + cigar +  ' with the bam file ' + bam +  ' and the position: ' + pos + ' Skipping.')
-				continue
+	units = []
+	costs = []
 
-			junctionStart = alignmentStart + matchedExon + offset
-			junctionEnd = junctionStart + intronLength
+	for clusterNumber, (genes, chrom, start, stop, members, bamNumbers) in enumerate(clusters):
+		for bamNumber in bamNumbers:
 
-			# Beryl Cummings' Code, taken from makeUniqSpliceDict()
-			# uniqueSplice = ':'.join([chrom, str(junctionStart), str(junctionEnd)])
-			uniqueSplice = (chrom, str(junctionStart), str(junctionEnd))
-			
-			if uniqueSplice not in spliceDict:
-				spliceDict[uniqueSplice] = 1
+			units.append((clusterNumber, bamNumber))
+
+			if all(statistics):
+				costs.append(estimateRegionBytes(statistics[bamNumber], chrom, start, stop) + queryOverheadBytes)
 			else:
-				spliceDict[uniqueSplice] += 1
+				costs.append(int(stop) - int(start) + 1)
 
-		del stdout # saves ram in between samtool calls
+	shardUnits, totals = partitionLargestFirst(costs, numShards)
+	shards = []
 
-		if spliceDict:
-			printSplices(geneFilePath, spliceDict)
-			del spliceDict
+	for shard, unitNumbers in enumerate(shardUnits):
 
-	print ('finished ' + gene)
+		shardBams = {}
 
-def makeBamListAndDirectories(bamList):
+		for unitNumber in unitNumbers:
+			clusterNumber, bamNumber = units[unitNumber]
+			shardBams.setdefault(clusterNumber, []).append(bamNumber)
+
+		tasks = [list(clusters[clusterNumber][:5]) + [shardBams[clusterNumber]] for clusterNumber in sorted(shardBams)]
+		shards.append({'cost': totals[shard], 'tasks': tasks})
+
+		print ('shard %d: %d (cluster, bam file) pairs, estimated cost %d' % (shard, len(unitNumbers), totals[shard]))
+
+	plan = {
+		'parameters': discoveryParameters,
+		'transcript_file': os.path.abspath(transcriptFile),
+		'regions': regionsDigest(regions),
+		'checksum': checksum,
+		'bam_files': bamFiles,
+		'bam_keys': bamKeys,
+		'shards': shards}
+
+	with open(planPath + '.tmp', "w") as pf:
+		json.dump(plan, pf, indent=1, sort_keys=True)
+
+	os.replace(planPath + '.tmp', planPath)
+
+	print ('Wrote a plan for %d shards to %s. Run each with -shard=N, then combine them with --merge' % (numShards, planPath))
+
+def runShard(planPath, shard, numProcesses, discoveryEngine='samtools', cache='discovery_cache.db'):
 
 	"""
-	Makes a list of bam files for each worker process to use and
-	the directories in which each gene file will reside in
+	Runs a single shard of a plan written by writeShardPlan(). Results are stored in the shard's own
+	result cache, see shardCachePath(), so shards running at the same time never write to the same database.
+	Rerunning a shard skips the work already in its cache.
+
+	Once every task of the shard has been stored a marker file is written next to the shard's cache.
+	mergeShards() only merges shards with a marker.
 
 	Args:
-		bamList, text file containing the names of all .bam files
-		each on a seperate line
+		planPath, path to a shard plan
+		shard, the index of the shard to run
+		numProcesses, the number of worker processes to run at a given time
+		discoveryEngine, 'pysam' to read bam files in-process or 'samtools' to spawn "samtools view" for each query
+		cache, path to the main result cache, used to name the shard's cache
 
 	Returns:
-	    bamFiles, a list of bamFiles to be processed
+	    None
 
 	Raises:
 	    None
 	"""
 
-	bamFiles = []
+	plan = readShardPlan(planPath)
 
-	with open(bamList) as bl:
-		for i in bl:
+	if not 0 <= shard < len(plan['shards']):
+		print ('The shard plan ' + planPath + ' has ' + str(len(plan['shards'])) + ' shards, there is no shard ' + str(shard) + '. Exiting.')
+		exit (3)
 
-			i = i.strip()
+	bamFiles = plan['bam_files']
+	bamKeys = plan['bam_keys']
 
-			bamLocation = os.getcwd() + '/' + i
-			if not os.path.isfile(bamLocation):
-				print ('bam file: ' + i + ' does not exist in CWD! Skipping.')
-				continue
+	for bam, bamKey in zip(bamFiles, bamKeys):
+		if bamIdentity(bam, plan['checksum']) != bamKey:
+			print ('bam file: ' + bam + ' has changed since the shard plan was written. Write a new plan. Exiting.')
+			exit (3)
 
-			outputDirectory = bamLocation[:-4]
+	path = shardCachePath(cache, shard)
+	resultCache = openDiscoveryCache(path)
+	done = [cachedRegions(resultCache, bamKey, discoveryParameters) for bamKey in bamKeys]
 
-			os.system("mkdir " + outputDirectory)
-			bamFiles.append(i)
+	poolArguements = []
+	expected = 0
 
-	return bamFiles
+	for genes, chrom, start, stop, members, bamNumbers in plan['shards'][shard]['tasks']:
+
+		members = [tuple(member) for member in members]
+		keys = [regionKey(member[1], member[2], member[3]) for member in members]
+		bamNumbers = tuple(bamNumber for bamNumber in bamNumbers if not all(key in done[bamNumber] for key in keys))
+
+		if bamNumbers:
+			poolArguements.append((genes, chrom, start, stop, members, bamNumbers))
+			expected += len(bamNumbers)
+
+	costs = [cost * len(task[5]) for cost, task in zip(estimateGeneCosts(poolArguements, bamFiles), poolArguements)]
+
+	print ('Running shard ' + str(shard) + ' of ' + str(len(plan['shards'])) + ', ' + str(expected) + ' (cluster, bam file) pairs left')
+	pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(discoveryEngine, bamFiles), processes=int(numProcesses))
+
+	finished = 0
+
+	for results, readsRead, readsCounted in runLargestFirst(pool, intronDiscovery, poolArguements, costs):
+		storeResults(resultCache, discoveryParameters, [(bamKeys[bamNumber], region, spliceDict) for bamNumber, regionResults in results for region, spliceDict in regionResults])
+		finished += len(results)
+
+	pool.close()
+	pool.join()
+	resultCache.close()
+
+	if finished < expected:
+		print ('Warning: ' + str(expected - finished) + ' (cluster, bam file) pairs could not be read. Rerun this shard to retry them.')
+		exit (1)
+
+	with open(path + '.done', "w") as mf:
+		mf.write(planDigest(planPath) + '\n')
+
+	print ('Shard ' + str(shard) + ' finished')
 
-def processGenesInParallel(transcriptFile, bamList, numProcesses):
+def mergeShards(planPath, numProcesses, discoveryEngine='samtools', output='genefiles', compress=False, cache='discovery_cache.db'):
 
 	"""
-	Sets up the parameters for each worker process and then runs them.
+	Checks that every shard of a plan has finished, imports their results in to the main result cache
+	and writes every sample's outputs from it. The outputs are the same as those of a single node run.
 
 	Args:
-		transcriptFile, path to a file which contains a list of genes and locations of investigation
-		bamList, a list of bam files you want to discover splice sites in
-		numProcesses, the number of worker processes to run at a given time
+		planPath, path to a shard plan
+		numProcesses, the number of worker processes used to write outputs
+		discoveryEngine, passed on to the worker processes
+		output, 'genefiles' or 'sample'
+		compress, True to gzip single sample junction files
+		cache, path to the main result cache
 
 	Returns:
 	    None
@@ -257,30 +1413,54 @@ def processGenesInParallel(transcriptFile, bamList, numProcesses):
 	    None
 	"""
 
+	plan = readShardPlan(planPath)
+	digest = planDigest(planPath) + '\n'
+	unfinished = []
+
+	for shard in range(len(plan['shards'])):
+
+		markerPath = shardCachePath(cache, shard) + '.done'
+
+		if not os.path.isfile(markerPath):
+			unfinished.append(shard)
+			continue
+
+		with open(markerPath) as mf:
+			if mf.read() != digest:
+				unfinished.append(shard)
+
+	if unfinished:
+		print ('Shards ' + ', '.join(str(shard) for shard in unfinished) + ' of ' + planPath + ' have not finished. Exiting.')
+		exit (1)
+
+	regions = readTranscriptFile(plan['transcript_file'])
+
+	if regionsDigest(regions) != plan['regions']:
+		print ('The transcript file ' + plan['transcript_file'] + ' has changed since the shard plan was written. Exiting.')
+		exit (3)
+
 	cwd = os.getcwd()
-	bamFiles = makeBamListAndDirectories(bamList)
-	poolArguements = []
+	bamFiles = plan['bam_files']
 
-	with open(transcriptFile) as tf:
-		for line in tf:
+	for bam in bamFiles:
+		os.makedirs(cwd + '/' + bam[:-4], exist_ok=True)
 
-			elems = line.strip().split()
-			try:
-				gene, gene2, plus, chrom, start, stop, gene_type = elems #edit the transcript file so that you only deal with junction coordinates
-			except Exception as e:
-				print ('Error while parsing transcript file named: ' + str(transcriptFile) + "\n" + 'Error message: ' + str(e) + "\nExiting.")
-				exit (3)
+	resultCache = openDiscoveryCache(cache)
 
-			poolArguements.append((bamFiles, gene, chrom, start, stop, cwd))
+	for shard in range(len(plan['shards'])):
+		print ('Imported ' + str(importResults(resultCache, shardCachePath(cache, shard))) + ' results from shard ' + str(shard))
 
-	print ("Creating a pool with " + str(numProcesses) + " processes")
-	pool = multiprocessing.Pool(int(numProcesses))
-	print ('pool: ' + str(pool))
+	bamKeys, missing = planDiscovery(bamFiles, regions, resultCache, plan['checksum'])
+	resultCache.close()
 
-	pool.map(intronDiscovery, poolArguements) # run the worker processes
+	if missing:
+		print ('Warning: ' + str(len(missing)) + ' gene regions are still missing from the result cache after merging.')
+
+	pool = multiprocessing.Pool(initializer=initializeWorker, initargs=(discoveryEngine, bamFiles, regions, cwd, output, compress, None, cache), processes=int(numProcesses))
+	writeOutputs(pool, bamFiles, bamKeys)
 	pool.close()
 	pool.join()
-	
+
 if __name__=="__main__":
 
 	print ('SpliceJunctionDiscover.py started on ' + datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
@@ -289,13 +1469,39 @@ if __name__=="__main__":
 	parser.add_argument('-transcript_file',help="A list of positions that you want to discover junctions in",action='store',default = "/home/dennis.kao/largeWork/gene-lists/all-protein-coding-genes-no-patches.list")
 	parser.add_argument('-bam_list',help='A text file containing the names of bam files you want to discover splice junctions in each on a seperate line',default='bamlist.list')
 	parser.add_argument('-processes',help='number of processes to run multiple instances of: "samtools view", default=10',default=10)
+	parser.add_argument('-engine',help='How bam files are read. "pysam" opens each bam file and its index once per worker process and queries regions in-process. "samtools" spawns "samtools view" for each gene and bam file. default=pysam if it is installed, otherwise samtools',choices=['pysam', 'samtools'],default=None)
+	parser.add_argument('-mode',help='"gene" gives each worker process a gene and queries that region in every bam file. "bam" gives each worker process a bam file which it reads from start to end once, assigning junctions to every gene they fall in. Both modes produce the same gene text files. default=gene',choices=['gene', 'bam'],default='gene')
+	parser.add_argument('-output',help='"genefiles" writes a text file for every gene in each sample folder (E.x. PATIENT/DMD.txt). "sample" writes all of a sample\'s junctions to a single sorted file with the gene as a column (E.x. PATIENT/junctions.txt). default=genefiles',choices=['genefiles', 'sample'],default='genefiles')
+	parser.add_argument('--compress',help='gzip single sample junction files (PATIENT/junctions.txt.gz). Only used with -output=sample',action='store_true')
+	parser.add_argument('-cache',help='Path to the result cache. (gene region, bam file) pairs found in it are not processed again, so reruns and projects sharing control bam files only do new work. default=discovery_cache.db',default='discovery_cache.db')
+	parser.add_argument('--checksum',help='Identify bam files in the result cache by the SHA-1 of their contents instead of their path, size and modification time. Lets copied or moved bam files reuse cached results but reads every bam file in full',action='store_true')
+	parser.add_argument('-shards',help='Write a plan splitting the work that is not in the result cache in to this many shards of about equal size, to run on separate nodes, and exit. Shards are balanced using the bam indexes',type=int,default=None)
+	parser.add_argument('-shard',help='Run a single shard of the plan, E.x. -shard=$PBS_ARRAYID or -shard=$SLURM_ARRAY_TASK_ID. Results go to a separate result cache for each shard',type=int,default=None)
+	parser.add_argument('--merge',help='Check that every shard of the plan has finished, combine their results in to the result cache and write outputs',action='store_true')
+	parser.add_argument('-shard_plan',help='Path to the shard plan used by -shards, -shard and --merge. default=discovery_shards.json',default='discovery_shards.json')
 	args=parser.parse_args()
 
+	if not args.engine:
+		args.engine = 'pysam' if pysam else 'samtools'
+	elif args.engine == 'pysam' and not pysam:
+		print ('The pysam engine was requested but pysam is not installed. Install it with "pip3 install pysam" or use -engine=samtools. Exiting.')
+		exit (1)
+
 	print ('Working in directory' + str(os.getcwd()))
 	print ('Transcript file is ' + str(args.transcript_file))
 	print ('Identifying splice junction is ' + str(args.bam_list))
-
-	processGenesInParallel(args.transcript_file, args.bam_list, args.processes)
+	print ('Reading bam files with ' + args.engine + ' in ' + args.mode + ' mode')
+
+	if args.shards:
+		writeShardPlan(args.transcript_file, args.bam_list, args.shards, args.shard_plan, args.cache, args.checksum)
+	elif args.shard is not None:
+		runShard(args.shard_plan, args.shard, args.processes, args.engine, args.cache)
+	elif args.merge:
+		mergeShards(args.shard_plan, args.processes, args.engine, args.output, args.compress, args.cache)
+	elif args.mode == 'bam':
+		processBamsInParallel(args.transcript_file, args.bam_list, args.processes, args.engine, args.output, args.compress, args.cache, args.checksum)
+	else:
+		processGenesInParallel(args.transcript_file, args.bam_list, args.processes, args.engine, args.output, args.compress, args.cache, args.checksum)
 	
 	# transcriptFile = str(args.transcriptFile).rsplit('/')[-1] #remove paths
 
@@ -0,0 +1,238 @@
+import os
+import gzip
+import heapq
+import struct
+
+# the BAI linear index has one entry per 2^14 = 16384 base window
+linearIndexShift = 14
+
+# bin number of the pseudo bin htslib uses to record where a reference's alignments begin and end
+pseudoBin = 37450
+
+# the fixed cost of a query on top of its estimated bytes: every query seeks to and decompresses at least
+# one BGZF block, of up to 64 KB, even when the bai linear index puts no data in the region
+queryOverheadBytes = 1 << 16
+
+def largestFirst(tasks, costs):
+
+	"""
+	Orders tasks so the most expensive ones are handed out first. Starting the giant genes
+	(TTN, NEB, DMD) early keeps them from landing at the end of a run and leaving most of the
+	worker processes idle.
+
+	Args:
+		tasks, a list of pool arguments
+		costs, a list of estimated costs, one for each task
+
+	Returns:
+	    a list of tasks sorted by decreasing cost, ties keep their original order
+
+	Raises:
+	    None
+	"""
+
+	order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+
+	return [tasks[i] for i in order]
+
+def runLargestFirst(pool, function, tasks, costs):
+
+	"""
+	Runs tasks on a pool, most expensive first, one task at a time per worker process
+
+	Args:
+		pool, a multiprocessing pool
+		function, the function each worker process goes through
+		tasks, a list of pool arguments
+		costs, a list of estimated costs, one for each task
+
+	Returns:
+	    a generator of the values returned by function, in the order tasks finish
+
+	Raises:
+	    None
+	"""
+
+	return pool.imap_unordered(function, largestFirst(tasks, costs), chunksize=1)
+
+def partitionLargestFirst(costs, numShards):
+
+	"""
+	Splits tasks in to shards of about equal total cost. Tasks are handed out most expensive first,
+	each to the shard with the lowest total so far, and between shards with the same total to the one
+	with the fewest tasks, so tasks costed at 0 are spread evenly instead of all going to the first shard.
+	The result only depends on the costs, so every node computing a plan from the same inputs gets the same shards.
+
+	Args:
+		costs, a list of estimated costs, one for each task
+		numShards, the number of shards to make
+
+	Returns:
+	    (shards, totals), shards is a list of numShards lists of task positions in increasing order
+	    and totals is the estimated cost of each shard
+
+	Raises:
+	    None
+	"""
+
+	shards = [[] for i in range(numShards)]
+	totals = [0] * numShards
+	heap = [(0, 0, shard) for shard in range(numShards)]
+
+	for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+
+		total, count, shard = heapq.heappop(heap)
+		shards[shard].append(i)
+		totals[shard] = total + costs[i]
+		heapq.heappush(heap, (totals[shard], count + 1, shard))
+
+	for shard in shards:
+		shard.sort()
+
+	return shards, totals
+
+def readBamReferences(bam):
+
+	"""
+	Reads the names of the references (chromosomes) from the header of a bam file.
+	BAM files are BGZF compressed which is valid multi-member gzip, so no extra libraries are needed.
+
+	Args:
+		bam, path to a bam file
+
+	Returns:
+	    a list of reference names in header order, their position in the list is the reference's id in the bai file
+
+	Raises:
+	    Exception, if the file is not a bam file
+	"""
+
+	with gzip.open(bam, "rb") as bf:
+
+		if bf.read(4) != b"BAM\1":
+			raise Exception(bam + ' is not a bam file')
+
+		textLength, = struct.unpack("<i", bf.read(4))
+		bf.read(textLength)
+		numReferences, = struct.unpack("<i", bf.read(4))
+
+		references = []
+
+		for i in range(numReferences):
+			nameLength, = struct.unpack("<i", bf.read(4))
+			references.append(bf.read(nameLength).rstrip(b"\0").decode())
+			bf.read(4) # reference length
+
+	return references
+
+def readBaiLinearIndex(bai):
+
+	"""
+	Reads the parts of a bai file needed to estimate how much data a region holds
+
+	Args:
+		bai, path to a bam index
+
+	Returns:
+	    a list with one (linearIndex, end) tuple per reference. linearIndex is a list of the compressed file
+	    offsets of the first alignment in each 16384 base window and end is the compressed file offset just
+	    past the reference's last alignment
+
+	Raises:
+	    Exception, if the file is not a bai file
+	"""
+
+	with open(bai, "rb") as bf:
+		data = bf.read()
+
+	if data[:4] != b"BAI\1":
+		raise Exception(bai + ' is not a bai file')
+
+	numReferences, = struct.unpack_from("<i", data, 4)
+	position = 8
+	references = []
+
+	for i in range(numReferences):
+
+		numBins, = struct.unpack_from("<i", data, position)
+		position += 4
+		end = 0
+
+		for b in range(numBins):
+
+			binNumber, numChunks = struct.unpack_from("<Ii", data, position)
+			position += 8
+
+			if binNumber == pseudoBin:
+				referenceBegin, referenceEnd = struct.unpack_from("<QQ", data, position)
+				end = referenceEnd >> 16
+			else:
+				lastChunkEnd, = struct.unpack_from("<Q", data, position + 16 * numChunks - 8)
+				end = max(end, lastChunkEnd >> 16)
+
+			position += 16 * numChunks
+
+		numIntervals, = struct.unpack_from("<i", data, position)
+		position += 4
+		linearIndex = [offset >> 16 for offset in struct.unpack_from("<%dQ" % numIntervals, data, position)]
+		position += 8 * numIntervals
+
+		references.append((linearIndex, end))
+
+	return references
+
+def readBamIndexStatistics(bam):
+
+	"""
+	Loads everything estimateRegionBytes() needs for a bam file
+
+	Args:
+		bam, path to a bam file with an index next to it (file.bam.bai or file.bai)
+
+	Returns:
+	    a dictionary keyed on reference name holding (linearIndex, end) tuples, or None if there is no usable index
+
+	Raises:
+	    None
+	"""
+
+	for bai in (bam + ".bai", bam[:-4] + ".bai"):
+		if os.path.isfile(bai):
+			try:
+				return dict(zip(readBamReferences(bam), readBaiLinearIndex(bai)))
+			except Exception as e:
+				print ('Could not read index statistics for ' + bam + ': ' + str(e))
+				return None
+
+	return None
+
+def estimateRegionBytes(statistics, chrom, start, stop):
+
+	"""
+	Estimates the amount of compressed alignment data in a region using the bai linear index.
+	This is proportional to the number of reads a query of the region decodes.
+
+	Args:
+		statistics, a dictionary made by readBamIndexStatistics()
+		chrom, start and stop, the region
+
+	Returns:
+	    the estimated number of compressed bytes
+
+	Raises:
+	    None
+	"""
+
+	if chrom not in statistics:
+		return 0
+
+	linearIndex, end = statistics[chrom]
+	firstWindow = int(start) >> linearIndexShift
+	lastWindow = (int(stop) >> linearIndexShift) + 1
+
+	if firstWindow >= len(linearIndex):
+		return 0
+
+	regionEnd = linearIndex[lastWindow] if lastWindow < len(linearIndex) else end
+
+	return max(regionEnd - linearIndex[firstWindow], 0)
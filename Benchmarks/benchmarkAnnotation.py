@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Analysis'))
+
+import AddJunctionsToDatabase as ajd
+
+def legacyAnnotateJunction(cur, chrom, start, stop, flank):
+
+	"""
+	The annotation getJunctionID() used to do with up to three queries on TRANSCRIPT_MODEL_JUNCTIONS per
+	new junction. Kept here as a baseline. The flank == 0 branch had a syntax error, exact matches are
+	done with the flanked queries instead.
+
+	Args:
+		cur, a cursor to a database with the transcript_model loaded
+		chrom, start, stop, a junction
+		flank, the +/- range a splice site must fall within
+
+	Returns:
+	    gencode_annotation, 0 = none, 1 = only start, 2 = only stop, 3 = both, 4 = exon skipping
+
+	Raises:
+	    None
+	"""
+
+	cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
+		chromosome is ? and
+		start >= ? and
+		start <= ? and
+		stop >= ? and
+		stop <= ?;''', (chrom, (start - flank), (start + flank), (stop - flank), (stop + flank)) )
+	isBothAnnotated = cur.fetchone()
+
+	if not isBothAnnotated:
+		cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
+			chromosome = ? and
+			start >= ? and
+			start <= ?;''', (chrom, (start - flank), (start + flank)) )
+		isStartAnnotated = cur.fetchone()
+
+		cur.execute('''select * from TRANSCRIPT_MODEL_JUNCTIONS where 
+			chromosome = ? and
+			stop >= ? and
+			stop <= ?;''', (chrom, (stop - flank), (stop + flank)))
+		isStopAnnotated = cur.fetchone()
+
+	if isBothAnnotated:
+		return 3
+	elif isStopAnnotated and isStartAnnotated:
+		return 4
+	elif isStopAnnotated:
+		return 2
+	elif isStartAnnotated:
+		return 1
+
+	return 0
+
+def makeLookups(transcriptModel, number, seed):
+
+	"""
+	Makes a seeded mix of junctions to annotate: transcript_model junctions, junctions shifted by a
+	few bases, junctions with one novel splice site and fully novel junctions
+
+	Args:
+		transcriptModel, path to a transcript_model file
+		number, the number of junctions to make
+		seed, the random seed
+
+	Returns:
+	    a list of (chrom, start, stop) tuples
+
+	Raises:
+	    None
+	"""
+
+	rng = random.Random(seed)
+	junctions = []
+
+	with open(transcriptModel) as tm:
+		for line in tm:
+			chrom, start, stop = line.split()[0:3]
+			junctions.append((chrom, int(start), int(stop)))
+
+	lookups = []
+
+	for i in range(number):
+
+		chrom, start, stop = rng.choice(junctions)
+		kind = i % 4
+
+		if kind == 1:
+			start += rng.randint(-2, 2)
+			stop += rng.randint(-2, 2)
+		elif kind == 2:
+			stop += rng.randint(10, 500)
+		elif kind == 3:
+			start += rng.randint(10, 500)
+			stop += rng.randint(10, 500)
+
+		lookups.append((chrom, start, stop))
+
+	return lookups
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Compare annotating junctions with queries on TRANSCRIPT_MODEL_JUNCTIONS to the in-memory transcript_model index')
+	parser.add_argument('-transcript_model',help='A transcript_model file, E.x. gencode.comprehensive.splice.junctions.txt',required=True)
+	parser.add_argument('-lookups',help='Number of junctions to annotate, default=100000',type=int,default=100000)
+	parser.add_argument('-flank',help='Flanking region used for annotation, default=1',type=int,default=1)
+	parser.add_argument('-seed',help='Random seed, default=1',type=int,default=1)
+	args=parser.parse_args()
+
+	transcriptModel = os.path.abspath(args.transcript_model)
+	lookups = makeLookups(transcriptModel, args.lookups, args.seed)
+
+	with tempfile.TemporaryDirectory() as scratch:
+
+		os.chdir(scratch)
+		ajd.initializeDB()
+		ajd.storeTranscriptModelJunctions(transcriptModel)
+		conn, cur = ajd.connectToDB()
+
+		begin = time.perf_counter()
+		legacy = [legacyAnnotateJunction(cur, chrom, start, stop, args.flank) for chrom, start, stop in lookups]
+		legacyTime = time.perf_counter() - begin
+
+		begin = time.perf_counter()
+		index = ajd.loadTranscriptModel(cur)
+		loadTime = time.perf_counter() - begin
+
+		begin = time.perf_counter()
+		annotations = [ajd.annotateJunction(index, chrom, start, stop, args.flank) for chrom, start, stop in lookups]
+		indexTime = time.perf_counter() - begin
+
+		conn.close()
+
+	print ('\t'.join(['method', 'lookups', 'seconds', 'lookups_per_second']))
+	print ('\t'.join(['sql', str(len(lookups)), '%.3f' % legacyTime, '%.1f' % (len(lookups) / legacyTime)]))
+	print ('\t'.join(['index', str(len(lookups)), '%.3f' % indexTime, '%.1f' % (len(lookups) / indexTime)]))
+	print ('index loaded in %.3f seconds' % loadTime)
+	print ('speedup: %.2fx' % (legacyTime / indexTime))
+
+	if legacy != annotations:
+		print ('MISMATCH: %d junctions were annotated differently' % sum(1 for a, b in zip(legacy, annotations) if a != b))
+		exit (1)
+
+	print ('Both methods annotated every junction the same way')
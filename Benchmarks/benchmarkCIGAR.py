@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Analysis'))
+
+from SpliceJunctionDiscovery import parseCIGARForIntrons
+
+cigarOperations = re.compile(r'(\d+)([MIDNSHP=X])')
+
+def legacyParseCIGARForIntrons(cigar):
+
+	"""
+	The parser SpliceJunctionDiscovery.py used before CIGAR strings were cached. It tokenizes the
+	string on every call and only reports the first intron of a read. Kept here as a baseline.
+
+	Args:
+		cigar, a CIGAR string with an intron in it
+
+	Returns:
+	    offset, matchedExon, intronLength
+
+	Raises:
+	    Exception, if the CIGAR string has no intron in it
+	"""
+
+	if 'N' in cigar:
+		cigar = cigar.split('N')[0] + 'N' #remove all information after intron
+	else:
+		raise Exception('No intron detected')
+
+	offset = 0
+	matchedExon = 0
+	intronLength = 0
+
+	for length, operation in cigarOperations.findall(cigar):
+		if operation == 'N':
+			intronLength += int(length)
+		elif operation == 'D':
+			offset += int(length)
+		elif operation == 'I':
+			offset -= int(length)
+		elif operation == 'M':
+			matchedExon += int(length)
+
+	return offset, matchedExon, intronLength
+
+def cigarsFromBam(bam, limit):
+
+	"""
+	Collects the CIGAR strings of spliced primary alignments from a bam file
+
+	Args:
+		bam, path to an indexed or unindexed bam file
+		limit, the number of CIGAR strings to collect
+
+	Returns:
+	    a list of CIGAR strings
+
+	Raises:
+	    None
+	"""
+
+	import pysam
+
+	cigars = []
+
+	with pysam.AlignmentFile(bam, "rb") as bf:
+		for read in bf.fetch(until_eof=True):
+
+			cigar = read.cigarstring
+
+			if cigar and 'N' in cigar and read.flag < 256:
+				cigars.append(cigar)
+
+				if len(cigars) >= limit:
+					break
+
+	return cigars
+
+def syntheticCigars(limit, seed):
+
+	"""
+	Makes spliced CIGAR strings with the skewed distribution seen in real, coordinate sorted libraries:
+	reads supporting the same junction come in runs, a few junctions account for most reads and
+	split points vary from read to read
+
+	Args:
+		limit, the number of CIGAR strings to make
+		seed, seed for the random number generator
+
+	Returns:
+	    a list of CIGAR strings
+
+	Raises:
+	    None
+	"""
+
+	rng = random.Random(seed)
+	readLength = 100
+	cigars = []
+
+	# intron lengths of the expressed junctions, a few highly expressed junctions account for most reads
+	intronLengths = [rng.randint(60, 300000) for i in range(2000)]
+	weights = [1.0 / (rank + 1) for rank in range(len(intronLengths))]
+	introns = []
+
+	while len(introns) < limit:
+		introns.extend([rng.choices(intronLengths, weights)[0]] * rng.randint(1, 60))
+
+	for i in range(limit):
+
+		split = rng.randint(1, readLength - 1)
+		intron = introns[i]
+
+		if rng.random() < 0.1:
+			second = rng.randint(1, readLength - split - 1) if readLength - split > 2 else 1
+			cigars.append('%dM%dN%dM%dN%dM' % (split, intron, second, rng.randint(60, 5000), readLength - split - second))
+		elif rng.random() < 0.05:
+			cigars.append('%dS%dM%dN%dM' % (3, split, intron, readLength - split - 3))
+		else:
+			cigars.append('%dM%dN%dM' % (split, intron, readLength - split))
+
+	return cigars
+
+def timeParser(parser, cigars):
+
+	"""
+	Parses every CIGAR string once
+
+	Args:
+		parser, a function taking a CIGAR string
+		cigars, a list of CIGAR strings
+
+	Returns:
+	    the wall time taken in seconds
+
+	Raises:
+	    None
+	"""
+
+	begin = time.perf_counter()
+
+	for cigar in cigars:
+		parser(cigar)
+
+	return time.perf_counter() - begin
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Microbenchmark of the CIGAR string parser used by SpliceJunctionDiscovery.py')
+	parser.add_argument('-bam',help='Collect real CIGAR strings from this bam file (requires pysam)')
+	parser.add_argument('-cigars',help='A text file with one CIGAR string per line, E.x. made with: samtools view file.bam | cut -f6 | grep N')
+	parser.add_argument('-n',help='The number of CIGAR strings to parse, default=3000000',type=int,default=3000000)
+	parser.add_argument('-seed',help='Seed used when making synthetic CIGAR strings, default=1',type=int,default=1)
+	args=parser.parse_args()
+
+	if args.bam:
+		cigars = cigarsFromBam(args.bam, args.n)
+	elif args.cigars:
+		with open(args.cigars) as cf:
+			cigars = [line.strip() for line in cf if 'N' in line][:args.n]
+	else:
+		cigars = syntheticCigars(args.n, args.seed)
+
+	distinct = len(set(cigars))
+	legacyJunctions = len(cigars)
+	junctions = sum(len(parseCIGARForIntrons(cigar)) for cigar in cigars)
+	parseCIGARForIntrons.cache_clear()
+
+	legacyTime = timeParser(legacyParseCIGARForIntrons, cigars)
+	cachedTime = timeParser(parseCIGARForIntrons, cigars)
+	cacheInfo = parseCIGARForIntrons.cache_info()
+
+	print ('cigars: %d, distinct: %d' % (len(cigars), distinct))
+	print ('\t'.join(['parser', 'seconds', 'cigars_per_second', 'junctions_reported']))
+	print ('\t'.join(['legacy', '%.3f' % legacyTime, '%.0f' % (len(cigars) / legacyTime), str(legacyJunctions)]))
+	print ('\t'.join(['cached', '%.3f' % cachedTime, '%.0f' % (len(cigars) / cachedTime), str(junctions)]))
+	print ('cache hits: %d, misses: %d' % (cacheInfo.hits, cacheInfo.misses))
+	print ('speedup: %.2fx' % (legacyTime / cachedTime))
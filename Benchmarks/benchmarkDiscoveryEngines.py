@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Analysis'))
+
+import SpliceJunctionDiscovery as sjd
+
+def readRegions(transcriptFile, maxGenes):
+
+	"""
+	Reads the gene regions to benchmark from a transcript file
+
+	Args:
+		transcriptFile, a transcript file in the format used by SpliceJunctionDiscovery.py
+		maxGenes, the number of genes to use, 0 uses every gene
+
+	Returns:
+	    a list of (gene, chrom, start, stop) tuples
+
+	Raises:
+	    None
+	"""
+
+	regions = []
+
+	with open(transcriptFile) as tf:
+		for line in tf:
+
+			gene, gene2, plus, chrom, start, stop, gene_type = line.strip().split()
+			regions.append((gene, chrom, start, stop))
+
+			if maxGenes and len(regions) >= maxGenes:
+				break
+
+	return regions
+
+def timeEngine(discoveryEngine, bamFiles, regions):
+
+	"""
+	Runs discovery over every (gene, bam) pair with one engine in the current process
+
+	Args:
+		discoveryEngine, 'pysam' or 'samtools'
+		bamFiles, a list of bam files
+		regions, a list of (gene, chrom, start, stop) tuples
+
+	Returns:
+	    (seconds, results), the wall time taken and a dictionary of spliceDicts keyed on (gene, bam)
+
+	Raises:
+	    None
+	"""
+
+	sjd.initializeWorker(discoveryEngine)
+	results = {}
+
+	begin = time.perf_counter()
+
+	for gene, chrom, start, stop in regions:
+		for bam in bamFiles:
+			results[(gene, bam)] = sjd.discoverSplicesInRegion(bam, chrom, start, stop)
+
+	return time.perf_counter() - begin, results
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Compare the pysam and samtools discovery engines of SpliceJunctionDiscovery.py on the same inputs')
+	parser.add_argument('-transcript_file',help='A transcript file in the format used by SpliceJunctionDiscovery.py',required=True)
+	parser.add_argument('-bam_list',help='A text file containing the names of bam files in the current working directory, default=bamlist.list',default='bamlist.list')
+	parser.add_argument('-genes',help='Only benchmark the first N genes of the transcript file, default=200. Use 0 for every gene',type=int,default=200)
+	args=parser.parse_args()
+
+	if not sjd.pysam:
+		print ('pysam is not installed, nothing to compare against. Exiting.')
+		exit (1)
+
+	with open(args.bam_list) as bl:
+		bamFiles = [line.strip() for line in bl if line.strip()]
+
+	regions = readRegions(args.transcript_file, args.genes)
+	queries = len(regions) * len(bamFiles)
+
+	samtoolsTime, samtoolsResults = timeEngine('samtools', bamFiles, regions)
+	pysamTime, pysamResults = timeEngine('pysam', bamFiles, regions)
+
+	print ('\t'.join(['engine', 'queries', 'seconds', 'queries_per_second']))
+	print ('\t'.join(['samtools', str(queries), '%.3f' % samtoolsTime, '%.1f' % (queries / samtoolsTime)]))
+	print ('\t'.join(['pysam', str(queries), '%.3f' % pysamTime, '%.1f' % (queries / pysamTime)]))
+	print ('speedup: %.2fx' % (samtoolsTime / pysamTime))
+
+	if samtoolsResults != pysamResults:
+		print ('MISMATCH: the engines reported different junctions')
+		exit (1)
+
+	print ('Both engines reported identical junctions')
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Analysis'))
+
+import AddJunctionsToDatabase as ajd
+
+def readGroups(bamList, gene_set):
+
+	"""
+	Reads the junctions of every sample the way AddJunctionsToDatabase.py --addBAM does, from each sample's
+	junction file or gene text files in the working directory
+
+	Args:
+		bamList, a list of bam file names
+		gene_set, a set of gene names from the transcript_file
+
+	Returns:
+	    a dictionary of sample names and their list of (bam_id, bam_type, sample, gene, spliceDict) tuples
+
+	Raises:
+	    None
+	"""
+
+	samples = {}
+
+	for number, bam in enumerate(bamList):
+		samples[bam] = [(number, 0, bam[:-4], gene, spliceDict) for gene, spliceDict in ajd.readSampleGenes(bam, gene_set)]
+
+	return samples
+
+def timeNormalization(samples, annotations, vectorized):
+
+	"""
+	Times normalizeJunctionGroups() over every sample, one call per sample
+
+	Args:
+		samples, a dictionary made by readGroups()
+		annotations, a dictionary of sample names and the annotations of their junctions
+		vectorized, True for the numpy path, False for get_annotated_counts() and normalizeReadCount()
+
+	Returns:
+	    (seconds, results), results is a dictionary of sample names and what normalizeJunctionGroups() returned
+
+	Raises:
+	    None
+	"""
+
+	numpy = ajd.numpy
+
+	if not vectorized:
+		ajd.numpy = None
+
+	results = {}
+	begin = time.perf_counter()
+
+	for bam in samples:
+		results[bam] = ajd.normalizeJunctionGroups(samples[bam], annotations[bam])
+
+	seconds = time.perf_counter() - begin
+	ajd.numpy = numpy
+
+	return seconds, results
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Compare normalizing the junctions of each sample with dictionaries to the numpy path, on the output of SpliceJunctionDiscovery.py in the working directory')
+	parser.add_argument('-transcript_model',help='A transcript_model file, E.x. gencode.comprehensive.splice.junctions.txt',required=True)
+	parser.add_argument('-transcript_file',help='The same transcript_file used in SpliceJunctionDiscovery.py',required=True)
+	parser.add_argument('-bamlist',help='A text file containing the names of bam files, default=bamlist.list',default='bamlist.list')
+	parser.add_argument('-flank',help='Flanking region used for annotation, default=1',type=int,default=1)
+	args=parser.parse_args()
+
+	if ajd.numpy is None:
+		print ('numpy is not installed, there is nothing to compare against')
+		exit(1)
+
+	transcriptModel = os.path.abspath(args.transcript_model)
+
+	with open(args.bamlist) as bl:
+		bamList = [line.strip() for line in bl if line.strip()]
+
+	samples = readGroups(bamList, ajd.gene_file_names(args.transcript_file))
+	junctions = sum(len(spliceDict) for groups in samples.values() for bam_id, bam_type, sample, gene, spliceDict in groups)
+	cwd = os.getcwd()
+
+	with tempfile.TemporaryDirectory() as scratch:
+
+		os.chdir(scratch)
+		ajd.initializeDB()
+		ajd.storeTranscriptModelJunctions(transcriptModel)
+		conn, cur = ajd.connectToDB()
+		index = ajd.loadTranscriptModel(cur)
+		conn.close()
+		os.chdir(cwd)
+
+	annotations = {}
+
+	for bam in samples:
+		annotations[bam] = [[ajd.annotateJunction(index, chrom, int(start), int(stop), args.flank) for chrom, start, stop in spliceDict]
+			for bam_id, bam_type, sample, gene, spliceDict in samples[bam]]
+
+	dictTime, dictResults = timeNormalization(samples, annotations, False)
+	numpyTime, numpyResults = timeNormalization(samples, annotations, True)
+
+	print ('\t'.join(['method', 'junctions', 'seconds', 'junctions_per_second']))
+	print ('\t'.join(['dict', str(junctions), '%.3f' % dictTime, '%.1f' % (junctions / dictTime)]))
+	print ('\t'.join(['numpy', str(junctions), '%.3f' % numpyTime, '%.1f' % (junctions / numpyTime)]))
+	print ('speedup: %.2fx' % (dictTime / numpyTime))
+
+	mismatches = 0
+
+	for bam in samples:
+		for dictValues, numpyValues in zip(dictResults[bam], numpyResults[bam]):
+			mismatches += sum(1 for a, b in zip(dictValues, numpyValues) if a != b)
+
+	if mismatches:
+		print ('MISMATCH: %d values differ between the two methods' % mismatches)
+		exit (1)
+
+	print ('Both methods gave the same normalized read counts and splice site maxima for every junction')
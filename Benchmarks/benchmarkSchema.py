@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarkDirectory, '..', 'Analysis'))
+sys.path.insert(0, benchmarkDirectory)
+
+import syntheticData
+import AddJunctionsToDatabase as ajd
+import FilterSpliceJunctions as fsj
+import MigrateDatabase
+
+def makeCohortJunctions(rng, genes):
+
+	"""
+	Makes the junctions a synthetic cohort draws from: the annotated junctions of syntheticData's genes,
+	and a pool of recurrent novel junctions with one or both splice sites moved. Each novel junction gets
+	a frequency, most are rare and a few are seen in most samples.
+
+	Args:
+		rng, a random.Random
+		genes, the number of genes
+
+	Returns:
+	    (model, junctions), model is a list of (chrom, start, stop) transcript_model junctions, junctions is a
+	    list of (gene, chrom, start, stop, annotation, frequency) tuples
+	"""
+
+	geneList, chromLengths = syntheticData.makeGenes(rng, genes, 22)
+	model = []
+	junctions = []
+
+	for gene, chrom, start, stop, exons in geneList:
+		for junctionStart, junctionStop in syntheticData.modelJunctions(exons):
+
+			model.append((chrom, junctionStart, junctionStop))
+			junctions.append((gene, chrom, junctionStart, junctionStop, 3, 0.7))
+
+			for novel in range(3):
+				kind = rng.random()
+				novelStart = junctionStart if kind < 0.4 else junctionStart + rng.randint(2, 200)
+				novelStop = junctionStop if 0.4 <= kind < 0.8 else junctionStop - rng.randint(2, 200)
+				annotation = 1 if kind < 0.4 else (2 if kind < 0.8 else 0)
+
+				if novelStop > novelStart:
+					junctions.append((gene, chrom, novelStart, novelStop, annotation, rng.random() ** 4))
+
+	return model, junctions
+
+def buildDatabase(path, rng, controls, patients, genes, privateJunctions):
+
+	"""
+	Writes a schema 1 database of a synthetic cohort straight in to the tables, sample by sample in the order
+	--addBAM stores them, without running SpliceJunctionDiscovery.py. Every sample also has privateJunctions
+	junctions no other sample has, the noise which makes JUNCTION_REF grow with the cohort.
+	The population aggregates are filled in at the end by rebuildAggregates().
+
+	Args:
+		path, the database to write
+		rng, a random.Random
+		controls, the number of GTEx samples
+		patients, the number of patient samples
+		genes, the number of genes
+		privateJunctions, the number of junctions only one sample has
+
+	Returns:
+	    the number of read counts stored
+	"""
+
+	model, junctions = makeCohortJunctions(rng, genes)
+
+	ajd.initializeDB(path, 1)
+	conn, cur = ajd.connectToDB(path)
+	cur.execute('''PRAGMA synchronous = OFF;''')
+	cur.executemany('''insert into TRANSCRIPT_MODEL_JUNCTIONS (chromosome, start, stop) values (?, ?, ?);''', model)
+	cur.execute('''create index stopJunction on TRANSCRIPT_MODEL_JUNCTIONS (chromosome, stop);''')
+
+	junctionIDs = {}
+	samples = ['S%d.GTEX.bam' % i for i in range(controls)] + ['PATIENT%d.bam' % i for i in range(patients)]
+	counts = 0
+
+	for bam in samples:
+
+		bam_id, bam_type = ajd.addSample(cur, bam)
+		seen = [junction for junction in junctions if rng.random() < junction[5]]
+
+		for private in range(privateJunctions):
+			gene, chrom, start, stop, annotation, frequency = rng.choice(junctions)
+			seen.append((gene, chrom, start + rng.randint(1, 5000), stop + rng.randint(5001, 10000), 0, 0))
+
+		rows = []
+
+		for gene, chrom, start, stop, annotation, frequency in seen:
+
+			key = (chrom, start, stop)
+
+			if key not in junctionIDs:
+				cur.execute('''insert or ignore into JUNCTION_REF (chromosome, start, stop, gencode_annotation) values (?, ?, ?, ?);''', (chrom, start, stop, annotation))
+				cur.execute('''select ROWID from JUNCTION_REF where chromosome = ? and start = ? and stop = ?;''', key)
+				junctionIDs[key] = cur.fetchone()[0]
+				cur.execute('''insert or ignore into GENE_REF (gene, junction_id) values (?, ?);''', (gene, junctionIDs[key]))
+
+			read_count = int(rng.lognormvariate(2, 1.5)) + 1
+			norm_read_count = 'NULL' if annotation == 0 else round(read_count / (read_count + rng.randint(0, 50)), 3)
+			rows.append((bam_id, junctionIDs[key], read_count, norm_read_count))
+
+		cur.executemany('''insert or ignore into JUNCTION_COUNTS (bam_id, junction_id, read_count, norm_read_count) values (?, ?, ?, ?);''', rows)
+		counts += len(rows)
+		conn.commit()
+
+	ajd.rebuildAggregates(cur)
+	conn.commit()
+	cur.execute('''PRAGMA wal_checkpoint(TRUNCATE);''')
+	conn.close()
+
+	return counts
+
+def tableSizes(path):
+
+	"""
+	Measures the bytes each table of a database takes on disk, its indexes included, with the dbstat virtual table
+
+	Args:
+		path, the database
+
+	Returns:
+	    a dictionary of table names and bytes, with the file size under 'file'
+	"""
+
+	conn, cur = ajd.connectToDB(path)
+	cur.execute('''PRAGMA wal_checkpoint(TRUNCATE);''')
+	cur.execute('''select m.tbl_name, sum(s.pgsize) from dbstat s
+		inner join sqlite_master m on m.name = s.name
+		group by m.tbl_name;''')
+	sizes = dict(cur.fetchall())
+	conn.close()
+
+	sizes['file'] = os.path.getsize(path)
+
+	return sizes
+
+def bytesRead():
+
+	"""
+	The bytes this process has read with read system calls, which is how SQLite reads pages in to its cache
+
+	Returns:
+	    an int
+	"""
+
+	with open('/proc/self/io') as io:
+		for line in io:
+			if line.startswith('rchar:'):
+				return int(line.split()[1])
+
+def footprint(path, workload):
+
+	"""
+	Runs a workload on a new connection with a page cache large enough never to evict a page, so the bytes
+	read are the pages the workload touched: the page cache it needs to run without going back to the disk
+
+	Args:
+		path, the database
+		workload, a function of a cursor
+
+	Returns:
+	    (bytes, seconds)
+	"""
+
+	conn, cur = ajd.connectToDB(path)
+	cur.execute('''PRAGMA cache_size = -4000000;''')
+
+	before = bytesRead()
+	begin = time.perf_counter()
+	workload(cur)
+	seconds = time.perf_counter() - begin
+	touched = bytesRead() - before
+
+	conn.rollback()
+	conn.close()
+
+	return touched, seconds
+
+def workloads(path):
+
+	"""
+	The workloads footprint() measures:
+
+		lookup, getJunctionID() on every junction of the last control, what the writer process does for each sample
+		sample, FilterSpliceJunctions.py --sample on a patient
+
+	Args:
+		path, a schema 1 database made by buildDatabase(), used to pick the junctions and samples
+
+	Returns:
+	    a list of (name, function) tuples
+	"""
+
+	conn, cur = ajd.connectToDB(path)
+	cur.execute('''select r.chromosome, r.start, r.stop from JUNCTION_COUNTS c
+		inner join JUNCTION_REF r on r.ROWID = c.junction_id
+		where c.bam_id = (select max(ROWID) from SAMPLE_REF where type = 0);''')
+	junctions = [(str(chrom), int(start), int(stop)) for chrom, start, stop in cur.fetchall()]
+	cur.execute('''select sample_name from SAMPLE_REF where type = 1 limit 1;''')
+	patient = cur.fetchone()[0]
+	conn.close()
+
+	def lookup(cur):
+		schema = ajd.schemaVersion(cur)
+
+		for chrom, start, stop in junctions:
+			ajd.getJunctionID(cur, chrom, start, stop, 1, 0, schema)
+
+	def sample(cur):
+		with tempfile.TemporaryDirectory() as scratch, contextlib.redirect_stdout(sys.stderr):
+			cwd = os.getcwd()
+			os.chdir(scratch)
+			fsj.sampleSpecificJunctions(cur, patient, 1, 0)
+			os.chdir(cwd)
+
+	return [('lookup', lookup), ('sample', sample)]
+
+def megabytes(size):
+
+	"""
+	Formats a number of bytes as megabytes
+
+	Returns:
+	    a string
+	"""
+
+	return '%.1f' % (size / 1e6)
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Report the size on disk and page cache footprint of schema 1 and schema 2 splice junction databases of the same synthetic cohort')
+	parser.add_argument('-controls',help='The number of GTEx samples, default=1000',type=int,default=1000)
+	parser.add_argument('-patients',help='The number of patient samples, default=2',type=int,default=2)
+	parser.add_argument('-genes',help='The number of genes, default=1000',type=int,default=1000)
+	parser.add_argument('-private',help='The number of junctions only one sample has, per sample, default=500',type=int,default=500)
+	parser.add_argument('-seed',help='Random seed, default=1',type=int,default=1)
+	parser.add_argument('-dir',help='Directory to write the databases to and keep them in, a temporary directory by default',default=None)
+	args=parser.parse_args()
+
+	if sqlite3.sqlite_version_info < (3, 31, 0):
+		print ('Schema 2 needs SQLite 3.31.0 or higher, this sqlite3 library uses ' + sqlite3.sqlite_version)
+		exit(1)
+
+	with contextlib.ExitStack() as stack:
+
+		directory = args.dir or stack.enter_context(tempfile.TemporaryDirectory())
+		os.makedirs(directory, exist_ok=True)
+
+		schema1 = os.path.join(directory, 'schema1.db')
+		vacuumed = os.path.join(directory, 'schema1_vacuumed.db')
+		schema2 = os.path.join(directory, 'schema2.db')
+
+		for path in (schema1, vacuumed, schema2):
+			for suffix in ('', '-wal', '-shm'):
+				if os.path.exists(path + suffix):
+					os.remove(path + suffix)
+
+		begin = time.perf_counter()
+
+		with contextlib.redirect_stdout(sys.stderr):
+			counts = buildDatabase(schema1, random.Random(args.seed), args.controls, args.patients, args.genes, args.private)
+			built = time.perf_counter()
+
+			conn, cur = ajd.connectToDB(schema1)
+			cur.execute('''vacuum into ?;''', (vacuumed, ))
+			conn.close()
+
+			MigrateDatabase.migrateDatabase(schema1, schema2)
+			migrated = time.perf_counter()
+
+		conn, cur = ajd.connectToDB(schema2)
+		cur.execute('''select count(*) from JUNCTION_REF;''')
+		junctions = cur.fetchone()[0]
+		conn.close()
+
+		print ('%d controls, %d patients, %d junctions, %d read counts. Built in %.1f s, migrated in %.1f s' % (args.controls, args.patients, junctions, counts, built - begin, migrated - built))
+
+		databases = [('schema1', schema1), ('schema1_vacuumed', vacuumed), ('schema2', schema2)]
+		sizes = [tableSizes(path) for name, path in databases]
+
+		print ('\t'.join(['MB on disk'] + [name for name, path in databases]))
+
+		for table in ('file', 'JUNCTION_COUNTS', 'JUNCTION_REF', 'GENE_REF', 'JUNCTION_GENES', 'GENE_NAMES', 'CHROMOSOME_REF', 'SAMPLE_REF', 'TRANSCRIPT_MODEL_JUNCTIONS'):
+			print ('\t'.join([table] + [megabytes(size.get(table, 0)) for size in sizes]))
+
+		print ('\t'.join(['MB of page cache (seconds)'] + [name for name, path in databases]))
+
+		for name, workload in workloads(schema1):
+			results = [footprint(path, workload) for database, path in databases]
+			print ('\t'.join([name] + ['%s (%.2f)' % (megabytes(touched), seconds) for touched, seconds in results]))
@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import random
+import sqlite3
+import platform
+import argparse
+import resource
+import subprocess
+import contextlib
+from datetime import datetime
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+analysisDirectory = os.path.join(benchmarkDirectory, '..', 'Analysis')
+sys.path.insert(0, analysisDirectory)
+sys.path.insert(0, benchmarkDirectory)
+
+import syntheticData
+
+# every benchmark in the order they run. getJunctionID and the FilterSpliceJunctions queries use the
+# database summarizeGeneFile leaves behind
+benchmarkNames = ['parseCIGARForIntrons', 'intronDiscovery', 'summarizeGeneFile', 'getJunctionID',
+	'sampleSpecificJunctions', 'customSampleSpecificJunctions', 'printAllJunctions']
+
+def samtoolsPath(fake):
+
+	"""
+	Makes the PATH benchmarks run with. The samtools stand-in in Benchmarks/bin is put first
+	when asked for or when samtools is not installed.
+
+	Args:
+		fake, True to always use the stand-in
+
+	Returns:
+	    a PATH string
+
+	Raises:
+	    None
+	"""
+
+	if fake or not shutil.which('samtools'):
+		return os.path.join(benchmarkDirectory, 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+	return os.environ.get('PATH', '')
+
+def readBamList(data):
+
+	"""
+	Reads the bam list of a dataset
+
+	Args:
+		data, path to a dataset made by syntheticData.py
+
+	Returns:
+	    a list of bam file names
+
+	Raises:
+	    None
+	"""
+
+	with open(os.path.join(data, 'bamlist.list')) as bl:
+		return [line.strip() for line in bl if line.strip()]
+
+def prepareGeneFiles(data, engine, processes):
+
+	"""
+	Runs SpliceJunctionDiscovery.py over a dataset once so the ingest benchmarks have gene text files to read
+
+	Args:
+		data, path to a dataset made by syntheticData.py
+		engine, the discovery engine to use
+		processes, the number of worker processes
+
+	Returns:
+	    None
+
+	Raises:
+	    Exception, if discovery fails
+	"""
+
+	if os.path.isfile(os.path.join(data, '.gene_files_complete')):
+		return
+
+	command = [sys.executable, os.path.join(analysisDirectory, 'SpliceJunctionDiscovery.py'), '-transcript_file=transcripts.list',
+		'-bam_list=bamlist.list', '-processes=' + str(processes), '-engine=' + engine]
+
+	with open(os.path.join(data, 'discovery.log'), 'w') as log:
+		subprocess.check_call(command, cwd=data, stdout=log, stderr=subprocess.STDOUT)
+
+	open(os.path.join(data, '.gene_files_complete'), 'w').close()
+
+def benchmarkParseCIGAR(data, engine):
+
+	"""
+	Times parseCIGARForIntrons() over the CIGAR strings of every spliced alignment in the dataset,
+	starting with an empty cache
+
+	Returns:
+	    (seconds, rows), rows is the number of CIGAR strings parsed
+	"""
+
+	from SpliceJunctionDiscovery import parseCIGARForIntrons
+
+	cigars = []
+
+	for bam in readBamList(data):
+		with open(os.path.join(data, bam[:-4] + '.sam')) as sam:
+			for line in sam:
+				if not line.startswith('@'):
+					cigar = line.split('\t', 6)[5]
+
+					if 'N' in cigar:
+						cigars.append(cigar)
+
+	parseCIGARForIntrons.cache_clear()
+	begin = time.perf_counter()
+
+	for cigar in cigars:
+		parseCIGARForIntrons(cigar)
+
+	return time.perf_counter() - begin, len(cigars)
+
+def benchmarkIntronDiscovery(data, engine):
+
+	"""
+	Times intronDiscovery() over every cluster of gene regions in every bam file, in a single process
+
+	Returns:
+	    (seconds, rows), rows is the number of spliced alignments parsed
+	"""
+
+	import SpliceJunctionDiscovery as sjd
+
+	os.chdir(data)
+	bamFiles = readBamList(data)
+	regions = sjd.readTranscriptFile('transcripts.list')
+	tasks = list(dict((sjd.regionKey(chrom, start, stop), (gene, chrom, start, stop, tuple(range(len(bamFiles))))) for gene, chrom, start, stop in regions).values())
+	clusters = sjd.clusterRegions(tasks)
+
+	sjd.initializeWorker(engine, bamFiles)
+	rows = 0
+	begin = time.perf_counter()
+
+	for cluster in clusters:
+		results, readsRead, readsCounted = sjd.intronDiscovery(cluster)
+		rows += readsRead
+
+	return time.perf_counter() - begin, rows
+
+def benchmarkSummarizeGeneFile(data, engine):
+
+	"""
+	Times summarizeGeneFile() ingesting every gene text file in to a fresh database with the transcript
+	model loaded, in a single process. The batches it sends are then stored by junctionWriter() in the
+	same process, and both are timed
+
+	Returns:
+	    (seconds, rows), rows is the number of junction lines read
+	"""
+
+	import AddJunctionsToDatabase as ajd
+
+	os.chdir(data)
+
+	for suffix in ('', '-wal', '-shm'):
+		if os.path.exists('SpliceJunction.db' + suffix):
+			os.remove('SpliceJunction.db' + suffix)
+
+	ajd.initializeDB()
+	ajd.storeTranscriptModelJunctions('gencode.splice.junctions.txt')
+	bamList = ajd.addSamplesToDatabase('bamlist.list')
+	genes = sorted(ajd.gene_file_names('transcripts.list'))
+
+	rows = 0
+
+	for bam in bamList:
+		for gene in genes:
+			path = os.path.join(bam[:-4], gene + '.txt')
+
+			if os.path.isfile(path):
+				with open(path) as gf:
+					rows += sum(1 for line in gf)
+
+	writerQueue = queue.Queue()
+	ajd.initializeWorker(writerQueue, bamList, set(genes), 1)
+	begin = time.perf_counter()
+
+	for gene in genes:
+		ajd.summarizeGeneFile(gene)
+
+	writerQueue.put(None)
+	ajd.junctionWriter(writerQueue, 1)
+
+	return time.perf_counter() - begin, rows
+
+def benchmarkGetJunctionID(data, engine):
+
+	"""
+	Times getJunctionID() looking up a seeded mix of junctions already in the database and novel
+	junctions near transcript model splice sites. Every change is rolled back.
+
+	Returns:
+	    (seconds, rows), rows is the number of lookups
+	"""
+
+	import AddJunctionsToDatabase as ajd
+
+	os.chdir(data)
+	conn, cur = ajd.connectToDB()
+	rng = random.Random(1)
+
+	known = cur.execute('''select chromosome, start, stop from JUNCTION_REF;''').fetchall()
+	lookups = []
+
+	for i in range(20000):
+		chrom, start, stop = rng.choice(known)
+
+		if i % 2:
+			start += rng.randint(-3, 3)
+			stop += rng.randint(-30, 30)
+
+		lookups.append((str(chrom), int(start), int(stop)))
+
+	begin = time.perf_counter()
+
+	for chrom, start, stop in lookups:
+		ajd.getJunctionID(cur, chrom, start, stop, 1)
+
+	seconds = time.perf_counter() - begin
+	conn.rollback()
+	conn.close()
+
+	return seconds, len(lookups)
+
+def runFilterQuery(data, query):
+
+	"""
+	Times a FilterSpliceJunctions.py query against the database summarizeGeneFile() left behind.
+	Output files are written to a scratch folder in the dataset.
+
+	Args:
+		data, path to a dataset made by syntheticData.py
+		query, a function taking a cursor and writing a single output file
+
+	Returns:
+	    (seconds, rows), rows is the number of lines written
+	"""
+
+	import AddJunctionsToDatabase as ajd
+
+	os.chdir(data)
+	conn, cur = ajd.connectToDB(profile='query')
+
+	scratch = os.path.join(data, 'filter_output')
+	shutil.rmtree(scratch, ignore_errors=True)
+	os.makedirs(scratch)
+	os.chdir(scratch)
+
+	begin = time.perf_counter()
+	query(cur)
+	seconds = time.perf_counter() - begin
+
+	conn.close()
+	rows = 0
+
+	for name in os.listdir(scratch):
+		with open(name) as out:
+			rows += sum(1 for line in out) - 1
+
+	return seconds, rows
+
+def patientSample(data):
+
+	"""
+	The name of the first patient sample of a dataset
+	"""
+
+	return [bam for bam in readBamList(data) if 'GTEX' not in bam][0]
+
+def benchmarkSampleSpecific(data, engine):
+
+	"""
+	Times FilterSpliceJunctions.sampleSpecificJunctions() for the first patient
+	"""
+
+	import FilterSpliceJunctions as fsj
+
+	return runFilterQuery(data, lambda cur: fsj.sampleSpecificJunctions(cur, patientSample(data), 1, 0.0))
+
+def benchmarkCustomSampleSpecific(data, engine):
+
+	"""
+	Times FilterSpliceJunctions.customSampleSpecificJunctions() for the first patient
+	"""
+
+	import FilterSpliceJunctions as fsj
+
+	return runFilterQuery(data, lambda cur: fsj.customSampleSpecificJunctions(cur, patientSample(data), 1, 0.0, 2, 100))
+
+def benchmarkPrintAll(data, engine):
+
+	"""
+	Times FilterSpliceJunctions.printAllJunctions()
+	"""
+
+	import FilterSpliceJunctions as fsj
+
+	return runFilterQuery(data, fsj.printAllJunctions)
+
+benchmarks = {
+	'parseCIGARForIntrons': benchmarkParseCIGAR,
+	'intronDiscovery': benchmarkIntronDiscovery,
+	'summarizeGeneFile': benchmarkSummarizeGeneFile,
+	'getJunctionID': benchmarkGetJunctionID,
+	'sampleSpecificJunctions': benchmarkSampleSpecific,
+	'customSampleSpecificJunctions': benchmarkCustomSampleSpecific,
+	'printAllJunctions': benchmarkPrintAll}
+
+def runChild(name, data, engine, resultPath):
+
+	"""
+	Runs a single benchmark in this process and writes its measurements to resultPath. Benchmarks
+	print progress messages, which are discarded.
+
+	Args:
+		name, the name of a benchmark
+		data, path to a dataset made by syntheticData.py
+		engine, the discovery engine used by intronDiscovery
+		resultPath, path to write the measurements to as JSON
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		seconds, rows = benchmarks[name](data, engine)
+
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+
+	with open(resultPath, 'w') as out:
+		json.dump({'seconds': seconds, 'rows': rows, 'peak_rss_kb': usage.ru_maxrss}, out)
+
+def runBenchmark(name, data, engine, path):
+
+	"""
+	Runs a single benchmark in a fresh python process so its peak RSS is its own
+
+	Args:
+		name, the name of a benchmark
+		data, path to a dataset made by syntheticData.py
+		engine, the discovery engine used by intronDiscovery
+		path, the PATH to run with
+
+	Returns:
+	    a dictionary of measurements
+
+	Raises:
+	    Exception, if the benchmark fails
+	"""
+
+	resultPath = os.path.join(data, '.benchmark_result.json')
+	environment = dict(os.environ, PATH=path)
+
+	subprocess.check_call([sys.executable, os.path.abspath(__file__), '-child=' + name, '-data=' + data, '-engine=' + engine, '-result=' + resultPath], env=environment)
+
+	with open(resultPath) as rf:
+		result = json.load(rf)
+
+	os.remove(resultPath)
+	result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else None
+
+	return result
+
+def compareToBaseline(results, baselinePath):
+
+	"""
+	Prints how each benchmark compares to an earlier results file
+
+	Args:
+		results, a dictionary of results made by this script
+		baselinePath, path to an earlier results file
+
+	Returns:
+	    None
+
+	Raises:
+	    None
+	"""
+
+	with open(baselinePath) as bf:
+		baseline = json.load(bf)
+
+	if baseline.get('dataset') != results['dataset']:
+		print ('Warning: the baseline was measured on a different dataset, comparisons are not like for like')
+
+	print ('\t'.join(['benchmark', 'baseline_seconds', 'seconds', 'speedup', 'baseline_peak_rss_kb', 'peak_rss_kb']))
+
+	for name, result in results['benchmarks'].items():
+
+		before = baseline.get('benchmarks', {}).get(name)
+
+		if not before:
+			continue
+
+		print ('\t'.join([name, '%.3f' % before['seconds'], '%.3f' % result['seconds'], '%.2fx' % (before['seconds'] / result['seconds']),
+			str(before['peak_rss_kb']), str(result['peak_rss_kb'])]))
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Benchmark discovery and ingest on a seeded synthetic dataset and record the results as JSON')
+	parser.add_argument('-data',help='Dataset directory. Generated with syntheticData.py if it does not exist yet, default=benchmark_data',default='benchmark_data')
+	parser.add_argument('-scale',help='Size of a newly generated dataset, default=small',choices=sorted(syntheticData.scales),default='small')
+	parser.add_argument('-seed',help='Random seed of a newly generated dataset, default=1',type=int,default=1)
+	parser.add_argument('-engine',help='Discovery engine benchmarked by intronDiscovery, default=samtools',choices=['pysam', 'samtools'],default='samtools')
+	parser.add_argument('--fake_samtools',help='Use the samtools stand-in in Benchmarks/bin even if samtools is installed',action='store_true')
+	parser.add_argument('-processes',help='Worker processes used to write the gene text files the ingest benchmarks read, default=4',default=4)
+	parser.add_argument('-only',help='Only run these benchmarks',nargs='+',choices=benchmarkNames,default=benchmarkNames)
+	parser.add_argument('-output',help='Path to write results to as JSON, default=benchmark_results.json',default='benchmark_results.json')
+	parser.add_argument('-baseline',help='An earlier results file to compare against',default=None)
+	parser.add_argument('-child',help=argparse.SUPPRESS,default=None)
+	parser.add_argument('-result',help=argparse.SUPPRESS,default=None)
+	args=parser.parse_args()
+
+	data = os.path.abspath(args.data)
+
+	if args.child:
+		runChild(args.child, data, args.engine, args.result)
+		exit (0)
+
+	if not os.path.isfile(os.path.join(data, 'manifest.json')):
+		scale = syntheticData.scales[args.scale]
+		print ('Generating a ' + args.scale + ' dataset in ' + data)
+		syntheticData.makeDataset(data, args.seed, **scale)
+
+	with open(os.path.join(data, 'manifest.json')) as mf:
+		manifest = json.load(mf)
+
+	path = samtoolsPath(args.fake_samtools)
+
+	if args.engine == 'pysam' and not manifest['bam']:
+		print ('The dataset has no bam files because pysam was not installed when it was generated. Use -engine=samtools. Exiting.')
+		exit (1)
+
+	if set(args.only) & set(benchmarkNames[2:]):
+		print ('Writing gene text files for the ingest benchmarks')
+		os.environ['PATH'] = path
+		prepareGeneFiles(data, args.engine, args.processes)
+
+	results = {
+		'created': datetime.now().isoformat(),
+		'python': platform.python_version(),
+		'sqlite': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'processor': platform.processor() or platform.machine(),
+		'engine': args.engine,
+		'dataset': manifest,
+		'benchmarks': {}}
+
+	print ('\t'.join(['benchmark', 'seconds', 'rows', 'rows_per_second', 'peak_rss_kb']))
+
+	for name in benchmarkNames:
+
+		if name not in args.only:
+			continue
+
+		result = runBenchmark(name, data, args.engine, path)
+		results['benchmarks'][name] = result
+
+		print ('\t'.join([name, '%.3f' % result['seconds'], str(result['rows']), '%.1f' % (result['rows_per_second'] or 0), str(result['peak_rss_kb'])]))
+
+	with open(args.output, 'w') as out:
+		json.dump(results, out, indent=1, sort_keys=True)
+
+	print ('Results written to ' + args.output)
+
+	if args.baseline:
+		compareToBaseline(results, args.baseline)
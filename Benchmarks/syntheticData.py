@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+import os
+import json
+import random
+import argparse
+
+try:
+	import pysam
+except ImportError:
+	pysam = None
+
+# the scales makeDataset() can generate, small takes under a minute to benchmark
+scales = {
+	'small': {'genes': 200, 'samples': 4, 'patients': 1, 'reads_per_gene': 50},
+	'medium': {'genes': 2000, 'samples': 10, 'patients': 2, 'reads_per_gene': 100},
+	'large': {'genes': 10000, 'samples': 30, 'patients': 3, 'reads_per_gene': 200}}
+
+readLength = 100
+
+# bases per window of the sidecar index read by the samtools stand-in, the same as the BAI linear index
+windowShift = 14
+
+def makeGenes(rng, numGenes, numChroms):
+
+	"""
+	Lays out genes and their exons along a handful of chromosomes. Gene lengths are heavy tailed so a
+	few giant genes dominate like TTN and NEB do, and about a quarter of the genes overlap or nest inside
+	the gene before them.
+
+	Args:
+		rng, a random.Random
+		numGenes, the number of genes to make
+		numChroms, the number of chromosomes to spread them over
+
+	Returns:
+	    (genes, chromLengths), genes is a list of (gene, chrom, start, stop, exons) tuples where exons is a
+	    sorted list of (start, stop) tuples, chromLengths is a dictionary of chromosome lengths
+
+	Raises:
+	    None
+	"""
+
+	genes = []
+	chromLengths = {}
+	perChrom = -(-numGenes // numChroms)
+
+	for c in range(numChroms):
+
+		chrom = str(c + 1)
+		position = 10000
+
+		for i in range(min(perChrom, numGenes - len(genes))):
+
+			length = int(min(rng.paretovariate(1.2) * 4000, 800000))
+
+			if genes and genes[-1][1] == chrom and rng.random() < 0.25:
+				previous = genes[-1]
+				start = rng.randint(previous[2], previous[3] - 1)
+			else:
+				start = position + rng.randint(1000, 20000)
+
+			stop = start + length
+			position = max(position, stop)
+
+			numExons = max(2, min(60, length // 3000 + rng.randint(1, 6)))
+			cuts = sorted(rng.sample(range(start + 1, stop - 200), min(2 * numExons - 2, length - 202)))
+			bounds = [start] + cuts + [stop]
+			exons = [(bounds[k], bounds[k + 1]) for k in range(0, len(bounds) - 1, 2) if bounds[k + 1] - bounds[k] >= 2]
+
+			genes.append(('GENE%d' % len(genes), chrom, start, stop, exons))
+
+		chromLengths[chrom] = position + 10000
+
+	return genes, chromLengths
+
+def modelJunctions(exons):
+
+	"""
+	Makes the annotated junctions of a gene: every pair of neighbouring exons, plus an exon skip
+	for every third exon
+
+	Args:
+		exons, a sorted list of (start, stop) tuples
+
+	Returns:
+	    a list of (start, stop) junctions
+
+	Raises:
+	    None
+	"""
+
+	junctions = [(exons[k][1], exons[k + 1][0]) for k in range(len(exons) - 1)]
+	junctions += [(exons[k][1], exons[k + 2][0]) for k in range(0, len(exons) - 2, 3)]
+
+	return junctions
+
+def makeRead(rng, gene, junctions):
+
+	"""
+	Makes a single alignment in a gene. Most reads are spliced on an annotated junction, some on a
+	novel one, some span two introns and the rest are unspliced. A few are secondary or duplicates.
+
+	Args:
+		rng, a random.Random
+		gene, a (gene, chrom, start, stop, exons) tuple
+		junctions, the gene's annotated junctions
+
+	Returns:
+	    (position, flag, cigar), position is the 1-based start of the alignment
+
+	Raises:
+	    None
+	"""
+
+	gene, chrom, start, stop, exons = gene
+	kind = rng.random()
+	flag = rng.choice((0, 16))
+
+	if rng.random() < 0.05:
+		flag |= 256
+	elif rng.random() < 0.02:
+		flag |= 1024
+
+	if kind < 0.2 or not junctions:
+		return rng.randint(start, max(start, stop - readLength)), flag, '%dM' % readLength
+
+	junctionStart, junctionStop = rng.choice(junctions)
+
+	if kind < 0.3:
+		junctionStart += rng.randint(-40, 40)
+		junctionStop += rng.randint(-40, 40)
+
+		if junctionStop - junctionStart < 30:
+			junctionStop = junctionStart + 30
+
+	first = rng.randint(8, readLength - 8)
+
+	if kind > 0.9:
+		following = [j for j in junctions if j[0] > junctionStop and j[0] - junctionStop < readLength - first - 8]
+
+		if following:
+			nextStart, nextStop = following[0]
+			middle = nextStart - junctionStop
+			last = readLength - first - middle
+			return junctionStart - first, flag, '%dM%dN%dM%dN%dM' % (first, junctionStop - junctionStart, middle, nextStop - nextStart, last)
+
+	return junctionStart - first, flag, '%dM%dN%dM' % (first, junctionStop - junctionStart, readLength - first)
+
+def referenceSpan(cigar):
+
+	"""
+	The number of reference bases an alignment covers
+
+	Args:
+		cigar, a CIGAR string using M and N
+
+	Returns:
+	    an int
+
+	Raises:
+	    None
+	"""
+
+	return sum(int(length) for length in cigar[:-1].replace('N', 'M').split('M'))
+
+def writeSample(path, rng, genes, chromLengths, readsPerGene, expression):
+
+	"""
+	Writes the alignments of one sample as coordinate sorted SAM text, with a sidecar index the
+	samtools stand-in uses to seek to a region. If pysam is installed a sorted and indexed bam file
+	is written next to it.
+
+	Args:
+		path, the path of the bam file, E.x. S1.GTEX.bam. The SAM text goes to S1.GTEX.sam
+		rng, a random.Random
+		genes, a list made by makeGenes()
+		chromLengths, a dictionary of chromosome lengths
+		readsPerGene, the average number of reads per gene
+		expression, a list with the expression level of each gene
+
+	Returns:
+	    the number of alignments written
+
+	Raises:
+	    None
+	"""
+
+	samPath = path[:-4] + '.sam'
+	index = {}
+	written = 0
+
+	with open(samPath, 'wb') as out:
+
+		out.write(b'@HD\tVN:1.0\tSO:coordinate\n')
+
+		for chrom in chromLengths:
+			out.write(('@SQ\tSN:%s\tLN:%d\n' % (chrom, chromLengths[chrom])).encode())
+
+		for chrom in chromLengths:
+
+			reads = []
+
+			for gene, level in zip(genes, expression):
+				if gene[1] == chrom:
+					junctions = modelJunctions(gene[4])
+
+					for r in range(int(readsPerGene * level)):
+						reads.append(makeRead(rng, gene, junctions))
+
+			reads.sort()
+
+			maxSpan = max([referenceSpan(cigar) for position, flag, cigar in reads] or [0])
+			windows = []
+
+			for position, flag, cigar in reads:
+
+				while len(windows) <= position >> windowShift:
+					windows.append(out.tell())
+
+				out.write(('r%d\t%d\t%s\t%d\t60\t%s\t*\t0\t0\t*\t*\n' % (written, flag, chrom, position, cigar)).encode())
+				written += 1
+
+			index[chrom] = {'max_span': maxSpan, 'windows': windows, 'end': out.tell()}
+
+	with open(samPath + '.idx', 'w') as out:
+		json.dump(index, out)
+
+	if pysam:
+		with pysam.AlignmentFile(samPath, 'r') as sam, pysam.AlignmentFile(path, 'wb', template=sam) as bam:
+			for read in sam:
+				bam.write(read)
+
+		pysam.index(path)
+
+	return written
+
+def makeDataset(directory, seed=1, genes=200, samples=4, patients=1, reads_per_gene=50, chromosomes=3):
+
+	"""
+	Generates a seeded synthetic dataset: a transcript file, a gencode style transcript model,
+	a bam list and the alignments of every sample. The same seed and scale always give the same files.
+
+	Args:
+		directory, the directory to write to, created if needed
+		seed, the random seed
+		genes, samples, patients and reads_per_gene, the scale of the dataset. Sample names containing
+		GTEX are controls, the last patients samples are patients
+		chromosomes, the number of chromosomes to spread genes over
+
+	Returns:
+	    the manifest written to directory/manifest.json
+
+	Raises:
+	    None
+	"""
+
+	os.makedirs(directory, exist_ok=True)
+	rng = random.Random(seed)
+
+	geneList, chromLengths = makeGenes(rng, genes, chromosomes)
+
+	with open(os.path.join(directory, 'transcripts.list'), 'w') as tf:
+		for gene, chrom, start, stop, exons in geneList:
+			tf.write('\t'.join([gene, gene, '+', chrom, str(start), str(stop), str(len(exons))]) + '\n')
+
+	numJunctions = 0
+
+	with open(os.path.join(directory, 'gencode.splice.junctions.txt'), 'w') as gf:
+		for gene, chrom, start, stop, exons in geneList:
+			for junctionStart, junctionStop in modelJunctions(exons):
+				gf.write('\t'.join([chrom, str(junctionStart), str(junctionStop), gene]) + '\n')
+				numJunctions += 1
+
+	bamFiles = ['S%d.GTEX.bam' % i for i in range(samples - patients)] + ['PATIENT%d.bam' % i for i in range(patients)]
+	alignments = 0
+
+	for bam in bamFiles:
+		expression = [rng.lognormvariate(0, 1) for gene in geneList]
+		alignments += writeSample(os.path.join(directory, bam), rng, geneList, chromLengths, reads_per_gene, expression)
+
+	with open(os.path.join(directory, 'bamlist.list'), 'w') as bl:
+		bl.write('\n'.join(bamFiles) + '\n')
+
+	manifest = {
+		'seed': seed,
+		'genes': genes,
+		'samples': samples,
+		'patients': patients,
+		'reads_per_gene': reads_per_gene,
+		'chromosomes': chromosomes,
+		'model_junctions': numJunctions,
+		'alignments': alignments,
+		'bam': bool(pysam)}
+
+	with open(os.path.join(directory, 'manifest.json'), 'w') as mf:
+		json.dump(manifest, mf, indent=1, sort_keys=True)
+
+	return manifest
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description = 'Generate a seeded synthetic dataset of spliced alignments, a transcript file and a transcript model for benchmarking')
+	parser.add_argument('-out',help='Directory to write the dataset to',required=True)
+	parser.add_argument('-scale',help='A preset size for the dataset, default=small',choices=sorted(scales),default='small')
+	parser.add_argument('-seed',help='Random seed, default=1',type=int,default=1)
+	parser.add_argument('-genes',help='Override the number of genes of the scale',type=int,default=None)
+	parser.add_argument('-samples',help='Override the number of samples of the scale',type=int,default=None)
+	parser.add_argument('-reads_per_gene',help='Override the average number of reads per gene of the scale',type=int,default=None)
+	args=parser.parse_args()
+
+	scale = dict(scales[args.scale])
+
+	for option in ('genes', 'samples', 'reads_per_gene'):
+		if getattr(args, option):
+			scale[option] = getattr(args, option)
+
+	scale['patients'] = min(scale['patients'], scale['samples'])
+
+	manifest = makeDataset(args.out, args.seed, **scale)
+	print (json.dumps(manifest, sort_keys=True))
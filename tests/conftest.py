@@ -0,0 +1,180 @@
+import os
+import sys
+import shutil
+import sqlite3
+import subprocess
+
+import pytest
+
+testDirectory = os.path.dirname(os.path.abspath(__file__))
+analysisDirectory = os.path.join(testDirectory, '..', 'Analysis')
+benchmarkDirectory = os.path.join(testDirectory, '..', 'Benchmarks')
+sys.path.insert(0, analysisDirectory)
+sys.path.insert(0, benchmarkDirectory)
+
+import syntheticData
+
+# a dataset small enough for every test to rediscover and reingest it in a few seconds
+tinyScale = {'genes': 30, 'samples': 4, 'patients': 1, 'reads_per_gene': 30}
+
+def runScript(script, arguments, cwd, returncode=0):
+
+	"""
+	Runs one of the scripts in Analysis/ the way a user would, with the samtools stand-in in
+	Benchmarks/bin on the PATH when samtools is not installed
+
+	Args:
+		script, the name of the script, E.x. SpliceJunctionDiscovery.py
+		arguments, a list of command line arguments
+		cwd, the directory to run it in
+		returncode, the exit code the script should exit with
+
+	Returns:
+	    the output of the script
+
+	Raises:
+	    AssertionError, if the script exits with another code
+	"""
+
+	environment = dict(os.environ)
+
+	if not shutil.which('samtools'):
+		environment['PATH'] = os.path.join(benchmarkDirectory, 'bin') + os.pathsep + environment.get('PATH', '')
+
+	result = subprocess.run([sys.executable, os.path.join(analysisDirectory, script)] + [str(a) for a in arguments],
+		cwd=str(cwd), env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+	assert result.returncode == returncode, result.stdout
+
+	return result.stdout
+
+def readTree(directory, suffix='.txt'):
+
+	"""
+	Reads every file ending in suffix below directory
+
+	Returns:
+	    a dictionary of relative paths and file contents
+	"""
+
+	files = {}
+
+	for root, dirs, names in os.walk(str(directory)):
+		for name in names:
+			if name.endswith(suffix):
+				path = os.path.join(root, name)
+				with open(path) as f:
+					files[os.path.relpath(path, str(directory))] = f.read()
+
+	return files
+
+def dumpDatabase(path):
+
+	"""
+	Reads every table of a splice junction database of either schema in to a list which does not depend on
+	the ROWIDs or junction_ids junctions and samples were given, so two databases holding the same data compare equal
+
+	Args:
+		path, the database
+
+	Returns:
+	    a sorted list of tuples
+	"""
+
+	conn = sqlite3.connect(str(path))
+	rows = []
+
+	for query in ('''select 'S', sample_name, type from SAMPLE_REF;''',
+		'''select 'J', chromosome, start, stop, gencode_annotation, n_patients_seen, n_gtex_seen,
+			total_patient_read_count, total_gtex_read_count, total_read_count from JUNCTION_REF;''',
+		'''select 'C', s.sample_name, r.chromosome, r.start, r.stop, c.read_count, c.norm_read_count, typeof(c.norm_read_count)
+			from JUNCTION_COUNTS c
+			inner join SAMPLE_REF s on s.ROWID = c.bam_id
+			inner join JUNCTION_REF r on r.ROWID = c.junction_id;''',
+		'''select 'G', g.gene, r.chromosome, r.start, r.stop from GENE_REF g inner join JUNCTION_REF r on r.ROWID = g.junction_id;''',
+		'''select 'T', chromosome, start, stop from TRANSCRIPT_MODEL_JUNCTIONS;'''):
+		rows += [tuple(str(value) for value in row) for row in conn.execute(query)]
+
+	conn.close()
+
+	return sorted(rows)
+
+def ingest(directory, *arguments, **options):
+
+	"""
+	Runs --addGencode with the dataset's transcript model and then --addBAM
+
+	Args:
+		directory, a dataset SpliceJunctionDiscovery.py has been run on
+		arguments, extra --addBAM arguments, E.x. --bulk
+		options, schema=2 for a schema 2 database
+
+	Returns:
+	    the path of the database
+	"""
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt', '-schema=%d' % options.get('schema', 1)], directory)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2'] + list(arguments), directory)
+
+	return directory / 'SpliceJunction.db'
+
+@pytest.fixture(scope='session')
+def tinyDataset(tmp_path_factory):
+
+	"""
+	The synthetic dataset of syntheticData.py at tinyScale, written once per test session. Tests copy it with dataset.
+	"""
+
+	directory = tmp_path_factory.mktemp('tiny')
+	syntheticData.makeDataset(str(directory), 1, **tinyScale)
+
+	return directory
+
+@pytest.fixture(scope='session')
+def discoveredDataset(tinyDataset, tmp_path_factory):
+
+	"""
+	The tiny dataset with the gene text files SpliceJunctionDiscovery.py writes, ready for AddJunctionsToDatabase.py
+	"""
+
+	directory = tmp_path_factory.mktemp('discovered') / 'data'
+	shutil.copytree(str(tinyDataset), str(directory))
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '-engine=samtools'], directory)
+
+	return directory
+
+@pytest.fixture(scope='session')
+def referenceDump(discoveredDataset, tmp_path_factory):
+
+	"""
+	The dump of the schema 1 database a plain --addBAM run, with the writer process, makes of the tiny dataset
+	"""
+
+	directory = tmp_path_factory.mktemp('ingested') / 'data'
+	shutil.copytree(str(discoveredDataset), str(directory))
+
+	return dumpDatabase(ingest(directory))
+
+@pytest.fixture
+def discovered(discoveredDataset, tmp_path):
+
+	"""
+	A copy of the discovered tiny dataset to ingest
+	"""
+
+	directory = tmp_path / 'data'
+	shutil.copytree(str(discoveredDataset), str(directory))
+
+	return directory
+
+@pytest.fixture
+def dataset(tinyDataset, tmp_path):
+
+	"""
+	A copy of the tiny dataset to run the scripts in, since they write their outputs to the working directory
+	"""
+
+	directory = tmp_path / 'data'
+	shutil.copytree(str(tinyDataset), str(directory))
+
+	return directory
@@ -0,0 +1,281 @@
+import shutil
+import sqlite3
+
+import pytest
+
+from conftest import runScript, dumpDatabase, ingest
+
+def breakGeneFile(directory):
+
+	"""
+	Appends a line AddJunctionsToDatabase.py cannot read to a gene text file of the patient, so --addBAM fails part way
+
+	Returns:
+	    a function which puts the gene text file back
+	"""
+
+	path = directory / 'PATIENT0' / 'GENE3.txt'
+	shutil.copyfile(str(path), str(path) + '.orig')
+
+	with open(str(path), 'a') as gf:
+		gf.write('1\tnotanumber\t5\t3\n')
+
+	return lambda: shutil.move(str(path) + '.orig', str(path))
+
+def test_failed_run_is_refused_until_its_samples_are_deleted(discovered, referenceDump):
+
+	restore = breakGeneFile(discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2'], discovered, returncode=1)
+	restore()
+
+	for arguments in ([], ['--bulk']):
+		output = runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2'] + arguments, discovered, returncode=1)
+		assert 'Sample PATIENT0.bam was only partly stored' in output
+
+	runScript('AddJunctionsToDatabase.py', ['--delete', '-sample', 'S0.GTEX.bam', 'S1.GTEX.bam', 'S2.GTEX.bam', 'PATIENT0.bam'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def test_failed_bulk_run_is_resumed(discovered, referenceDump):
+
+	restore = breakGeneFile(discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '--bulk'], discovered, returncode=1)
+	restore()
+
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '--bulk'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def test_bulk_ingest_matches_the_writer_process(discovered, referenceDump):
+
+	assert dumpDatabase(ingest(discovered, '--bulk')) == referenceDump
+
+def test_writer_process_with_one_worker(discovered, referenceDump):
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=1'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def test_samples_added_in_two_runs(discovered, referenceDump):
+
+	with open(str(discovered / 'bamlist.list')) as bl:
+		bams = bl.read().split()
+
+	with open(str(discovered / 'first.list'), 'w') as bl:
+		bl.write('\n'.join(bams[:2]) + '\n')
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '-bamlist=first.list'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '--bulk'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def test_single_sample_junction_files(dataset, referenceDump):
+
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '-engine=samtools', '-output=sample', '--compress'], dataset)
+
+	assert dumpDatabase(ingest(dataset)) == referenceDump
+
+@pytest.mark.parametrize('arguments', [('--deferAggregates', ), ('--deferAggregates', '--bulk')])
+def test_deferred_aggregates(discovered, referenceDump, arguments):
+
+	assert dumpDatabase(ingest(discovered, *arguments)) == referenceDump
+
+def test_rebuild_aggregates_repairs_drifted_totals(discovered, referenceDump):
+
+	database = ingest(discovered)
+	output = runScript('AddJunctionsToDatabase.py', ['--rebuildAggregates'], discovered)
+	assert 'Rebuilt the population aggregates of 0 junctions' in output
+
+	conn = sqlite3.connect(str(database))
+	conn.execute('''update JUNCTION_REF set n_gtex_seen = n_gtex_seen + 1, total_read_count = 0 where ROWID % 7 = 0;''')
+	drifted = conn.execute('''select count(*) from JUNCTION_REF where ROWID % 7 = 0;''').fetchone()[0]
+	conn.commit()
+	conn.close()
+
+	output = runScript('AddJunctionsToDatabase.py', ['--rebuildAggregates'], discovered)
+
+	assert 'Rebuilt the population aggregates of %d junctions' % drifted in output
+	assert dumpDatabase(database) == referenceDump
+
+def normalizeBothWays(groups, annotations):
+
+	"""
+	Normalizes junction groups with normalizeJunctionGroups(), once with the dictionary code and once with numpy
+
+	Returns:
+	    (dictionaryResults, numpyResults)
+	"""
+
+	import AddJunctionsToDatabase as ajd
+
+	vectorized = ajd.numpy
+
+	try:
+		ajd.numpy = None
+		dictionaryResults = ajd.normalizeJunctionGroups(groups, annotations)
+	finally:
+		ajd.numpy = vectorized
+
+	return dictionaryResults, ajd.normalizeJunctionGroups(groups, annotations)
+
+def test_numpy_normalization_matches_dictionaries(discovered, monkeypatch):
+
+	pytest.importorskip('numpy')
+	import AddJunctionsToDatabase as ajd
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt'], discovered)
+	monkeypatch.chdir(str(discovered))
+
+	conn, cur = ajd.connectToDB(str(discovered / 'SpliceJunction.db'))
+	index = ajd.loadTranscriptModel(cur)
+	conn.close()
+
+	gene_set = ajd.gene_file_names('transcripts.list')
+	groups = [(number, 0, bam[:-4], gene, spliceDict)
+		for number, bam in enumerate(['S0.GTEX.bam', 'S1.GTEX.bam', 'S2.GTEX.bam', 'PATIENT0.bam'])
+		for gene, spliceDict in ajd.readSampleGenes(bam, gene_set)]
+	annotations = [[ajd.annotateJunction(index, chrom, int(start), int(stop), 1) for chrom, start, stop in spliceDict]
+		for bam_id, bam_type, sample, gene, spliceDict in groups]
+
+	assert {annotation for groupAnnotations in annotations for annotation in groupAnnotations} >= {0, 3}
+
+	dictionaryResults, numpyResults = normalizeBothWays(groups, annotations)
+
+	assert len(dictionaryResults[0]) == sum(len(group[4]) for group in groups)
+	assert dictionaryResults == numpyResults
+
+def test_numpy_normalization_of_every_annotation():
+
+	"""
+	Every junction is given each annotation in turn, including splice sites with no reads, where the dictionary code divides by zero
+	"""
+
+	pytest.importorskip('numpy')
+
+	spliceDict = {('1', '100', '200'): 5, ('1', '100', '300'): 7, ('1', '150', '300'): 2, ('1', '400', '500'): 0, ('2', '100', '200'): 3}
+	groups = [(1, 0, 'S', 'GENE', spliceDict), (2, 1, 'P', 'GENE', {('1', '100', '200'): 1})]
+
+	norms = []
+
+	for annotation in range(5):
+		annotations = [[(annotation + i) % 5 for i in range(len(spliceDict))], [annotation]]
+		dictionaryResults, numpyResults = normalizeBothWays(groups, annotations)
+
+		assert dictionaryResults == numpyResults
+		norms += dictionaryResults[0]
+
+	assert None in norms
+
+def test_transcript_model_index_follows_the_database(discovered, monkeypatch):
+
+	"""
+	A process which annotates against two databases, or after the transcript_model of its database changes, gets the junctions of the database it is connected to
+	"""
+
+	import AddJunctionsToDatabase as ajd
+
+	with open(str(discovered / 'gencode.splice.junctions.txt')) as gf:
+		lines = gf.readlines()
+
+	with open(str(discovered / 'half.txt'), 'w') as gf:
+		gf.writelines(lines[::2])
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt', '-db=full.db'], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=half.txt', '-db=half.db'], discovered)
+	monkeypatch.chdir(str(discovered))
+
+	def junctions(path):
+		conn, cur = ajd.connectToDB(path)
+		index = ajd.transcriptModelIndex(cur)
+		conn.close()
+		return sum(len(starts) for starts, pairedStops, stops in index.values())
+
+	assert junctions('full.db') == len(lines)
+	assert junctions('half.db') == len(lines[::2])
+	assert junctions('full.db') == len(lines)
+
+	ajd.storeTranscriptModelJunctions('gencode.splice.junctions.txt', 'half.db')
+
+	assert junctions('half.db') == len(lines)
+
+@pytest.mark.parametrize('schema', [1, 2])
+def test_prebuilt_transcript_model(discovered, referenceDump, schema):
+
+	runScript('AddJunctionsToDatabase.py', ['--buildTranscriptModel', '-transcript_model=gencode.splice.junctions.txt', '-model_db=model.db', '-schema=%d' % schema], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=model.db', '-schema=%d' % schema], discovered)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def test_prebuilt_transcript_model_copied_in(discovered, referenceDump):
+
+	runScript('AddJunctionsToDatabase.py', ['--buildTranscriptModel', '-transcript_model=gencode.splice.junctions.txt', '-model_db=model.db'], discovered)
+	shutil.copyfile(str(discovered / 'model.db'), str(discovered / 'SpliceJunction.db'))
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '--bulk'], discovered)
+
+	assert dumpDatabase(discovered / 'SpliceJunction.db') == referenceDump
+
+def ingestWithout(directory, sample):
+
+	"""
+	Ingests every sample of the bam list except one, as if it had never been added
+
+	Returns:
+	    the dump of the database
+	"""
+
+	with open(str(directory / 'bamlist.list')) as bl:
+		bams = [bam for bam in bl.read().split() if bam != sample]
+
+	with open(str(directory / 'without.list'), 'w') as bl:
+		bl.write('\n'.join(bams) + '\n')
+
+	runScript('AddJunctionsToDatabase.py', ['--addGencode', '-transcript_model=gencode.splice.junctions.txt', '-db=without.db'], directory)
+	runScript('AddJunctionsToDatabase.py', ['--addBAM', '-transcript_file=transcripts.list', '-processes=2', '-bamlist=without.list', '-db=without.db'], directory)
+
+	return dumpDatabase(directory / 'without.db')
+
+def withoutUnseenJunctions(dump):
+
+	"""
+	Leaves out the junctions of a dump no sample has a read count for, and their genes
+	"""
+
+	unseen = set(row[1:4] for row in dump if row[0] == 'J' and row[-1] == '0')
+
+	return [row for row in dump if not ((row[0] == 'J' and row[1:4] in unseen) or (row[0] == 'G' and row[2:5] in unseen))]
+
+@pytest.mark.parametrize('arguments', [(), ('--deferAggregates', ), ('--compact', ), ('--deferAggregates', '--compact')])
+@pytest.mark.parametrize('schema', [1, 2])
+def test_delete_matches_never_adding_the_sample(discovered, arguments, schema):
+
+	expected = ingestWithout(discovered, 'S1.GTEX.bam')
+	database = ingest(discovered, schema=schema)
+
+	runScript('AddJunctionsToDatabase.py', ['--delete', '-sample', 'S1.GTEX.bam'] + list(arguments), discovered)
+	deleted = dumpDatabase(database)
+	remaining = withoutUnseenJunctions(deleted)
+
+	assert remaining == withoutUnseenJunctions(expected)
+
+	if '--compact' in arguments:
+		# the junctions only the deleted sample had are removed with their genes
+		assert remaining == deleted
+	else:
+		assert len(deleted) > len(remaining)
+
+	output = runScript('AddJunctionsToDatabase.py', ['--rebuildAggregates'], discovered)
+	assert 'Rebuilt the population aggregates of 0 junctions' in output
+
+def test_delete_of_a_missing_sample_changes_nothing(discovered, referenceDump):
+
+	database = ingest(discovered)
+	output = runScript('AddJunctionsToDatabase.py', ['--delete', '-sample', 'S1.GTEX.bam', 'NOT_A_SAMPLE.bam'], discovered, returncode=1)
+
+	assert 'Sample NOT_A_SAMPLE.bam does not exist in the database!' in output
+	assert dumpDatabase(database) == referenceDump
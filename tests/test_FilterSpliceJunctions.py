@@ -0,0 +1,185 @@
+import os
+import shutil
+
+import pytest
+
+import syntheticData
+from conftest import tinyScale, runScript, readTree, ingest
+
+# two patients, so --all-patients has more than one file to write
+patientScale = dict(tinyScale, samples=5, patients=2)
+patients = ['PATIENT0.bam', 'PATIENT1.bam']
+
+@pytest.fixture(scope='session')
+def patientDatabases(tmp_path_factory):
+
+	"""
+	The tiny dataset with two patients, discovered and ingested once in to a database of each schema
+
+	Returns:
+	    a dictionary of the directory holding each schema's database
+	"""
+
+	directory = tmp_path_factory.mktemp('patients') / 'data'
+	syntheticData.makeDataset(str(directory), 1, **patientScale)
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '-engine=samtools'], directory)
+
+	databases = {}
+
+	for schema in (1, 2):
+		databases[schema] = tmp_path_factory.mktemp('schema%d' % schema) / 'data'
+		shutil.copytree(str(directory), str(databases[schema]))
+		ingest(databases[schema], schema=schema)
+
+	return databases
+
+@pytest.fixture(params=[1, 2])
+def database(request, patientDatabases, tmp_path):
+
+	"""
+	A copy of the two patient database of each schema, with the transcript file, in an empty directory for the reports
+	"""
+
+	shutil.copyfile(str(patientDatabases[request.param] / 'SpliceJunction.db'), str(tmp_path / 'SpliceJunction.db'))
+	shutil.copyfile(str(patientDatabases[request.param] / 'transcripts.list'), str(tmp_path / 'transcripts.list'))
+
+	return tmp_path / 'SpliceJunction.db'
+
+def filterJunctions(database, directory, *arguments):
+
+	"""
+	Runs FilterSpliceJunctions.py on database in directory, which is created if needed
+
+	Returns:
+	    a dictionary of the name and rows of each report written, see reportRows()
+	"""
+
+	os.makedirs(str(directory), exist_ok=True)
+	runScript('FilterSpliceJunctions.py', ['-db=%s' % database] + list(arguments), directory)
+
+	return dict((name, reportRows(text)) for name, text in readTree(directory, suffix='').items() if not name.startswith('SpliceJunction.db'))
+
+def reportRows(text):
+
+	"""
+	Reads the rows of a report in to a form which does not depend on the order SQLite returned rows or
+	joined the genes and samples of a junction in
+
+	Returns:
+	    a sorted list of tuples
+	"""
+
+	lines = text.splitlines()
+	assert lines[0].startswith('gene\tchromosome:start-stop')
+
+	rows = []
+
+	for line in lines[1:]:
+		fields = line.split('\t')
+		rows.append(tuple([','.join(sorted(fields[0].split(',')))] + fields[1:8] + [','.join(sorted(field.split(','))) for field in fields[8:]]))
+
+	return sorted(rows)
+
+def junctionPosition(row):
+
+	chromosome, positions = row[1].rsplit(':', 1)
+	start, stop = positions.split('-')
+
+	return chromosome, int(start), int(stop)
+
+def readGenes(directory):
+
+	with open(str(directory / 'transcripts.list')) as tf:
+		return [(fields[0], fields[3], int(fields[4]), int(fields[5])) for fields in (line.split('\t') for line in tf)]
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_all_patients_matches_each_sample(database, processes):
+
+	directory = database.parent
+	expected = {}
+
+	for patient in patients:
+		expected.update(filterJunctions(database, directory / patient, '--sample', patient, '1', '0'))
+
+	assert sorted(expected) == ['PATIENT0.bam_specific_rc1_norm_rc0.0_n_gtex_3', 'PATIENT1.bam_specific_rc1_norm_rc0.0_n_gtex_3']
+	assert all(expected.values())
+
+	assert filterJunctions(database, directory / 'all', '--all-patients', '1', '0', '-processes=%d' % processes) == expected
+
+def test_all_patients_writes_the_same_files_with_more_processes(database):
+
+	"""
+	The part files of each chromosome are joined in chromosome order, so the files are the same byte for byte
+	"""
+
+	directory = database.parent
+	reports = []
+
+	for processes in (1, 2):
+		os.makedirs(str(directory / str(processes)))
+		runScript('FilterSpliceJunctions.py', ['-db=%s' % database, '--all-patients', '1', '0', '-processes=%d' % processes], directory / str(processes))
+		reports.append(readTree(directory / str(processes), suffix=''))
+
+	assert len(reports[0]) == 2
+	assert reports[0] == reports[1]
+
+def test_panels_match_filtering_every_junction(database):
+
+	directory = database.parent
+	genes = readGenes(directory)
+	panelGenes = set(gene for gene, chromosome, start, stop in genes[::3])
+	regions = [(chromosome, start, stop) for gene, chromosome, start, stop in genes[1::4]]
+
+	with open(str(directory / 'panel.genes'), 'w') as gf:
+		gf.write(''.join(gene + '\n' for gene in sorted(panelGenes)))
+
+	# BED files are 0-based and the end is not part of the region
+	with open(str(directory / 'panel.bed'), 'w') as bf:
+		bf.write(''.join('%s\t%d\t%d\n' % (chromosome, start - 1, stop) for chromosome, start, stop in regions))
+
+	allRows = filterJunctions(database, directory / 'all', '--all')['all_junctions_n_gtex_3_n_paitents_2']
+
+	def inGenes(row):
+		return bool(panelGenes.intersection(row[0].split(',')))
+
+	def inRegions(row):
+		chromosome, start, stop = junctionPosition(row)
+		return any(c == chromosome and s <= stop and e >= start for c, s, e in regions)
+
+	panels = [(['--genes', str(directory / 'panel.genes')], '_panel.genes', inGenes),
+		(['--bed', str(directory / 'panel.bed')], '_panel.bed', inRegions),
+		(['--genes', str(directory / 'panel.genes'), '--bed', str(directory / 'panel.bed')], '_panel.genes_panel.bed', lambda row: inGenes(row) and inRegions(row))]
+
+	for optimized in (False, True):
+		if optimized:
+			runScript('FilterSpliceJunctions.py', ['-db=%s' % database, '--optimize'], directory)
+
+		for arguments, suffix, inPanel in panels:
+			expected = [row for row in allRows if inPanel(row)]
+			assert 0 < len(expected) < len(allRows)
+
+			reports = filterJunctions(database, directory / ('%s%s' % (suffix, optimized)), '--all', *arguments)
+			assert reports == {'all_junctions_n_gtex_3_n_paitents_2' + suffix: expected}
+
+			reports = filterJunctions(database, directory / ('sample%s%s' % (suffix, optimized)), '--sample', 'PATIENT0.bam', '1', '0', *arguments)
+			unfiltered = filterJunctions(database, directory / ('unfiltered%s' % optimized), '--sample', 'PATIENT0.bam', '1', '0')
+			assert reports == {'PATIENT0.bam_specific_rc1_norm_rc0.0_n_gtex_3' + suffix:
+				[row for row in unfiltered['PATIENT0.bam_specific_rc1_norm_rc0.0_n_gtex_3'] if inPanel(row)]}
+
+def test_region_is_the_same_before_and_after_optimize(database):
+
+	directory = database.parent
+	gene, chromosome, start, stop = readGenes(directory)[2]
+	region = '%s:%d-%d' % (chromosome, start, stop + 20000)
+	name = 'region_%s_%d-%d' % (chromosome, start, stop + 20000)
+
+	allRows = filterJunctions(database, directory / 'all', '--all')['all_junctions_n_gtex_3_n_paitents_2']
+	expected = [row for row, (c, s, e) in ((row, junctionPosition(row)) for row in allRows) if c == chromosome and s <= stop + 20000 and e >= start]
+
+	assert 0 < len(expected) < len(allRows)
+	assert filterJunctions(database, directory / 'scan', '--region', region) == {name: expected}
+
+	runScript('FilterSpliceJunctions.py', ['-db=%s' % database, '--optimize'], directory)
+
+	assert filterJunctions(database, directory / 'rtree', '--region', region) == {name: expected}
+	assert filterJunctions(database, directory / 'missing', '--region', 'NOT_A_CHROMOSOME:1-100000') == {'region_NOT_A_CHROMOSOME_1-100000': []}
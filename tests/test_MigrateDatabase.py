@@ -0,0 +1,47 @@
+import sqlite3
+
+from conftest import runScript, dumpDatabase, ingest
+
+def test_migration_keeps_every_row(discovered, referenceDump):
+
+	ingest(discovered)
+	output = runScript('MigrateDatabase.py', ['-db=SpliceJunction.db', '-out=v2.db'], discovered)
+
+	assert 'Finished migrating' in output
+	assert dumpDatabase(discovered / 'v2.db') == referenceDump
+
+	conn = sqlite3.connect(str(discovered / 'v2.db'))
+	assert conn.execute('''PRAGMA user_version;''').fetchone()[0] == 2
+	assert conn.execute('''PRAGMA journal_mode;''').fetchone()[0] == 'wal'
+	conn.close()
+
+def test_migration_keeps_the_database_optimized(discovered):
+
+	import FilterSpliceJunctions
+
+	ingest(discovered)
+	runScript('FilterSpliceJunctions.py', ['--optimize'], discovered)
+	runScript('MigrateDatabase.py', ['-db=SpliceJunction.db', '-out=v2.db'], discovered)
+
+	conn = sqlite3.connect(str(discovered / 'v2.db'))
+	cur = conn.cursor()
+	indexes = set(row[0] for row in cur.execute('''select name from sqlite_master;'''))
+
+	assert {'sampleJunctionCounts', 'geneJunctions', 'JUNCTION_RTREE', 'sqlite_stat1'} <= indexes
+	assert conn.execute('''select count(*) from JUNCTION_RTREE;''').fetchone() == conn.execute('''select count(*) from JUNCTION_REF;''').fetchone()
+	assert FilterSpliceJunctions.checkQueryPlans(cur) == []
+	conn.close()
+
+def test_migration_refuses_incomplete_samples(discovered):
+
+	database = ingest(discovered)
+
+	conn = sqlite3.connect(str(database))
+	conn.execute('''insert into PENDING_SAMPLES (bam_id) select ROWID from SAMPLE_REF where sample_name = 'PATIENT0.bam';''')
+	conn.commit()
+	conn.close()
+
+	output = runScript('MigrateDatabase.py', ['-db=SpliceJunction.db', '-out=v2.db'], discovered, returncode=1)
+
+	assert 'PATIENT0.bam' in output
+	assert not (discovered / 'v2.db').exists()
@@ -0,0 +1,164 @@
+import os
+import gzip
+import json
+import shutil
+
+import pytest
+
+from conftest import runScript, readTree
+
+def discoveredJunctions(directory):
+
+	"""
+	Reads every junction SpliceJunctionDiscovery.py wrote below directory, from gene text files or single sample junction files
+
+	Returns:
+	    a sorted list of (sample, gene, chromosome, start, stop, read_count) tuples
+	"""
+
+	junctions = []
+
+	for path, text in readTree(directory).items():
+		sample, name = os.path.split(path)
+
+		if sample and name != 'junctions.txt':
+			junctions += [tuple([sample, name[:-4]] + line.split('\t')) for line in text.splitlines()]
+
+	for sample in os.listdir(str(directory)):
+		path = os.path.join(str(directory), sample, 'junctions.txt.gz')
+
+		if os.path.isfile(path):
+			with gzip.open(path, 'rt') as jf:
+				junctions += [tuple([sample] + line.rstrip('\n').split('\t')) for line in jf if not line.startswith('#')]
+
+		path = os.path.join(str(directory), sample, 'junctions.txt')
+
+		if os.path.isfile(path):
+			with open(path) as jf:
+				junctions += [tuple([sample] + line.rstrip('\n').split('\t')) for line in jf if not line.startswith('#')]
+
+	return sorted(junctions)
+
+def discover(directory, *arguments):
+
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2'] + list(arguments), directory)
+
+	return discoveredJunctions(directory)
+
+@pytest.fixture(scope='session')
+def referenceJunctions(tinyDataset, tmp_path_factory):
+
+	"""
+	The junctions of the tiny dataset found by samtools in gene mode, the way the original scripts found them
+	"""
+
+	directory = tmp_path_factory.mktemp('reference') / 'data'
+	shutil.copytree(str(tinyDataset), str(directory))
+
+	return discover(directory, '-engine=samtools', '-mode=gene')
+
+def test_reference_finds_junctions(referenceJunctions):
+
+	assert len(referenceJunctions) > 100
+	assert {junction[0] for junction in referenceJunctions} == {'S0.GTEX', 'S1.GTEX', 'S2.GTEX', 'PATIENT0'}
+
+@pytest.mark.parametrize('arguments', [
+	('-engine=samtools', '-mode=bam'),
+	('-engine=pysam', '-mode=gene'),
+	('-engine=pysam', '-mode=bam'),
+	('-engine=samtools', '-mode=gene', '-output=sample'),
+	('-engine=pysam', '-mode=gene', '-output=sample', '--compress'),
+	('-engine=pysam', '-mode=bam', '-output=sample')])
+def test_discovery_modes_find_the_same_junctions(dataset, referenceJunctions, arguments):
+
+	if '-engine=pysam' in arguments:
+		pytest.importorskip('pysam')
+
+	assert discover(dataset, *arguments) == referenceJunctions
+
+def test_sample_file_is_sorted_by_gene_and_position(dataset):
+
+	discover(dataset, '-engine=samtools', '-output=sample')
+
+	with open(str(dataset / 'PATIENT0' / 'junctions.txt')) as jf:
+		rows = [line.rstrip('\n').split('\t') for line in jf]
+
+	assert rows[0][0] == '#gene'
+	keys = [(row[0], int(row[2]), int(row[3])) for row in rows[1:]]
+	assert keys == sorted(keys)
+
+def test_shard_plan_has_shards_of_equal_size(dataset):
+
+	"""
+	Most (cluster, bam file) pairs of the tiny dataset fit in a single bai window and are estimated at 0 bytes
+	"""
+
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=1', '-shards=3'], dataset)
+
+	with open(str(dataset / 'discovery_shards.json')) as pf:
+		plan = json.load(pf)
+
+	sizes = [sum(len(task[5]) for task in shard['tasks']) for shard in plan['shards']]
+	costs = [shard['cost'] for shard in plan['shards']]
+
+	assert min(sizes) > 0
+	assert max(sizes) <= 1.25 * min(sizes)
+	assert max(costs) <= 1.25 * min(costs)
+
+def test_rerun_reads_the_result_cache(dataset, referenceJunctions):
+
+	discover(dataset, '-engine=samtools')
+
+	for sample in ('S0.GTEX', 'S1.GTEX', 'S2.GTEX', 'PATIENT0'):
+		shutil.rmtree(str(dataset / sample))
+
+	output = runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '-engine=samtools'], dataset)
+
+	assert '120 of 120 (gene region, bam file) pairs found in the result cache' in output
+	assert discoveredJunctions(dataset) == referenceJunctions
+
+def test_cache_is_not_used_for_a_changed_bam_file(dataset, referenceJunctions):
+
+	discover(dataset, '-engine=samtools')
+	os.utime(str(dataset / 'PATIENT0.bam'), (1, 1))
+
+	output = runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '-engine=samtools'], dataset)
+
+	assert '90 of 120 (gene region, bam file) pairs found in the result cache' in output
+	assert discoveredJunctions(dataset) == referenceJunctions
+
+def test_sharded_run_finds_the_same_junctions(dataset, referenceJunctions):
+
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=1', '-shards=3'], dataset)
+
+	for shard in range(3):
+		runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=1', '-engine=samtools', '-shard=%d' % shard], dataset)
+
+	assert discoveredJunctions(dataset) == []
+
+	runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2', '--merge'], dataset)
+
+	assert discoveredJunctions(dataset) == referenceJunctions
+
+@pytest.mark.parametrize('arguments', [('-engine=samtools', '-mode=gene'), ('-engine=pysam', '-mode=bam')])
+def test_chromosome_missing_from_the_bam_files_completes(dataset, referenceJunctions, arguments):
+
+	if '-engine=pysam' in arguments:
+		pytest.importorskip('pysam')
+
+	with open(str(dataset / 'transcripts.list'), 'a') as tf:
+		tf.write('GENENOPE\tGENENOPE\t+\tchrNOPE\t100\t5000\t3\n')
+
+	output = runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2'] + list(arguments), dataset)
+
+	assert output.count('Warning: chromosome chrNOPE is not in the header of S0.GTEX.bam, S1.GTEX.bam, S2.GTEX.bam, PATIENT0.bam') == 1
+	assert 'Rerun SpliceJunctionDiscovery.py' not in output
+
+	for sample in ('S0.GTEX', 'S1.GTEX', 'S2.GTEX', 'PATIENT0'):
+		assert os.path.isfile(str(dataset / sample / '.discovery_complete'))
+
+	output = runScript('SpliceJunctionDiscovery.py', ['-transcript_file=transcripts.list', '-processes=2'] + list(arguments), dataset)
+
+	assert '124 of 124 (gene region, bam file) pairs found in the result cache' in output
+	assert 'Warning' not in output
+	assert discoveredJunctions(dataset) == referenceJunctions
@@ -0,0 +1,29 @@
+from TaskScheduling import largestFirst, partitionLargestFirst
+
+def test_largestFirst_keeps_ties_in_order():
+
+	assert largestFirst(['a', 'b', 'c', 'd'], [1, 5, 1, 3]) == ['b', 'd', 'a', 'c']
+
+def test_partitionLargestFirst_balances_costs():
+
+	shards, totals = partitionLargestFirst([8, 7, 6, 5, 4, 3, 2, 1], 2)
+
+	assert sorted(i for shard in shards for i in shard) == list(range(8))
+	assert totals == [18, 18]
+
+def test_partitionLargestFirst_spreads_zero_cost_tasks():
+
+	"""
+	Between shards of the same total the one with the fewest tasks is picked, so tasks costed at 0 do not all go to the first shard
+	"""
+
+	shards, totals = partitionLargestFirst([5, 5, 5] + [0] * 540, 3)
+
+	assert [len(shard) for shard in shards] == [181, 181, 181]
+	assert totals == [5, 5, 5]
+
+def test_partitionLargestFirst_is_deterministic():
+
+	costs = [3, 0, 0, 7, 3, 0, 1]
+
+	assert partitionLargestFirst(costs, 3) == partitionLargestFirst(list(costs), 3)